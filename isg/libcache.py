@@ -1,76 +1,616 @@
 # -*- coding: utf-8 -*-
 
 import memcache
+import random
+import threading
+import uuid
 
-from django.core.cache import cache
+from collections import OrderedDict
+from django.core.cache import cache, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
 from datetime import datetime
 from django.conf import settings
+from django.utils import six
+from django.utils.six.moves.queue import Queue
+from isg.libmemcached import server_names
+from isg.libmetrics import LOCAL_CACHE_LOOKUPS, PORTAL_LOOKUP_SECONDS, PORTAL_LOOKUPS
+from isg.libtable import SessionTables, remove_session_table, write_session_table
+from isgtool.contrib import log
+from time import sleep, time
 
-UID_BY_IP_TEMPLATE = 'uid_by_ip_{0}'
-SESSION_BY_UID_TEMPLATE = 'session_by_uid_{0}'
-COA_LOCK_KEY = 'coa_lock'
+# Session keys of a BRAS poll live in the namespace of its generation, see SessionCacheUpdate
+UID_BY_IP_TEMPLATE = 'uid_by_ip_{bid}_{generation}_{ip}'
+SESSION_BY_UID_TEMPLATE = 'session_by_uid_{bid}_{generation}_{uid}'
+SESSION_GENERATION_TEMPLATE = 'session_generation_{0}'
+BRAS_BY_SESSION_IP_TEMPLATE = 'bras_by_session_ip_{0}'
+BRAS_BY_SESSION_UID_TEMPLATE = 'bras_by_session_uid_{0}'
+# Changed whenever new sessions of the /24 network are cached, its unknown IPs remembered before are looked up again
+SESSION_EPOCH_TEMPLATE = 'session_epoch_{0}'
+COA_LOCK_KEY = 'coa_lease'
 COA_COUTER_KEY = 'coa_counter'
 COA_SID_TEMPLATE = 'sid_from_cid_{cid}_for_uid_{uid}'
 
 BRAS_UPDATED_TIME = 'bras_{0}_updated_time'
 BRAS_UPDATED_SESSIONS = 'bras_{0}_updated_sessions'
 
+# memcached stats describing the server itself, not added up over the servers
+NODE_STATS = ('pid', 'uptime', 'time', 'version', 'libevent', 'pointer_size', 'threads')
 
-def cache_session_data(session_data):
+
+class LocalCache(object):
+    """Per-process LRU cache in front of the shared cache.
+
+    Every key belongs to a family with its own TTL in LOCAL_CACHE_TTL, a family
+    with no TTL isn't cached locally. Entries are dropped explicitly when the
+    objects change in this process, other processes see the change after TTL.
+    Hits and misses are counted by LOCAL_CACHE_LOOKUPS.
+    """
+
+    def __init__(self, max_entries, ttls):
+        self.max_entries = max_entries
+        self.ttls = ttls
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, family, key):
+        if not self.ttls.get(family):
+            return None
+        with self.lock:
+            entry = self.data.pop((family, key), None)
+            if entry is not None and entry[0] >= time():
+                self.data[(family, key)] = entry
+            else:
+                entry = None
+        LOCAL_CACHE_LOOKUPS.inc(family=family, result='miss' if entry is None else 'hit')
+        return None if entry is None else entry[1]
+
+    def set(self, family, key, value):
+        ttl = self.ttls.get(family)
+        if not ttl:
+            return
+        with self.lock:
+            self.data.pop((family, key), None)
+            self.data[(family, key)] = (time() + ttl, value)
+            while len(self.data) > self.max_entries:
+                self.data.popitem(last=False)
+
+    def delete(self, family, key):
+        with self.lock:
+            self.data.pop((family, key), None)
+
+    def clear(self, family=None):
+        with self.lock:
+            if family is None:
+                self.data.clear()
+            else:
+                for entry_key in [entry_key for entry_key in self.data if entry_key[0] == family]:
+                    del self.data[entry_key]
+
+    def stats(self):
+        return dict((family, dict(hits=LOCAL_CACHE_LOOKUPS.get(family=family, result='hit'),
+                                  misses=LOCAL_CACHE_LOOKUPS.get(family=family, result='miss')))
+                    for family in self.ttls)
+
+
+local_cache = LocalCache(settings.LOCAL_CACHE_MAX_ENTRIES, settings.LOCAL_CACHE_TTL)
+
+
+
+class CachedValue(object):
+    """Compact cache form of a model: the fields the hot path reads.
+
+    The cache keeps the ('TAG', VERSION, field, ...) tuple, which is small
+    and cheap to pickle and doesn't depend on the model class. A value of
+    another type or version reads as a miss, so changing the fields only
+    takes a VERSION bump. Subclasses list the fields in __slots__.
+    """
+    __slots__ = ()
+    TAG = None
+    VERSION = 1
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_instance(cls, instance):
+        return cls(*[getattr(instance, name) for name in cls.__slots__])
+
+    @classmethod
+    def unpack(cls, value):
+        if type(value) is tuple and len(value) == len(cls.__slots__) + 2 and value[:2] == (cls.TAG, cls.VERSION):
+            return cls(*value[2:])
+        return None
+
+    def pack(self):
+        return (self.TAG, self.VERSION) + tuple([getattr(self, name) for name in self.__slots__])
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, ' '.join(
+            ['{0}={1!r}'.format(name, getattr(self, name)) for name in self.__slots__]))
+
+
+session_tables = None
+if settings.SESSION_TABLE_DIR:
+    session_tables = SessionTables(settings.SESSION_TABLE_DIR, max_age=settings.SESSION_CACHE_TIMEOUT)
+
+
+class CacheWriter(object):
+    """Writes keys to the cache by chunks of SESSION_CACHE_CHUNK_SIZE keys.
+
+    Chunks are written by a background thread while the caller prepares the
+    next ones, at most SESSION_CACHE_PIPELINE chunks wait for it (0 - write in
+    the caller's thread). A failed chunk is retried on its own, so are the
+    keys a backend returning them from set_many() hasn't stored.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, backend=None):
+        self.timeout = timeout
+        self.backend = backend or cache
+        self.chunk_size = settings.SESSION_CACHE_CHUNK_SIZE
+        self.retries = settings.SESSION_CACHE_RETRIES
+        self.chunk = {}
+        self.keys = 0
+        self.failed = 0
+        self.started = time()
+        self.elapsed = None
+        self.queue = None
+        if settings.SESSION_CACHE_PIPELINE > 0:
+            self.queue = Queue(settings.SESSION_CACHE_PIPELINE)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def set(self, key, value):
+        self.chunk[key] = value
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def set_many(self, data):
+        for key in data:
+            self.set(key, data[key])
+
+    def flush(self):
+        if self.chunk:
+            if self.queue is not None:
+                self.queue.put(self.chunk)
+            else:
+                self._write(self.chunk)
+            self.chunk = {}
+
+    def close(self):
+        self.flush()
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        self.elapsed = time() - self.started
+        return self
+
+    def rate(self):
+        elapsed = self.elapsed if self.elapsed is not None else time() - self.started
+        return self.keys / elapsed if elapsed > 0 else 0.0
+
+    def _run(self):
+        chunk = self.queue.get()
+        while chunk is not None:
+            self._write(chunk)
+            chunk = self.queue.get()
+
+    def _write(self, chunk):
+        logger = log(self)
+        for attempt in range(self.retries + 1):
+            try:
+                failed_keys = self.backend.set_many(chunk, self.timeout)
+            except Exception as ex:
+                logger.warning(u'Writing {0} keys to the cache failed: {1}'.format(len(chunk), ex))
+                continue
+            if not failed_keys:
+                self.keys += len(chunk)
+                return
+            self.keys += len(chunk) - len(failed_keys)
+            chunk = dict((key, chunk[key]) for key in failed_keys)
+        logger.error(u'{0} keys weren\'t written to the cache'.format(len(chunk)))
+        self.failed += len(chunk)
+
+
+def new_generation():
+    return '{0:x}'.format(int(time() * 1000000))
+
+
+def session_generation(bid):
+    """Current session generation of the BRAS, None if it has no cached sessions."""
+    generation = local_cache.get('generation', bid)
+    if generation is None:
+        generation = cache.get(SESSION_GENERATION_TEMPLATE.format(bid))
+        if generation is not None:
+            local_cache.set('generation', bid, generation)
+    return generation
+
+
+def session_generations(bids):
+    generations = {}
+    keys = {}
+    for bid in set(bids):
+        generation = local_cache.get('generation', bid)
+        if generation is None:
+            keys[SESSION_GENERATION_TEMPLATE.format(bid)] = bid
+        else:
+            generations[bid] = generation
+    for key, generation in cache.get_many(keys).items():
+        if generation is not None:
+            generations[keys[key]] = generation
+            local_cache.set('generation', keys[key], generation)
+    return generations
+
+
+def invalidate_bras_sessions(bid, address=None):
+    """Drop all cached sessions of the BRAS with one write, the keys of its generations expire by themselves."""
+    address = address if address is not None else bid
+    cache.delete(SESSION_GENERATION_TEMPLATE.format(address))
+    local_cache.delete('generation', address)
+    if settings.SESSION_TABLE_DIR:
+        remove_session_table(settings.SESSION_TABLE_DIR, bid)
+
+
+def ip_network(ip):
+    """/24 network of an IPv4 address, any other address is its own network."""
+    return ip.rsplit('.', 1)[0] if '.' in ip else ip
+
+
+def session_epoch(ip):
+    key = SESSION_EPOCH_TEMPLATE.format(ip_network(ip))
+    epoch = local_cache.get('epoch', key)
+    if epoch is None:
+        epoch = cache.get(key) or 0
+        local_cache.set('epoch', key, epoch)
+    return epoch
+
+
+def new_sessions_cached(ips):
+    """Make all processes forget the unknown IPs of the networks where the IPs have got sessions."""
+    keys = set([SESSION_EPOCH_TEMPLATE.format(ip_network(ip)) for ip in ips])
+    if not keys:
+        return
+    cache.set_many(dict.fromkeys(keys, new_generation()), None)
+    for key in keys:
+        local_cache.delete('epoch', key)
+
+
+def route_items(session_data):
+    """Keys pointing the session IP and UID to the BRAS generation holding them."""
+    items = {}
+    for session in session_data:
+        items[BRAS_BY_SESSION_IP_TEMPLATE.format(session['ip'])] = session['bid']
+        items[BRAS_BY_SESSION_UID_TEMPLATE.format(session['uid'])] = session['bid']
+    return items
+
+
+def cache_session_data(session_data, timeout=DEFAULT_TIMEOUT, writer=None, generation=None, routes=True):
+    """Cache the sessions in the given generation of their BRAS, the current one by default."""
     if type(session_data) == dict:
         session_data = [session_data, ]
-    cache_data = {}
+    own_writer = writer is None
+    if own_writer:
+        writer = CacheWriter(timeout)
+    generations = {}
+    if generation is None:
+        bids = set([session['bid'] for session in session_data])
+        generations = session_generations(bids)
+        for bid in bids - set(generations):
+            cache.add(SESSION_GENERATION_TEMPLATE.format(bid), new_generation(), None)
+            generations[bid] = session_generation(bid)
     for session in session_data:
         ip = session['ip']
         bid = session['bid']
         uid = session['uid']
         sid = session['sid']
-        uid_by_ip_key = UID_BY_IP_TEMPLATE.format(ip)
-        session_by_uid_key = SESSION_BY_UID_TEMPLATE.format(uid)
+        session_generation_value = generation or generations[bid]
+        uid_by_ip_key = UID_BY_IP_TEMPLATE.format(bid=bid, generation=session_generation_value, ip=ip)
+        session_by_uid_key = SESSION_BY_UID_TEMPLATE.format(bid=bid, generation=session_generation_value, uid=uid)
         session_detail = ' '.join([bid, sid])
-        cache_data[uid_by_ip_key] = uid
-        cache_data[session_by_uid_key] = session_detail
-    cache.set_many(cache_data)
+        writer.set(uid_by_ip_key, uid)
+        writer.set(session_by_uid_key, session_detail)
+    if routes:
+        writer.set_many(route_items(session_data))
+    if own_writer:
+        writer.close()
+    if routes:
+        new_sessions_cached([session['ip'] for session in session_data])
+    return writer
+
+
+_snapshots = {}
+
+
+class EmptyPoll(Exception):
+    pass
+
+
+class SessionCacheUpdate(object):
+    """Caches sessions of one BRAS poll writing only what has changed since the previous poll.
+
+    The previous poll's sessions are kept in the process memory, keys of the
+    ended sessions are deleted on finish(). Every SESSION_FULL_SYNC_INTERVAL
+    seconds all sessions are written to a new generation instead, which
+    readers see at once when finish() switches the BRAS generation key to it,
+    the keys of the replaced generation expire by themselves. The keys
+    pointing session IPs and UIDs to the BRAS are written after the switch.
+    With SESSION_TABLE_DIR set the poll is also published as the BRAS session
+    table.
+
+    finish() refuses to publish a poll without sessions, raising EmptyPoll,
+    unless allow_empty is set: an error banner or a cut listing parses to
+    nothing and would replace every session of the BRAS.
+
+    Keys live for timeout seconds, SESSION_CACHE_TIMEOUT by default. A
+    one-shot poll which leaves no snapshot for the next run should pass a
+    shorter timeout, its ended sessions are only dropped by expiry.
+
+    Unchanged keys are rewritten by full syncs only, so SESSION_CACHE_TIMEOUT
+    has to exceed SESSION_FULL_SYNC_INTERVAL by the longest poll and a
+    margin, and no more than that: every session takes four keys (the IP
+    and the UID of the generation and their routes) and the replaced
+    generation stays resident until it expires, so for SESSION_CACHE_TIMEOUT
+    - SESSION_FULL_SYNC_INTERVAL seconds after a full sync a BRAS takes
+    twice its keys.
+    """
+
+    def __init__(self, bid, address=None, timeout=None):
+        self.bid = bid
+        self.address = address if address is not None else bid
+        self.timeout = timeout if timeout is not None else settings.SESSION_CACHE_TIMEOUT
+        previous, synced, generation = _snapshots.get(bid, (None, 0, None))
+        self.previous = previous or {}
+        # The sessions of the snapshot are gone from the cache, e.g. dropped by invalidate_bras_sessions()
+        self.lost = (previous is not None and
+                     cache.get(SESSION_GENERATION_TEMPLATE.format(self.address)) != generation)
+        self.full = previous is None or self.lost or time() - synced >= settings.SESSION_FULL_SYNC_INTERVAL
+        if self.full:
+            generation = new_generation()
+        self.generation = generation
+        self.current = {}
+        self.routes = {}
+        self.appeared = []
+        self.writer = CacheWriter(self.timeout)
+        self.sessions = 0
+        self.added = 0
+        self.changed = 0
+        self.removed = 0
+        self.written = 0
+
+    def update(self, session_data):
+        changed = []
+        for session in session_data:
+            ip = session['ip']
+            value = (session['uid'], session['sid'])
+            if self.current.get(ip) == value:
+                continue
+            self.sessions += 1
+            self.current[ip] = value
+            previous = self.previous.get(ip)
+            if previous is None or self.lost:
+                self.appeared.append(ip)
+            if previous is None:
+                self.added += 1
+            elif previous != value:
+                self.changed += 1
+            elif not self.full:
+                continue
+            changed.append(session)
+        cache_session_data(changed, writer=self.writer, generation=self.generation, routes=False)
+        self.routes.update(route_items(changed))
+
+    def abort(self):
+        self.writer.close()
+        self.previous = None
+
+    def finish(self, allow_empty=False):
+        if not self.current and not allow_empty:
+            self.abort()
+            raise EmptyPoll(u'No sessions of BRAS {0} to publish'.format(self.address))
+        self.writer.close()
+        if self.full:
+            cache.set(SESSION_GENERATION_TEMPLATE.format(self.address), self.generation, None)
+            local_cache.delete('generation', self.address)
+        routes = CacheWriter(self.timeout)
+        routes.set_many(self.routes)
+        routes.close()
+        new_sessions_cached(self.appeared)
+        self.written = self.writer.keys + routes.keys
+        uids = set([uid for uid, sid in self.current.values()])
+        stale_keys = []
+        for ip, (uid, sid) in self.previous.items():
+            if ip not in self.current:
+                self.removed += 1
+                if not self.full:
+                    stale_keys.append(UID_BY_IP_TEMPLATE.format(bid=self.address, generation=self.generation, ip=ip))
+            if uid not in uids and not self.full:
+                stale_keys.append(SESSION_BY_UID_TEMPLATE.format(bid=self.address, generation=self.generation,
+                                                                 uid=uid))
+        for index in range(0, len(stale_keys), settings.SESSION_CHUNK_SIZE):
+            cache.delete_many(stale_keys[index:index + settings.SESSION_CHUNK_SIZE])
+        if settings.SESSION_TABLE_DIR:
+            write_session_table(settings.SESSION_TABLE_DIR, self.bid, self.current, self.address, self.generation)
+        _, synced, _ = _snapshots.get(self.bid, (None, 0, None))
+        _snapshots[self.bid] = (self.current, time() if self.full else synced, self.generation)
+        self.previous = None
+        self.routes = None
+        self.appeared = None
+        return self
+
+
+def _lookup_uid(ip):
+    if session_tables is not None:
+        record = session_tables.lookup(ip, session_generation)
+        if record:
+            return record[0], 'table'
+    uid = local_cache.get('uid', ip)
+    if uid is not None:
+        return uid, 'local'
+    epoch = session_epoch(ip)
+    if local_cache.get('uid_miss', ip) == epoch:
+        return None, 'negative'
+    bid = cache.get(BRAS_BY_SESSION_IP_TEMPLATE.format(ip))
+    generation = session_generation(bid) if bid else None
+    uid = None
+    if generation is not None:
+        uid = cache.get(UID_BY_IP_TEMPLATE.format(bid=bid, generation=generation, ip=ip))
+    if uid:
+        local_cache.set('uid', ip, uid)
+        return uid, 'memcached'
+    local_cache.set('uid_miss', ip, epoch)
+    return None, 'miss'
 
 
 def get_uid(ip):
     if settings.DEBUG and ip == '127.0.0.1':
         return settings.DEBUG_UID
     else:
-        key = UID_BY_IP_TEMPLATE.format(ip)
-        return cache.get(key)
+        started = time()
+        uid, source = _lookup_uid(ip)
+        PORTAL_LOOKUPS.inc(kind='uid', source=source)
+        PORTAL_LOOKUP_SECONDS.observe(time() - started, kind='uid')
+        return uid
 
 
 def get_session_detail(uid):
-    key = SESSION_BY_UID_TEMPLATE.format(uid)
-    session_detail = cache.get(key)
-    if session_detail:
-        return session_detail.split(' ')
-    else:
-        return [None, None]
+    return get_session_details([uid]).get(uid, [None, None])
+
+
+def get_session_details(uids):
+    """{uid: [bid, sid]} of the users with a session in the current generation of their BRAS."""
+    routes = dict((BRAS_BY_SESSION_UID_TEMPLATE.format(uid), uid) for uid in uids)
+    bids = dict((routes[key], bid) for key, bid in cache.get_many(routes).items() if bid)
+    generations = session_generations(bids.values())
+    keys = dict((SESSION_BY_UID_TEMPLATE.format(bid=bid, generation=generations[bid], uid=uid), uid)
+                for uid, bid in bids.items() if bid in generations)
+    return dict((keys[key], session_detail.split(' ')) for key, session_detail in cache.get_many(keys).items()
+                if session_detail)
+
+
+class LockLost(Exception):
+    pass
+
+
+_compare_lock = threading.Lock()
+
+
+class LeaseLock(object):
+    """Lock shared by processes through the cache.
+
+    The lock is taken by an atomic add() of a random owner token which
+    expires in ttl seconds, so a crashed job can't keep it. Long jobs call
+    renew_if_due() while they work; renew() raises LockLost if the lease has
+    expired and somebody else has taken the lock. Waiters back off
+    exponentially with jitter up to max_delay seconds.
 
+    Renewal and release change the lease only if it still holds the token,
+    with the backend's compare_and_set() (memcached gets/cas). Backends
+    without it are compared under a process lock, which is atomic for the
+    per-process locmem cache only: with any other such backend processes
+    may take over each other's lease, a warning is logged.
+    """
 
-def lock_coa():
-    cache.set(COA_LOCK_KEY, True, None)
+    def __init__(self, key, ttl, backend=None, max_delay=2.0):
+        self.key = key
+        self.ttl = ttl
+        self.backend = backend or caches['default']
+        if not hasattr(self.backend, 'compare_and_set') and not isinstance(self.backend, LocMemCache):
+            log(self).warning(u'Cache backend {0} has no compare_and_set(), lock \'{1}\' isn\'t atomic across '
+                              u'processes'.format(self.backend.__class__.__name__, key))
+        self.max_delay = max_delay
+        self.token = None
+        self.renewed = 0
 
+    def __enter__(self):
+        self.acquire()
+        return self
 
-def unlock_coa():
-    cache.set(COA_LOCK_KEY, False, None)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
 
+    def acquire(self, blocking=True, timeout=None):
+        token = uuid.uuid4().hex
+        started = time()
+        delay = 0.01
+        while not self._add(token):
+            if not blocking or (timeout is not None and time() - started >= timeout):
+                return False
+            sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, self.max_delay)
+        self.token = token
+        self.renewed = time()
+        return True
 
-def coa_is_locked():
-    return cache.get(COA_LOCK_KEY)
+    def owned(self):
+        return self.token is not None and self.backend.get(self.key) == self.token
 
+    def _add(self, token):
+        if hasattr(self.backend, 'compare_and_set'):
+            return self.backend.add(self.key, token, self.ttl)
+        with _compare_lock:
+            return self.backend.add(self.key, token, self.ttl)
 
-def cache_stats():
-    mc = memcache.Client((settings.CACHES['default']['LOCATION'],))
-    stats = mc.get_stats()[0][1]
-    for key in stats:
-        try:
-            stats[key] = int(stats[key])
-        except ValueError:
-            pass
-    return stats
+    def _replace(self, timeout):
+        """Store the token for timeout seconds (0 - delete) if the lease still holds it."""
+        if self.token is None:
+            return False
+        if hasattr(self.backend, 'compare_and_set'):
+            return self.backend.compare_and_set(self.key, self.token, self.token, timeout)
+        with _compare_lock:
+            if self.backend.get(self.key) != self.token:
+                return False
+            self.backend.set(self.key, self.token, timeout)
+            return True
+
+    def renew(self):
+        if not self._replace(self.ttl):
+            self.token = None
+            raise LockLost(u'Lock \'{0}\' has been lost'.format(self.key))
+        self.renewed = time()
+
+    def renew_if_due(self):
+        if time() - self.renewed >= self.ttl / 3.0:
+            self.renew()
+
+    def release(self):
+        self._replace(0)
+        self.token = None
+
+
+def coa_lock():
+    return LeaseLock(COA_LOCK_KEY, settings.COA_LOCK_TTL)
+
+
+def cache_node_stats():
+    """[(server, stats)] of every memcached server of the default cache, the unreachable ones are left out."""
+    mc = memcache.Client(server_names(settings.CACHES['default']['LOCATION']))
+    node_stats = []
+    for name, stats in mc.get_stats():
+        for key in stats:
+            try:
+                stats[key] = int(stats[key])
+            except ValueError:
+                pass
+        node_stats.append((name.split(' ')[0], stats))
+    mc.disconnect_all()
+    return node_stats
+
+
+def cache_stats(node_stats=None):
+    """Stats of all memcached servers added up, NODE_STATS are taken from the first server."""
+    if node_stats is None:
+        node_stats = cache_node_stats()
+    total = {'nodes': len(node_stats)}
+    for name, stats in node_stats:
+        for key, value in stats.items():
+            if key not in total:
+                total[key] = value
+            elif key not in NODE_STATS and isinstance(value, six.integer_types) and isinstance(total[key], six.integer_types):
+                total[key] += value
+    return total
 
 
 def increase_coa_counter():
@@ -106,3 +646,8 @@ def set_coa_sid(cid, uid, sid):
 
 def get_last_coa_sid(cid, uid):
     return cache.get(COA_SID_TEMPLATE.format(cid=cid, uid=uid))
+
+
+def get_last_coa_sids(cid, uids):
+    keys = dict((COA_SID_TEMPLATE.format(cid=cid, uid=uid), uid) for uid in uids)
+    return dict((keys[key], sid) for key, sid in cache.get_many(keys).items())
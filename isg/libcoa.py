@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import re
+import select
+import socket
+import struct
+import threading
+
+from collections import deque
+from django.conf import settings
+from isg.libmetrics import COA_COMPLETED, COA_LATENCY_SECONDS, COA_SENT, COA_SKIPPED
+from time import time
+
+COA_REQUEST = 43
+COA_ACK = 44
+COA_NAK = 45
+DISCONNECT_REQUEST = 40
+DISCONNECT_ACK = 41
+DISCONNECT_NAK = 42
+
+CODE_NAMES = {
+    COA_REQUEST: 'CoA-Request',
+    COA_ACK: 'CoA-ACK',
+    COA_NAK: 'CoA-NAK',
+    DISCONNECT_REQUEST: 'Disconnect-Request',
+    DISCONNECT_ACK: 'Disconnect-ACK',
+    DISCONNECT_NAK: 'Disconnect-NAK',
+}
+
+# Return codes are the radclient exit codes CoaCommand.run() used to return
+RESULT_SUCCESS = 0
+RESULT_FAILURE = 1
+
+VENDOR_SPECIFIC = 26
+CISCO = 9
+
+# name: (vendor, type, data type), other attributes are written as Attr-<type> or Vendor-<vendor>-Attr-<type>
+ATTRIBUTES = {
+    'User-Name': (None, 1, 'string'),
+    'NAS-IP-Address': (None, 4, 'ipaddr'),
+    'NAS-Port': (None, 5, 'integer'),
+    'Service-Type': (None, 6, 'integer'),
+    'Framed-IP-Address': (None, 8, 'ipaddr'),
+    'Framed-IP-Netmask': (None, 9, 'ipaddr'),
+    'Filter-Id': (None, 11, 'string'),
+    'Reply-Message': (None, 18, 'string'),
+    'State': (None, 24, 'octets'),
+    'Class': (None, 25, 'octets'),
+    'Session-Timeout': (None, 27, 'integer'),
+    'Idle-Timeout': (None, 28, 'integer'),
+    'Called-Station-Id': (None, 30, 'string'),
+    'Calling-Station-Id': (None, 31, 'string'),
+    'NAS-Identifier': (None, 32, 'string'),
+    'Acct-Session-Id': (None, 44, 'string'),
+    'Acct-Terminate-Cause': (None, 49, 'integer'),
+    'Acct-Multi-Session-Id': (None, 50, 'string'),
+    'Event-Timestamp': (None, 55, 'integer'),
+    'NAS-Port-Type': (None, 61, 'integer'),
+    'Acct-Interim-Interval': (None, 85, 'integer'),
+    'NAS-Port-Id': (None, 87, 'string'),
+    'Error-Cause': (None, 101, 'integer'),
+    'Cisco-AVPair': (CISCO, 1, 'string'),
+    'Cisco-NAS-Port': (CISCO, 2, 'string'),
+    'Cisco-Subscriber-Password': (CISCO, 249, 'string'),
+    'Cisco-Account-Info': (CISCO, 250, 'string'),
+    'Cisco-Service-Info': (CISCO, 251, 'string'),
+    'Cisco-Command-Code': (CISCO, 252, 'string'),
+    'Cisco-Control-Info': (CISCO, 253, 'string'),
+}
+
+ATTRIBUTE_NAMES = dict(((vendor, code), name) for name, (vendor, code, data_type) in ATTRIBUTES.items())
+
+RAW_ATTRIBUTE_RE = re.compile(r'^(?:Vendor-(\d+)-)?Attr-(\d+)$')
+MESSAGE_PAIR_RE = re.compile(r'([\w-]+)\s*[:+]?=\s*("(?:[^"\\]|\\.)*"|[^,\s]+)\s*,?')
+ESCAPE_RE = re.compile(r'\\([0-7]{3}|.)')
+ESCAPES = {'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class CoaError(Exception):
+    pass
+
+
+def _unescape(match):
+    value = match.group(1)
+    if len(value) == 3:
+        return chr(int(value, 8))
+    return ESCAPES.get(value, value)
+
+
+def parse_message(message):
+    """Parse radclient-style 'Attribute = value' text into a list of pairs."""
+    pairs = []
+    for line in message.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        position = 0
+        for match in MESSAGE_PAIR_RE.finditer(line):
+            if line[position:match.start()].strip():
+                break
+            name, value = match.groups()
+            if value.startswith('"'):
+                value = ESCAPE_RE.sub(_unescape, value[1:-1])
+            pairs.append((name, value))
+            position = match.end()
+        if line[position:].strip():
+            raise CoaError(u'Invalid RADIUS message line: {0}'.format(line))
+    return pairs
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def attribute_definition(name):
+    """(vendor, type, data type) of the attribute, the raw Attr-<type> ones are octets."""
+    if name in ATTRIBUTES:
+        return ATTRIBUTES[name]
+    match = RAW_ATTRIBUTE_RE.match(name)
+    if match is None or not 0 < int(match.group(2)) < 256:
+        raise CoaError(u'Unknown RADIUS attribute {0}'.format(name))
+    vendor, code = match.groups()
+    return int(vendor) if vendor else None, int(code), 'octets'
+
+
+def encode_attribute(name, value):
+    vendor, code, data_type = attribute_definition(name)
+    if data_type == 'integer':
+        data = struct.pack('!I', int(value))
+    elif data_type == 'ipaddr':
+        data = socket.inet_aton(value)
+    elif data_type == 'octets' and value.startswith('0x'):
+        data = bytes(bytearray.fromhex(value[2:]))
+    else:
+        data = _to_bytes(value)
+    if vendor is None:
+        if len(data) > 253:
+            raise CoaError(u'RADIUS attribute {0} is too long'.format(name))
+        return struct.pack('!BB', code, len(data) + 2) + data
+    if len(data) > 247:
+        raise CoaError(u'RADIUS attribute {0} is too long'.format(name))
+    return struct.pack('!BBIBB', VENDOR_SPECIFIC, len(data) + 8, vendor, code, len(data) + 2) + data
+
+
+def decode_attributes(data):
+    attributes = []
+    data = bytearray(data)
+    position = 0
+    while position + 2 <= len(data):
+        code, length = data[position], data[position + 1]
+        if length < 2 or position + length > len(data):
+            raise CoaError(u'Malformed RADIUS attribute')
+        value = bytes(data[position + 2:position + length])
+        position += length
+        if code == VENDOR_SPECIFIC and len(value) >= 6:
+            vendor, vendor_code, vendor_length = struct.unpack('!IBB', value[:6])
+            attributes.append((ATTRIBUTE_NAMES.get((vendor, vendor_code),
+                                                   'Vendor-{0}-Attr-{1}'.format(vendor, vendor_code)),
+                               value[6:vendor_length + 4]))
+        else:
+            attributes.append((ATTRIBUTE_NAMES.get((None, code), 'Attr-{0}'.format(code)), value))
+    return attributes
+
+
+def encode_request(identifier, secret, pairs, code=COA_REQUEST):
+    attributes = b''.join([encode_attribute(name, value) for name, value in pairs])
+    header = struct.pack('!BBH', code, identifier, 20 + len(attributes))
+    authenticator = hashlib.md5(header + b'\x00' * 16 + attributes + _to_bytes(secret)).digest()
+    return header + authenticator + attributes, authenticator
+
+
+def encode_reply(request, secret, code, pairs=()):
+    attributes = b''.join([encode_attribute(name, value) for name, value in pairs])
+    header = struct.pack('!BBH', code, bytearray(request)[1], 20 + len(attributes))
+    authenticator = hashlib.md5(header + request[4:20] + attributes + _to_bytes(secret)).digest()
+    return header + authenticator + attributes
+
+
+def decode_packet(packet):
+    if len(packet) < 20:
+        raise CoaError(u'RADIUS packet is too short')
+    code, identifier, length = struct.unpack('!BBH', packet[:4])
+    if length < 20 or length > len(packet):
+        raise CoaError(u'Invalid RADIUS packet length')
+    return code, identifier, packet[4:20], decode_attributes(packet[20:length])
+
+
+def verify_request(packet, secret):
+    length = struct.unpack('!H', packet[2:4])[0]
+    expected = hashlib.md5(packet[:4] + b'\x00' * 16 + packet[20:length] + _to_bytes(secret)).digest()
+    return expected == packet[4:20]
+
+
+def verify_reply(packet, request_authenticator, secret):
+    length = struct.unpack('!H', packet[2:4])[0]
+    expected = hashlib.md5(packet[:4] + request_authenticator + packet[20:length] + _to_bytes(secret)).digest()
+    return expected == packet[4:20]
+
+
+class CoaRequest(object):
+    __slots__ = ('address', 'identifier', 'secret', 'packet', 'authenticator', 'callback', 'started', 'expires',
+                 'attempts', 'reply_code', 'reply_attributes', 'result', 'context')
+
+    def __init__(self, address, identifier, secret, packet, authenticator, callback, context):
+        self.address = address
+        self.identifier = identifier
+        self.secret = secret
+        self.packet = packet
+        self.authenticator = authenticator
+        self.callback = callback
+        self.context = context
+        self.started = time()
+        self.expires = None
+        self.attempts = 0
+        self.reply_code = None
+        self.reply_attributes = None
+        self.result = None
+
+    @property
+    def done(self):
+        return self.result is not None
+
+    def describe(self):
+        if self.reply_code is None:
+            return u'No reply from {0}:{1} after {2} attempt(s)'.format(self.address[0], self.address[1],
+                                                                         self.attempts)
+        description = u'{0} from {1}:{2}'.format(CODE_NAMES.get(self.reply_code, self.reply_code), *self.address)
+        if self.reply_attributes:
+            description += u': ' + u', '.join([u'{0} = {1!r}'.format(name, value)
+                                                for name, value in self.reply_attributes])
+        return description
+
+
+class CoaClient(object):
+    """Sends CoA requests from one UDP socket, many of them may be in flight at once.
+
+    Every destination gets its own 256 RADIUS identifiers. The client is not
+    thread-safe, use get_client() to get a client owned by the current thread.
+    """
+
+    def __init__(self, timeout=3, retries=1):
+        self.timeout = timeout
+        self.retries = retries
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('', 0))
+        self.socket.setblocking(0)
+        self.pending = {}
+        self.counts = {}
+        self.identifiers = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def close(self):
+        self.socket.close()
+
+    def in_flight(self, address):
+        return self.counts.get(address, 0)
+
+    def _identifier(self, address):
+        start = self.identifiers.get(address, ord(os.urandom(1)))
+        for offset in range(256):
+            identifier = (start + offset) % 256
+            if (address, identifier) not in self.pending:
+                self.identifiers[address] = identifier + 1
+                return identifier
+        return None
+
+    def _send(self, request):
+        request.attempts += 1
+        request.expires = time() + self.timeout
+        try:
+            self.socket.sendto(request.packet, request.address)
+        except socket.error:
+            pass
+
+    def submit(self, host, port, secret, message, callback=None, context=None):
+        pairs = parse_message(message) if not isinstance(message, list) else message
+        address = (socket.gethostbyname(host), int(port))
+        identifier = self._identifier(address)
+        while identifier is None:
+            self.process(self.timeout)
+            identifier = self._identifier(address)
+        packet, authenticator = encode_request(identifier, secret, pairs)
+        request = CoaRequest(address, identifier, secret, packet, authenticator, callback, context)
+        self.pending[(address, identifier)] = request
+        self.counts[address] = self.counts.get(address, 0) + 1
+        self._send(request)
+        COA_SENT.inc()
+        return request
+
+    def _complete(self, request, result):
+        del self.pending[(request.address, request.identifier)]
+        self.counts[request.address] -= 1
+        request.result = result
+        COA_COMPLETED.inc(result='succeeded' if result == RESULT_SUCCESS else 'failed')
+        COA_LATENCY_SECONDS.observe(time() - request.started)
+        if request.callback:
+            request.callback(request)
+
+    def process(self, timeout=0):
+        """Handle replies and retransmits, wait at most timeout seconds for a reply."""
+        if self.pending:
+            timeout = max(0, min(timeout, min([request.expires for request in self.pending.values()]) - time()))
+        readable = select.select([self.socket], [], [], timeout)[0]
+        while readable:
+            try:
+                packet, address = self.socket.recvfrom(4096)
+            except socket.error:
+                break
+            try:
+                code, identifier, authenticator, attributes = decode_packet(packet)
+            except CoaError:
+                continue
+            request = self.pending.get((address, identifier))
+            if request is None or not verify_reply(packet, request.authenticator, request.secret):
+                continue
+            request.reply_code = code
+            request.reply_attributes = attributes
+            self._complete(request, RESULT_SUCCESS if code in (COA_ACK, DISCONNECT_ACK) else RESULT_FAILURE)
+        now = time()
+        for request in [request for request in self.pending.values() if request.expires <= now]:
+            if request.attempts > self.retries:
+                self._complete(request, RESULT_FAILURE)
+            else:
+                self._send(request)
+
+    def wait(self, requests=None):
+        if requests is None:
+            while self.pending:
+                self.process(self.timeout)
+        else:
+            while not all([request.done for request in requests]):
+                self.process(self.timeout)
+
+    def request(self, host, port, secret, message):
+        request = self.submit(host, port, secret, message)
+        self.wait([request])
+        return request
+
+
+_local = threading.local()
+
+
+def get_client():
+    client = getattr(_local, 'client', None)
+    if client is None:
+        client = CoaClient(settings.COA_TIMEOUT, settings.COA_RETRIES)
+        _local.client = client
+    return client
+
+
+class CoaDispatcher(object):
+    """Spreads CoA requests over BRASs through one CoaClient.
+
+    Every BRAS gets its own queue, at most window requests in flight and at
+    most rate requests per second (0 - no limit), all BRASs are served at once.
+    submit() blocks while more than backlog requests are queued. tick is
+    called on every processing round, e.g. to renew a lock.
+    """
+
+    def __init__(self, client, window, rate, backlog=1000, progress_interval=5, logger=None, tick=None):
+        self.client = client
+        self.window = min(window, 255)
+        self.rate = rate
+        self.backlog = backlog
+        self.progress_interval = progress_interval
+        self.logger = logger
+        self.tick = tick
+        self.queues = {}
+        self.next_send = {}
+        self.queued = 0
+        self.sent = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = time()
+        self.reported = self.started
+
+    def skip(self):
+        self.skipped += 1
+        COA_SKIPPED.inc()
+
+    def fail(self):
+        self.failed += 1
+        COA_COMPLETED.inc(result='error')
+
+    def submit(self, host, port, secret, message, callback=None, context=None):
+        address = (socket.gethostbyname(host), int(port))
+        self.queues.setdefault(address, deque()).append((secret, message, callback, context))
+        self.queued += 1
+        self.pump()
+        while self.queued > self.backlog:
+            self.process()
+
+    def _completed(self, request):
+        if request.result == RESULT_SUCCESS:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        callback = request.context[0]
+        if callback:
+            callback(request, request.context[1])
+
+    def pump(self):
+        now = time()
+        for address, queue in list(self.queues.items()):
+            while queue and self.client.in_flight(address) < self.window and self.next_send.get(address, 0) <= now:
+                secret, message, callback, context = queue.popleft()
+                self.queued -= 1
+                self.sent += 1
+                self.client.submit(address[0], address[1], secret, message, self._completed, (callback, context))
+                if self.rate > 0:
+                    self.next_send[address] = max(self.next_send.get(address, 0), now - 1.0) + 1.0 / self.rate
+            if not queue:
+                del self.queues[address]
+
+    def process(self, timeout=None):
+        if timeout is None:
+            timeout = self.client.timeout
+        waiting = [self.next_send.get(address, 0) for address, queue in self.queues.items()
+                   if self.client.in_flight(address) < self.window]
+        if waiting:
+            timeout = max(0, min(timeout, min(waiting) - time()))
+        self.client.process(timeout)
+        self.pump()
+        if self.tick:
+            self.tick()
+        if self.logger and time() - self.reported >= self.progress_interval:
+            self.report()
+
+    def join(self):
+        while self.queued or len(self.client):
+            self.process()
+        if self.logger:
+            self.report()
+
+    def report(self):
+        self.reported = time()
+        elapsed = self.reported - self.started
+        self.logger.info(u'CoA sent: {0} ({1:.1f} msg/sec), succeeded: {2}, failed: {3}, skipped: {4}, '
+                         u'in flight: {5}, queued: {6}'.format(self.sent, self.sent / elapsed if elapsed else 0,
+                                                                self.succeeded, self.failed, self.skipped,
+                                                                len(self.client), self.queued))
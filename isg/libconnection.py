@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import telnetlib
+import threading
+
+from django.conf import settings
+from isgtool.contrib import log
+from time import time
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def time_left(deadline, timeout=None):
+    if deadline is None:
+        return timeout
+    remaining = deadline - time()
+    if remaining <= 0:
+        raise socket.timeout(u'Deadline exceeded')
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+class BrasConnection(object):
+    def __init__(self, bras):
+        self.name = bras.name
+        self.address = bras.ip_address
+        self.username = bras.username
+        self.password = bras.password
+        self.timeout = bras.timeout
+        self.prompt = str(bras.command_prompt)
+        self.lock = threading.Lock()
+        self.telnet = None
+        self.logins = 0
+        self.commands = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+
+    def credentials(self):
+        return self.address, self.username, self.password, self.timeout, self.prompt
+
+    def _read_until(self, expected, deadline, timeout=None):
+        result = self.telnet.read_until(expected, timeout=time_left(deadline, timeout))
+        if not result.endswith(expected):
+            raise socket.timeout(u'BRAS \'{0}\' hasn\'t sent \'{1}\''.format(self.name, expected.strip()))
+        return result
+
+    def connect(self, deadline=None):
+        self.close()
+        log(self).info(u'Open CLI session to BRAS \'{0}\''.format(self.name))
+        self.telnet = telnetlib.Telnet(self.address, settings.BRAS_TELNET_PORT, time_left(deadline, self.timeout))
+        try:
+            self._read_until('TACACS+ Username: ', deadline, self.timeout)
+            self.telnet.write('{0}\n'.format(self.username))
+            self._read_until('Password: ', deadline, self.timeout)
+            self.telnet.write('{0}\n'.format(self.password))
+            self._read_until(self.prompt, deadline, self.timeout)
+            self.telnet.write('terminal length 0\n')
+            self._read_until(self.prompt, deadline, self.timeout)
+        except:
+            self.close()
+            raise
+        self.logins += 1
+
+    def is_alive(self, deadline=None):
+        if self.telnet is None:
+            return False
+        try:
+            self.telnet.read_very_eager()
+            self.telnet.write('\n')
+            self._read_until(self.prompt, deadline, self.timeout)
+        except (EOFError, socket.error):
+            return False
+        return True
+
+    def close(self):
+        if self.telnet is not None:
+            try:
+                self.telnet.write('logout\n')
+            except socket.error:
+                pass
+            self.telnet.close()
+            self.telnet = None
+
+    def execute(self, command, deadline=None):
+        if not self.is_alive(deadline):
+            self.connect(deadline)
+        completed = False
+        try:
+            self.telnet.write('{0}\n'.format(command))
+            tail = ''
+            while True:
+                self.telnet.sock.settimeout(time_left(deadline))
+                data = self.telnet.read_some()
+                if not data:
+                    raise EOFError(u'BRAS \'{0}\' closed connection'.format(self.name))
+                window = tail + data
+                position = window.find(self.prompt)
+                if position >= 0:
+                    yield window[len(tail):position] if position >= len(tail) else ''
+                    break
+                yield data
+                tail = window[-len(self.prompt):]
+            self.telnet.sock.settimeout(self.timeout)
+            completed = True
+            self.commands += 1
+        finally:
+            if not completed:
+                self.close()
+
+
+def get_connection(bras):
+    with _connections_lock:
+        connection = _connections.get(bras.id)
+        if connection is None or connection.credentials() != BrasConnection(bras).credentials():
+            if connection is not None:
+                with connection:
+                    connection.close()
+            connection = BrasConnection(bras)
+            _connections[bras.id] = connection
+        return connection
+
+
+def close_connections():
+    with _connections_lock:
+        for connection in _connections.values():
+            with connection:
+                connection.close()
+        _connections.clear()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import memcache
+import pickle
+import re
+
+from bisect import bisect
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.memcached import MemcachedCache
+
+
+def server_names(location):
+    """Server addresses of a cache LOCATION: a list or a string separated by ';' or ','."""
+    if isinstance(location, (list, tuple)):
+        return list(location)
+    return [name.strip() for name in re.split('[;,]', location) if name.strip()]
+
+
+def ring_hash(value):
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring of the cache nodes.
+
+    Every node gets replicas points per unit of weight on the ring, a key
+    belongs to the node of the first point following the key hash. Adding a
+    node moves only the keys that fall on its points, about 1/N of all keys.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        points = []
+        for node, name, weight in nodes:
+            for n in range(replicas * weight):
+                points.append((ring_hash('{0}-{1}'.format(name, n)), node))
+        points.sort(key=lambda point: point[0])
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+        self.count = len(set([node for node, name, weight in nodes]))
+
+    def iter_nodes(self, key):
+        """Distinct nodes in the ring order starting from the key's node."""
+        if not self.hashes:
+            return
+        index = bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        seen = []
+        for offset in range(len(self.nodes)):
+            node = self.nodes[(index + offset) % len(self.nodes)]
+            if node not in seen:
+                seen.append(node)
+                yield node
+                if len(seen) == self.count:
+                    return
+
+    def node(self, key):
+        for node in self.iter_nodes(key):
+            return node
+        return None
+
+
+class ConsistentClient(memcache.Client):
+    """python-memcached client choosing servers by a HashRing instead of the hash modulo server count.
+
+    A key of a dead server goes to the next server on the ring.
+    """
+
+    def __init__(self, servers, **kwargs):
+        kwargs.setdefault('cache_cas', True)
+        super(ConsistentClient, self).__init__(servers, **kwargs)
+
+    def set_servers(self, servers):
+        self.names = [server if isinstance(server, str) else server[0] for server in servers]
+        super(ConsistentClient, self).set_servers(servers)
+
+    def _init_buckets(self):
+        self.ring = HashRing([(server, name, server.weight) for server, name in zip(self.servers, self.names)],
+                             settings.MEMCACHED_RING_REPLICAS)
+
+    def _get_server(self, key):
+        if isinstance(key, tuple):
+            key = key[1]
+        for server in self.ring.iter_nodes(key):
+            if server.connect():
+                return server, key
+        return None, None
+
+
+class ConsistentMemcachedCache(MemcachedCache):
+    """Django memcached backend spreading the keys over the LOCATION servers with consistent hashing."""
+
+    def __init__(self, server, params):
+        super(ConsistentMemcachedCache, self).__init__(server_names(server), params)
+
+    @property
+    def _cache(self):
+        if getattr(self, '_client', None) is None:
+            self._client = ConsistentClient(self._servers, pickleProtocol=pickle.HIGHEST_PROTOCOL)
+        return self._client
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        """Like MemcachedCache.set_many() but returns the keys which weren't stored."""
+        keys = dict((self.make_key(key, version=version), key) for key in data)
+        failed = self._cache.set_multi(dict((key, data[keys[key]]) for key in keys),
+                                       self.get_backend_timeout(timeout))
+        return [keys[key] for key in failed or ()]
+
+    def compare_and_set(self, key, expected, value, timeout=DEFAULT_TIMEOUT, version=None):
+        """Atomically set the key to value if it holds expected, timeout 0 deletes it. True on success."""
+        key = self.make_key(key, version=version)
+        client = self._cache
+        if client.gets(key) != expected:
+            return False
+        try:
+            return bool(client.cas(key, value, self.get_backend_timeout(timeout)))
+        finally:
+            client.cas_ids.pop(key, None)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import fcntl
+import json
+import os
+import re
+import tempfile
+import threading
+
+from bisect import bisect_left
+from django.conf import settings
+from time import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+WORKER_RE = re.compile(r'^(\d+)-(\d+)\.json$')
+RETIRED_NAME = 'retired.json'
+RETIRED_LOCK = '.retired.lock'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return u'{0}'.format(value).replace(u'\\', u'\\\\').replace(u'\n', u'\\n').replace(u'"', u'\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return u''
+    return u'{' + u','.join([u'{0}="{1}"'.format(name, _escape(value)) for name, value in pairs]) + u'}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return u'+Inf'
+    return repr(float(value)) if isinstance(value, float) else u'{0}'.format(value)
+
+
+class Metric(object):
+    """Metric values of this process, one per label values set.
+
+    Values are kept in memory and rendered on demand, updates take a lock
+    only for the dictionary access. Values of other processes are added up
+    by merge_value().
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple([labels.get(name, '') for name in self.label_names])
+
+    def render(self, values=None):
+        lines = [u'# HELP {0} {1}'.format(self.name, self.documentation),
+                 u'# TYPE {0} {1}'.format(self.name, self.kind)]
+        if values is None:
+            values = self.snapshot()
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [u'{0}{1} {2}'.format(self.name, _format_labels(self.label_names, key), _format_value(value))]
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def merge_value(self, total, value):
+        return value if total is None else total + value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def merge_value(self, total, value):
+        return value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * len(self.buckets) + [0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _render_value(self, key, counts):
+        lines = []
+        total = 0
+        for bucket, count in zip(self.buckets, counts):
+            total += count
+            lines.append(u'{0}_bucket{1} {2}'.format(self.name, _format_labels(self.label_names, key,
+                                                                                [('le', _format_value(bucket))]),
+                                                     total))
+        labels = _format_labels(self.label_names, key)
+        lines.append(u'{0}_sum{1} {2}'.format(self.name, labels, _format_value(float(counts[-1]))))
+        lines.append(u'{0}_count{1} {2}'.format(self.name, labels, total))
+        return lines
+
+    def get(self, **labels):
+        counts = self.values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def snapshot(self):
+        with self.lock:
+            return dict((key, list(counts)) for key, counts in self.values.items())
+
+    def merge_value(self, total, value):
+        return list(value) if total is None else [a + b for a, b in zip(total, value)]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, values=None):
+        """Text exposition of this process' values or of the merged {name: {labels: value}} values."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(values.get(metric.name, {}) if values is not None else None))
+        return u'\n'.join(lines) + u'\n'
+
+    def dump(self):
+        return dict((metric.name, [[list(key), value] for key, value in metric.snapshot().items()])
+                    for metric in self.metrics)
+
+    def merge(self, dumps):
+        """Add up dump() outputs of several processes."""
+        metrics = dict((metric.name, metric) for metric in self.metrics)
+        values = dict((name, {}) for name in metrics)
+        for dump in dumps:
+            for name, items in dump.items():
+                if name not in metrics:
+                    continue
+                for key, value in items:
+                    key = tuple(key)
+                    values[name][key] = metrics[name].merge_value(values[name].get(key), value)
+        return values
+
+
+class TextfileExporter(object):
+    """Writes the registry as name.prom to METRICS_TEXTFILE_DIR for the node_exporter textfile collector.
+
+    The file is replaced atomically, export is a no-op when the directory
+    isn't set.
+    """
+
+    def __init__(self, name, interval=None, registry=None):
+        self.name = name
+        self.interval = settings.METRICS_EXPORT_INTERVAL if interval is None else interval
+        self.registry = registry or metrics_registry
+        self.exported = 0
+
+    @property
+    def enabled(self):
+        return bool(settings.METRICS_TEXTFILE_DIR)
+
+    def due(self):
+        return self.enabled and time() - self.exported >= self.interval
+
+    def export(self):
+        self.exported = time()
+        directory = settings.METRICS_TEXTFILE_DIR
+        if not directory:
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.{0}_'.format(self.name))
+        try:
+            with os.fdopen(descriptor, 'wb') as output:
+                output.write(self.registry.render().encode('utf-8'))
+            os.chmod(temporary_path, 0o644)
+            os.rename(temporary_path, os.path.join(directory, '{0}.prom'.format(self.name)))
+        except:
+            os.unlink(temporary_path)
+            raise
+
+
+class WorkerExporter(object):
+    """Keeps the values of this web server worker as <pid>-<start time>.json in METRICS_WORKER_DIR.
+
+    Every worker has its own registry, the metrics view adds up the files of
+    all the workers with collect_workers(). The start time tells apart the
+    workers which got the same pid. Without the directory the view shows
+    only the worker which has served the scrape.
+    """
+
+    def __init__(self, interval=None, registry=None):
+        self.interval = settings.METRICS_EXPORT_INTERVAL if interval is None else interval
+        self.registry = registry or metrics_registry
+        self.exported = 0
+        self.pid = None
+        self.started = None
+
+    @property
+    def enabled(self):
+        return bool(settings.METRICS_WORKER_DIR)
+
+    @property
+    def name(self):
+        # The exporter may be created before the web server forks its workers
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.started = int(time() * 1000)
+        return '{0}-{1}.json'.format(self.pid, self.started)
+
+    def due(self):
+        return self.enabled and time() - self.exported >= self.interval
+
+    def export(self):
+        self.exported = time()
+        directory = settings.METRICS_WORKER_DIR
+        if not directory:
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        _write_dump(os.path.join(directory, self.name), self.registry.dump())
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+def _load_dump(path):
+    try:
+        with open(path) as source:
+            return json.load(source)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_dump(path, dump):
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.worker_')
+    try:
+        with os.fdopen(descriptor, 'w') as output:
+            json.dump(dump, output)
+        os.rename(temporary_path, path)
+    except:
+        os.unlink(temporary_path)
+        raise
+
+
+def retire_workers(directory, registry=None):
+    """Add the files of the gone workers to the retired totals and remove them.
+
+    A worker is gone when its pid isn't running or a later worker has got
+    the pid. The files are handled under a lock, so concurrent scrapes don't
+    add a worker twice.
+    """
+    registry = registry or metrics_registry
+    with open(os.path.join(directory, RETIRED_LOCK), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        latest = {}
+        for name in os.listdir(directory):
+            match = WORKER_RE.match(name)
+            if match:
+                pid, started = int(match.group(1)), int(match.group(2))
+                latest[pid] = max(latest.get(pid, started), started)
+        gone = []
+        for name in os.listdir(directory):
+            match = WORKER_RE.match(name)
+            if match:
+                pid, started = int(match.group(1)), int(match.group(2))
+                if started < latest[pid] or not _is_running(pid):
+                    gone.append(name)
+        if not gone:
+            return
+        path = os.path.join(directory, RETIRED_NAME)
+        dumps = [_load_dump(os.path.join(directory, name)) for name in [RETIRED_NAME] + gone]
+        values = registry.merge([dump for dump in dumps if dump])
+        _write_dump(path, dict((name, [[list(key), value] for key, value in items.items()])
+                               for name, items in values.items()))
+        for name in gone:
+            os.unlink(os.path.join(directory, name))
+
+
+def collect_workers(directory, registry=None):
+    """Merged values of the running workers and the retired totals in the directory, see WorkerExporter."""
+    registry = registry or metrics_registry
+    retire_workers(directory, registry)
+    dumps = []
+    for name in os.listdir(directory):
+        if WORKER_RE.match(name) or name == RETIRED_NAME:
+            dump = _load_dump(os.path.join(directory, name))
+            if dump:
+                dumps.append(dump)
+    return registry.merge(dumps)
+
+
+metrics_registry = Registry()
+
+BRAS_POLLS = metrics_registry.register(Counter(
+    'isg_bras_polls_total', 'BRAS session list polls.', ['bras', 'status']))
+BRAS_POLL_SECONDS = metrics_registry.register(Histogram(
+    'isg_bras_poll_seconds', 'BRAS session list poll time.', ['bras']))
+SESSIONS_PARSED = metrics_registry.register(Counter(
+    'isg_sessions_parsed_total', 'Sessions parsed from BRAS session lists.', ['bras']))
+COA_SENT = metrics_registry.register(Counter(
+    'isg_coa_sent_total', 'CoA requests sent, retransmits excluded.'))
+COA_COMPLETED = metrics_registry.register(Counter(
+    'isg_coa_completed_total', 'CoA requests completed.', ['result']))
+COA_SKIPPED = metrics_registry.register(Counter(
+    'isg_coa_skipped_total', 'CoA requests skipped because the user has no session.'))
+COA_LATENCY_SECONDS = metrics_registry.register(Histogram(
+    'isg_coa_latency_seconds', 'CoA request time until the reply or the last timeout.'))
+COA_QUEUE_DEPTH = metrics_registry.register(Gauge(
+    'isg_coa_queue_depth', 'Pending CoA queue entries.'))
+PORTAL_LOOKUPS = metrics_registry.register(Counter(
+    'isg_portal_lookups_total', 'Captive portal lookups by the layer that answered, negative or miss when not found.',
+    ['kind', 'source']))
+PORTAL_LOOKUP_SECONDS = metrics_registry.register(Histogram(
+    'isg_portal_lookup_seconds', 'Captive portal lookup time.', ['kind']))
+LOCAL_CACHE_LOOKUPS = metrics_registry.register(Counter(
+    'isg_local_cache_lookups_total', 'Per-process cache lookups by key family, hit or miss.', ['family', 'result']))
+
+worker_exporter = WorkerExporter()
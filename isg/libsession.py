@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+READ_SIZE = 65536
+NOT_AVAILABLE = '*not available*'
+
+
+def iter_lines(chunks):
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    if tail:
+        yield tail
+
+
+def parse_sessions(lines, bid):
+    session_id = None
+    uid = None
+    ip_address = None
+    for raw_line in lines:
+        try:
+            param, value = raw_line.strip().split(': ')
+        except ValueError:
+            continue
+        if param == 'Session Id':
+            session_id = value
+            uid = None
+            ip_address = None
+        elif param == 'User Name' and value != NOT_AVAILABLE:
+            uid = value
+        elif param == 'IP Address':
+            ip_address = value
+            if not uid:
+                uid = value
+        else:
+            continue
+
+        if uid and session_id and ip_address and ip_address != '0.0.0.0':
+            yield dict(ip=ip_address, uid=uid, bid=bid, sid='{:X}'.format(int(session_id)))
+
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
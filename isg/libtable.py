@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import socket
+import struct
+import tempfile
+
+from time import time
+
+# Session table file layout (little-endian):
+#   header: magic, version, reserved, sessions number, creation time, BRAS address, session generation
+#   sorted IPv4 addresses as uint32, sessions number items
+#   offsets of the records in the data block as uint32, sessions number + 1 items
+#   data block: 'uid\0sid' records
+MAGIC = b'ISGT'
+VERSION = 2
+HEADER = struct.Struct('<4sHHId16s16s')
+ITEM = struct.Struct('<I')
+TABLE_TEMPLATE = 'bras_{0}.table'
+TABLE_SUFFIX = '.table'
+
+
+def ip_to_int(ip):
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, UnicodeError, TypeError):
+        return None
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def write_session_table(directory, bid, sessions, address='', generation=''):
+    """Publish {ip: (uid, sid)} as the BRAS session table, the file is swapped atomically."""
+    items = sorted([(ip_to_int(ip), uid, sid) for ip, (uid, sid) in sessions.items() if ip_to_int(ip) is not None])
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.bras_{0}_'.format(bid))
+    try:
+        with os.fdopen(descriptor, 'wb') as table:
+            table.write(HEADER.pack(MAGIC, VERSION, 0, len(items), time(), _to_bytes(address),
+                                    _to_bytes(generation)))
+            for ip, uid, sid in items:
+                table.write(ITEM.pack(ip))
+            offset = 0
+            records = []
+            for ip, uid, sid in items:
+                record = _to_bytes(uid) + b'\x00' + _to_bytes(sid)
+                table.write(ITEM.pack(offset))
+                offset += len(record)
+                records.append(record)
+            table.write(ITEM.pack(offset))
+            table.write(b''.join(records))
+        os.chmod(temporary_path, 0o644)
+        os.rename(temporary_path, os.path.join(directory, TABLE_TEMPLATE.format(bid)))
+    except:
+        os.unlink(temporary_path)
+        raise
+
+
+def remove_session_table(directory, bid):
+    try:
+        os.unlink(os.path.join(directory, TABLE_TEMPLATE.format(bid)))
+    except OSError:
+        pass
+
+
+class SessionTable(object):
+    def __init__(self, path):
+        with open(path, 'rb') as table:
+            self.stat = os.fstat(table.fileno())
+            self.map = mmap.mmap(table.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = HEADER.unpack_from(self.map, 0)[:2]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(u'{0} is not a session table'.format(path))
+        reserved, self.count, self.created, address, generation = HEADER.unpack_from(self.map, 0)[2:]
+        self.address = address.rstrip(b'\x00').decode('utf-8')
+        self.generation = generation.rstrip(b'\x00').decode('utf-8')
+        self.offsets = HEADER.size + self.count * ITEM.size
+        self.data = self.offsets + (self.count + 1) * ITEM.size
+
+    def record(self, index):
+        start, end = struct.unpack_from('<II', self.map, self.offsets + index * ITEM.size)
+        return self.map[self.data + start:self.data + end].split(b'\x00', 1)
+
+    def lookup(self, ip, generation=None):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            value = ITEM.unpack_from(self.map, HEADER.size + middle * ITEM.size)[0]
+            if value < ip:
+                low = middle + 1
+            elif value > ip:
+                high = middle
+            else:
+                return self.record(middle)
+        return None
+
+
+class SessionTables(object):
+    """Session tables of all BRASs mapped into the process memory.
+
+    The directory is checked at most every check_interval seconds, swapped
+    files are mapped again. Lookups don't take locks: they use whatever table
+    set was current when they started and the replaced maps are closed when
+    the last reference is gone. Tables older than max_age are ignored, and
+    so are the tables of a generation other than the current one of their
+    BRAS, if lookup() is given the generation(address) function: a removed
+    file is only noticed at the next check, an invalidated BRAS at once.
+    """
+
+    def __init__(self, directory, check_interval=1, max_age=None):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.tables = {}
+        self.checked = 0
+
+    def refresh(self):
+        tables = {}
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith(TABLE_SUFFIX)]
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            current = self.tables.get(name)
+            try:
+                stat = os.stat(path)
+                if current is None or (stat.st_ino, stat.st_mtime) != (current.stat.st_ino, current.stat.st_mtime):
+                    current = SessionTable(path)
+            except (OSError, IOError, ValueError):
+                continue
+            tables[name] = current
+        self.tables = tables
+        self.checked = time()
+
+    def lookup(self, ip, generation=None):
+        if time() - self.checked >= self.check_interval:
+            self.refresh()
+        ip = ip_to_int(ip)
+        if ip is None:
+            return None
+        oldest = time() - self.max_age if self.max_age else 0
+        for table in list(self.tables.values()):
+            if table.created < oldest:
+                continue
+            if generation is not None and table.generation and generation(table.address) != table.generation:
+                continue
+            record = table.lookup(ip)
+            if record:
+                return record
+        return None
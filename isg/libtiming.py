@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from isgtool.contrib import log
+from random import random
+from time import time
+
+# Stages of the captive portal request path, 'other' is the time not covered by any stage
+STAGES = ('notification', 'get_uid', 'record_cache', 'record_db', 'complete', 'render', 'other', 'total')
+# Upper bounds of the timing buckets: 50 us to 30 s, 1.5 times wider each
+BUCKETS = tuple([0.00005 * 1.5 ** index for index in range(34)]) + (float('inf'),)
+STAGE_TIMING_TEMPLATE = 'stage_timing_{window}_{stage}_{bucket}'
+PERCENTILES = (50, 90, 99)
+
+_local = threading.local()
+
+
+class RequestTiming(object):
+    __slots__ = ('path', 'started', 'stages', 'sampled', 'total')
+
+    def __init__(self, path, sampled):
+        self.path = path
+        self.sampled = sampled
+        self.started = time()
+        self.stages = {}
+        self.total = None
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def finish(self):
+        self.total = time() - self.started
+        self.stages['other'] = max(0, self.total - sum(self.stages.values()))
+
+    def describe(self):
+        return u', '.join([u'{0} {1:.1f} ms'.format(name, self.stages[name] * 1000)
+                           for name in STAGES if name in self.stages])
+
+
+def start_timing(path):
+    _local.timing = RequestTiming(path, random() < settings.TIMING_SAMPLE_RATE)
+    return _local.timing
+
+
+def current_timing():
+    return getattr(_local, 'timing', None)
+
+
+def finish_timing():
+    timing = getattr(_local, 'timing', None)
+    _local.timing = None
+    if timing is not None:
+        timing.finish()
+    return timing
+
+
+@contextmanager
+def stage(name):
+    """Add the block run time to the named stage of the current request, a no-op outside requests."""
+    timing = getattr(_local, 'timing', None)
+    if timing is None:
+        yield
+        return
+    started = time()
+    try:
+        yield
+    finally:
+        timing.add(name, time() - started)
+
+
+def percentile(counts, value):
+    total = sum(counts)
+    if not total:
+        return None
+    rank = total * value / 100.0
+    passed = 0
+    for bucket, count in zip(BUCKETS, counts):
+        passed += count
+        if passed >= rank:
+            return bucket
+    return BUCKETS[-1]
+
+
+def format_percentiles(counts):
+    values = [percentile(counts, value) for value in PERCENTILES]
+    return u'n={0} '.format(sum(counts)) + u' '.join(
+        [u'p{0}={1:.1f}ms'.format(name, value * 1000) for name, value in zip(PERCENTILES, values)])
+
+
+class StageStats(object):
+    """Per-process bucket counts of the sampled request stages.
+
+    Every TIMING_FLUSH_INTERVAL seconds the counts are logged as percentiles
+    and added to the shared per-window counters in the cache, which
+    stage_counts() reads back for all processes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.flushed = time()
+
+    def record(self, timing):
+        with self.lock:
+            for name, seconds in list(timing.stages.items()) + [('total', timing.total)]:
+                counts = self.counts.get(name)
+                if counts is None:
+                    counts = self.counts[name] = [0] * len(BUCKETS)
+                counts[bisect_left(BUCKETS, seconds)] += 1
+            due = time() - self.flushed >= settings.TIMING_FLUSH_INTERVAL
+            if due:
+                counts, self.counts, self.flushed = self.counts, {}, time()
+        if due:
+            self.flush(counts)
+
+    def flush(self, counts):
+        logger = log(self)
+        for name in STAGES:
+            if name in counts:
+                logger.info(u'Request stage {0}: {1}'.format(name, format_percentiles(counts[name])))
+        window = int(time() // settings.TIMING_WINDOW)
+        timeout = settings.TIMING_WINDOW * settings.TIMING_WINDOWS
+        try:
+            for name in counts:
+                if name not in STAGES:
+                    continue
+                for bucket, count in enumerate(counts[name]):
+                    if count:
+                        key = STAGE_TIMING_TEMPLATE.format(window=window, stage=name, bucket=bucket)
+                        if not cache.add(key, count, timeout):
+                            cache.incr(key, count)
+        except Exception as ex:
+            logger.error(u'Stage timings flush failed: {0}'.format(ex))
+
+
+stage_stats = StageStats()
+
+
+def stage_counts(windows=5):
+    """{stage: bucket counts} of all processes for the last windows timing windows."""
+    current = int(time() // settings.TIMING_WINDOW)
+    keys = [STAGE_TIMING_TEMPLATE.format(window=window, stage=name, bucket=bucket)
+            for window in range(current - windows + 1, current + 1)
+            for name in STAGES for bucket in range(len(BUCKETS))]
+    values = cache.get_many(keys)
+    result = {}
+    for window in range(current - windows + 1, current + 1):
+        for name in STAGES:
+            for bucket in range(len(BUCKETS)):
+                count = values.get(STAGE_TIMING_TEMPLATE.format(window=window, stage=name, bucket=bucket))
+                if count:
+                    result.setdefault(name, [0] * len(BUCKETS))[bucket] += int(count)
+    return result
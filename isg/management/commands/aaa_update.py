@@ -1,17 +1,91 @@
 # -*- coding: utf-8 -*-
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from isg.libconnection import close_connections
+from isg.libmetrics import BRAS_POLL_SECONDS, BRAS_POLLS, SESSIONS_PARSED, TextfileExporter
 from isg.models import Bras
 from isgtool.contrib import log
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+
+SUMMARY_ROW = u'{name:<30} {sessions:>10} {added:>8} {changed:>8} {removed:>8} {elapsed:>10} {status}'
 
 
 class Command(BaseCommand):
     help = 'Update AAA sessions info'
 
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workers', type=int, dest='workers', default=settings.AAA_UPDATE_WORKERS,
+                            metavar='WORKERS', help='Number of BRASs polled concurrently')
+        parser.add_argument('-d', '--deadline', type=int, dest='deadline', default=settings.AAA_UPDATE_DEADLINE,
+                            metavar='SECONDS', help='Per-BRAS poll deadline, 0 - no deadline')
+        parser.add_argument('-i', '--interval', type=int, dest='interval', default=0, metavar='SECONDS',
+                            help='Keep running and start update cycle every SECONDS, BRAS sessions are kept open')
+
+    def poll(self, bras):
+        logger = log(self)
+        logger.info(u'Run session list update procedure from bras \'{0}\''.format(bras.name))
+        started = time()
+        deadline = started + self.deadline if self.deadline > 0 else None
+        try:
+            update = bras.aaa_list_update(deadline, self.timeout)
+        except Exception as ex:
+            logger.error(u'Session list update from bras \'{0}\' failed: {1}'.format(bras.name, ex))
+            BRAS_POLLS.inc(bras=bras.name, status='failed')
+            BRAS_POLL_SECONDS.observe(time() - started, bras=bras.name)
+            return bras, None, time() - started, u'FAILED: {0}'.format(ex)
+        BRAS_POLLS.inc(bras=bras.name, status='ok')
+        BRAS_POLL_SECONDS.observe(time() - started, bras=bras.name)
+        SESSIONS_PARSED.inc(update.sessions, bras=bras.name)
+        return bras, update, time() - started, u'OK'
+
+    def cycle(self, workers):
+        started = time()
+        bras_list = list(Bras.objects.filter(is_active=True))
+        pool = ThreadPool(max(1, min(workers, len(bras_list))))
+        try:
+            results = list(pool.imap_unordered(self.poll, bras_list))
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time() - started
+
+        self.stdout.write(SUMMARY_ROW.format(name=u'BRAS', sessions=u'Sessions', added=u'Added', changed=u'Changed',
+                                             removed=u'Removed', elapsed=u'Time, s', status=u'Status'))
+        for bras, update, bras_elapsed, status in sorted(results, key=lambda result: -result[2]):
+            if update is None:
+                counters = dict(sessions='-', added='-', changed='-', removed='-')
+            else:
+                counters = dict(sessions=update.sessions, added=update.added, changed=update.changed,
+                                removed=update.removed)
+            self.stdout.write(SUMMARY_ROW.format(name=bras.name, elapsed='{0:.2f}'.format(bras_elapsed),
+                                                 status=status, **counters))
+        updates = [result[1] for result in results if result[1] is not None]
+        self.stdout.write(u'Polled {0} BRAS(s), {1} failed, {2} sessions, {3} keys written, {4} sessions removed, '
+                          u'cycle time {5:.2f} s'.format(len(results), len(results) - len(updates),
+                                                         sum([update.sessions for update in updates]),
+                                                         sum([update.written for update in updates]),
+                                                         sum([update.removed for update in updates]), elapsed))
+        return elapsed
+
     def handle(self, *args, **options):
         logger = log(self)
         logger.info('Run session cache update job.')
-        for bras in Bras.objects.filter(is_active=True):
-            logger.info(u'Run session list update procedure from bras \'{0}\''.format(bras.name))
-            bras.aaa_list_update()
+        self.deadline = options['deadline']
+        # A one-shot run has no previous poll to drop the ended sessions by, they have to expire soon
+        self.timeout = None if options['interval'] > 0 else settings.SESSION_ONESHOT_CACHE_TIMEOUT
+        exporter = TextfileExporter('aaa_update')
+        try:
+            while True:
+                elapsed = self.cycle(options['workers'])
+                exporter.export()
+                logger.info(u'Sessions update cycle complete in {0:.2f} s.'.format(elapsed))
+                if options['interval'] <= 0:
+                    break
+                close_old_connections()
+                sleep(max(0, options['interval'] - elapsed))
+        finally:
+            close_connections()
         logger.info(u'Sessions update job complete.')
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import struct
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from isg.libsession import NOT_AVAILABLE
+from isg.models import Bras
+from isg.testing import FakeBras, FakeSessionTable
+from isgtool.contrib import log
+from time import sleep
+
+STATS_ROW = u'{bras:>6} {connections:>12} {logins:>8} {polls:>8} {coa:>10}'
+
+
+def addresses(first, count):
+    """count consecutive IPv4 addresses starting from first."""
+    start = struct.unpack('!I', socket.inet_aton(first))[0]
+    return [socket.inet_ntoa(struct.pack('!I', start + n)) for n in range(count)]
+
+
+class Command(BaseCommand):
+    help = 'Run local fake BRASs answering the telnet session list and CoA for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--count', type=int, dest='count', default=1, metavar='NUMBER',
+                            help='Number of BRASs, each on its own address')
+        parser.add_argument('-a', '--address', dest='address', default='127.1.0.1', metavar='ADDRESS',
+                            help='Address of the first BRAS, the others follow it (any 127.x.x.x on Linux)')
+        parser.add_argument('-p', '--port', type=int, dest='port', default=settings.BRAS_TELNET_PORT,
+                            metavar='PORT', help='Telnet port, BRAS_TELNET_PORT by default')
+        parser.add_argument('-c', '--coa-port', type=int, dest='coa_port', default=1700, metavar='PORT',
+                            help='CoA port')
+        parser.add_argument('-s', '--sessions', type=int, dest='sessions', default=10000, metavar='NUMBER',
+                            help='Sessions of every BRAS')
+        parser.add_argument('--churn', type=float, dest='churn', default=0.05, metavar='FRACTION',
+                            help='Part of the subscribers getting a new session before every session list')
+        parser.add_argument('--latency', type=float, dest='latency', default=0, metavar='SECONDS',
+                            help='Delay of every command output')
+        parser.add_argument('--username', dest='username', default='isgtool', help='TACACS+ username')
+        parser.add_argument('--password', dest='password', default='isgtool', help='TACACS+ password')
+        parser.add_argument('--prompt', dest='prompt', default='BRAS#', help='Command prompt')
+        parser.add_argument('--secret', dest='secret', default='secret', help='CoA secret')
+        parser.add_argument('--coa-reply', dest='coa_reply', default='ack', choices=('ack', 'nak', 'drop'),
+                            help='CoA reply')
+        parser.add_argument('--register', dest='register', action='store_true',
+                            help='Add the BRASs to the database while running, they are deactivated on exit')
+        parser.add_argument('--uids', dest='uids', metavar='FILE',
+                            help='Write the subscriber user names to the file, e.g. for add_records')
+        parser.add_argument('-i', '--interval', type=int, dest='interval', default=10, metavar='SECONDS',
+                            help='Statistics output interval')
+
+    def register(self, brases, options):
+        for n, bras in enumerate(brases):
+            Bras.objects.update_or_create(ip_address=bras.host, defaults=dict(
+                name=u'Simulator {0}'.format(n + 1), username=options['username'], password=options['password'],
+                timeout=10, command_prompt=options['prompt'], coa_secret=options['secret'],
+                coa_port=options['coa_port'], method='tln', is_active=True))
+
+    def unregister(self, brases):
+        for instance in Bras.objects.filter(ip_address__in=[bras.host for bras in brases]):
+            instance.is_active = False
+            instance.save()
+
+    def write_uids(self, path, brases):
+        with open(path, 'w') as output:
+            for bras in brases:
+                for sid, uid, ip in bras.table.sessions:
+                    output.write('{0}\n'.format(ip if uid == NOT_AVAILABLE else uid))
+
+    def write_stats(self, brases):
+        self.stdout.write(STATS_ROW.format(bras=u'BRASs', connections=u'Connections', logins=u'Logins',
+                                           polls=u'Polls', coa=u'CoA'))
+        self.stdout.write(STATS_ROW.format(bras=len(brases),
+                                           connections=sum([bras.connections for bras in brases]),
+                                           logins=sum([bras.logins for bras in brases]),
+                                           polls=sum([bras.polls for bras in brases]),
+                                           coa=sum([bras.coa.received for bras in brases])))
+
+    def handle(self, *args, **options):
+        logger = log(self)
+        if options['count'] < 1:
+            raise CommandError(u'At least one BRAS is needed')
+        if options['count'] * options['sessions'] >= 1 << 24:
+            raise CommandError(u'At most {0} sessions of all BRASs fit the subscriber network'.format(1 << 24))
+        brases = []
+        try:
+            for n, address in enumerate(addresses(options['address'], options['count'])):
+                table = FakeSessionTable(options['sessions'], seed=n, first=n * options['sessions'])
+                try:
+                    bras = FakeBras(table, address, options['port'], options['username'], options['password'],
+                                    options['prompt'], options['churn'], options['latency'], options['secret'],
+                                    options['coa_port'], options['coa_reply'])
+                except socket.error as ex:
+                    raise CommandError(u'Can\'t listen on {0}: {1}'.format(address, ex))
+                bras.start()
+                brases.append(bras)
+            logger.info(u'Started {0} BRAS(s) on {1}-{2}, telnet port {3}, CoA port {4}'.format(
+                len(brases), brases[0].host, brases[-1].host, options['port'], options['coa_port']))
+            if options['uids']:
+                self.write_uids(options['uids'], brases)
+            if options['register']:
+                self.register(brases, options)
+            try:
+                while True:
+                    sleep(options['interval'])
+                    self.write_stats(brases)
+            except KeyboardInterrupt:
+                pass
+        finally:
+            if options['register']:
+                self.unregister(brases)
+            for bras in brases:
+                bras.stop()
+            logger.info(u'Stopped {0} BRAS(s)'.format(len(brases)))
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import platform
+import random
+import resource
+
+from datetime import datetime
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.template.response import TemplateResponse
+from django.test import RequestFactory, override_settings
+from isg.libcache import CacheWriter, SessionCacheUpdate, _snapshots, cache_session_data, get_uid, local_cache
+from isg.libcoa import CoaClient, CoaDispatcher, parse_message
+from isg.libsession import iter_chunks, iter_lines, parse_sessions
+from isg.models import Bras, CachedBras, CoaCommand
+from isg.testing import FakeCoaServer, FakeSessionTable
+from json import dump, dumps
+from time import time
+from www.libpage import clear_pages, render_page
+from www.models import CachedNotification, CachedRecord, UserNotification, UserNotificationRecord
+from www.views import AnswerView, NotificationView
+
+VALUES_ROW = u'{name:<14} {form:<8} {size:>8} {pickle:>12} {decode:>12} {get:>12}'
+PAGES_ROW = u'{name:<30} {full:>14} {prerendered:>14} {speedup:>8}'
+STAGES_ROW = u'{stage:<16} {size:>8} {count:>9} {rate:>12} {p50:>9} {p90:>9} {p99:>9} {max:>9} {peak:>9} {growth:>9}'
+PERCENTILES = (50, 90, 99, 100)
+
+BENCH_BRAS = '127.0.0.1'
+BENCH_SECRET = 'isgbench'
+BENCH_MESSAGE = u'''User-Name = "{user_id}"
+Cisco-Account-Info = "S{aaa_session_id}"
+Cisco-AVPair = "subscriber:command=account-logon", Cisco-Command-Code = "\\013PBHK"'''
+CACHE_BACKENDS = {
+    'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'isgbench',
+               'OPTIONS': {'MAX_ENTRIES': 10000000}},
+    'memcached': {'BACKEND': 'isg.libmemcached.ConsistentMemcachedCache', 'KEY_PREFIX': 'isgbench'},
+}
+
+
+def measure(function, iterations):
+    """Average run time of the function in microseconds."""
+    started = time()
+    for n in range(iterations):
+        function()
+    return (time() - started) / iterations * 1000000
+
+
+def peak_memory():
+    """Peak resident set size of the process in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def percentiles(latencies):
+    """{percentile: seconds} of the latencies, the 100th is the maximum."""
+    latencies = sorted(latencies)
+    if not latencies:
+        return dict((value, None) for value in PERCENTILES)
+    return dict((value, latencies[min(len(latencies) - 1, int(len(latencies) * value / 100.0))])
+                for value in PERCENTILES)
+
+
+class StageRun(object):
+    """Run time, per-operation latencies and peak memory of one benchmark stage.
+
+    The peak is the process high-water mark at the end of the stage, growth is
+    how much the stage raised it.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.count = 0
+        self.latencies = []
+        self.seconds = None
+
+    def __enter__(self):
+        self.memory = peak_memory()
+        self.started = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time() - self.started
+
+    def timed(self, iterable):
+        """Yield the items recording the time the consumer spends on each of them."""
+        for item in iterable:
+            started = time()
+            yield item
+            self.latencies.append(time() - started)
+
+    def result(self):
+        peak = peak_memory()
+        values = percentiles(self.latencies)
+        return dict(benchmark='stages', stage=self.name, size=self.size, count=self.count, seconds=self.seconds,
+                    throughput=self.count / self.seconds if self.seconds else None,
+                    latency=dict(('p{0}'.format(value) if value < 100 else 'max', values[value])
+                                 for value in PERCENTILES),
+                    operations=len(self.latencies), peak_memory=peak, memory_growth=peak - self.memory)
+
+
+def format_ms(seconds):
+    return u'-' if seconds is None else u'{0:.2f}'.format(seconds * 1000)
+
+
+class Command(BaseCommand):
+    help = 'Run ISG Tool benchmarks'
+    benchmarks = ('values', 'pages', 'sessions', 'coa', 'portal')
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', nargs='*', metavar='BENCHMARK',
+                            help='Benchmarks to run: {0}, all by default'.format(', '.join(self.benchmarks)))
+        parser.add_argument('-n', '--iterations', type=int, dest='iterations', default=10000, metavar='NUMBER',
+                            help='Iterations of every measured operation')
+        parser.add_argument('-s', '--sessions', dest='sessions', default='10000,100000,500000', metavar='SIZES',
+                            help='Comma separated sizes of the synthetic BRAS session tables')
+        parser.add_argument('-r', '--requests', type=int, dest='requests', default=10000, metavar='NUMBER',
+                            help='CoA requests and captive portal requests to run')
+        parser.add_argument('-c', '--cache', dest='cache', default='locmem', choices=sorted(CACHE_BACKENDS),
+                            help='Cache of the session, CoA and portal benchmarks: in-process memory or memcached')
+        parser.add_argument('--memcached', dest='memcached', default='127.0.0.1:11211', metavar='SERVERS',
+                            help='memcached servers of --cache memcached separated by ";", the keys get the '
+                                 'isgbench prefix')
+        parser.add_argument('-j', '--json', dest='json', metavar='FILE',
+                            help='Save the results as JSON to compare them between releases, - for stdout')
+
+    def sample_values(self):
+        bras = Bras(id=1, name=u'BRAS 1', ip_address=u'10.255.0.1', username=u'isgtool', password=u'password',
+                    timeout=5, command_prompt=u'BRAS#', coa_secret=u'secret', coa_port=1700)
+        notification = UserNotification(id=1, name=u'Poll', template=u'max', coa_id=1, successful_coa_id=2,
+                                         is_active=True)
+        answer = dumps(dict(('question{0}'.format(n), u'answer {0}'.format(n) * 4) for n in range(10)))
+        record = UserNotificationRecord(id=123456, uid=u'sibttk-user-123456', notification_id=1,
+                                        json_result=answer, is_completed=True, is_active=True)
+        return [(u'Bras', bras, CachedBras), (u'Notification', notification, CachedNotification),
+                (u'Record', record, CachedRecord)]
+
+    def run_values(self, options):
+        """Cached value size and lookup time of pickled model instances and compact values."""
+        iterations = options['iterations']
+        self.stdout.write(VALUES_ROW.format(name=u'Value', form=u'Form', size=u'Bytes', pickle=u'Pickle, us',
+                                            decode=u'Decode, us', get=u'Get, us'))
+        for name, instance, compact in self.sample_values():
+            packed = compact.from_instance(instance).pack()
+            forms = [(u'model', instance, lambda data: pickle.loads(data), lambda key: cache.get(key)),
+                     (u'compact', packed, lambda data: compact.unpack(pickle.loads(data)),
+                      lambda key: compact.unpack(cache.get(key)))]
+            for form, value, decode, get in forms:
+                data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                key = u'isgbench_{0}_{1}'.format(name, form)
+                cache.set(key, value, 60)
+                get_time = None
+                if get(key) is not None:
+                    get_time = measure(lambda: get(key), iterations)
+                pickle_time = measure(lambda: pickle.dumps(value, pickle.HIGHEST_PROTOCOL), iterations)
+                decode_time = measure(lambda: decode(data), iterations)
+                self.stdout.write(VALUES_ROW.format(
+                    name=name, form=form, size=len(data), pickle='{0:.2f}'.format(pickle_time),
+                    decode='{0:.2f}'.format(decode_time),
+                    get='{0:.2f}'.format(get_time) if get_time is not None else u'no cache'))
+                self.results.append(dict(benchmark='values', name=name, form=form, size=len(data),
+                                         pickle_us=pickle_time, decode_us=decode_time, get_us=get_time))
+                cache.delete(key)
+
+    def page_templates(self):
+        names = []
+        for directory in settings.TEMPLATES[0]['DIRS']:
+            for name in sorted(os.listdir(directory)):
+                for page in 'notification.html', 'answer.html':
+                    if os.path.exists(os.path.join(directory, name, page)):
+                        names.append(u'{0}/{1}'.format(name, page))
+        return names
+
+    def run_pages(self, options):
+        """Pages per second of the template engine with the context processors and of the pre-rendered pages."""
+        iterations = options['iterations']
+        request = RequestFactory().get('/sttk-notification/')
+        request.user = AnonymousUser()
+        notification = CachedNotification(0, u'Benchmark', None, None, None)
+        self.stdout.write(PAGES_ROW.format(name=u'Template', full=u'Full, pages/s', prerendered=u'Pre, pages/s',
+                                           speedup=u'Speedup'))
+        for template_name in self.page_templates():
+            names = ('rid', 'answer_url') if template_name.endswith('notification.html') else ()
+            context = dict(rid=123456, answer_url=u'/sttk-notification-answer/', code=u'1', pppoe=u'')
+            full = measure(lambda: TemplateResponse(request, template_name, context).render(), iterations)
+            prerendered = measure(lambda: render_page(notification, template_name, names, context), iterations)
+            if render_page(notification, template_name, names, context) is None:
+                prerendered = None
+            self.stdout.write(PAGES_ROW.format(
+                name=template_name, full='{0:.0f}'.format(1000000 / full),
+                prerendered='{0:.0f}'.format(1000000 / prerendered) if prerendered else u'-',
+                speedup='{0:.1f}x'.format(full / prerendered) if prerendered else u'-'))
+            self.results.append(dict(benchmark='pages', template=template_name, full_us=full,
+                                     prerendered_us=prerendered))
+
+    def report(self, stage):
+        result = stage.result()
+        self.stdout.write(STAGES_ROW.format(
+            stage=result['stage'], size=result['size'], count=result['count'],
+            rate=u'{0:.0f}'.format(result['throughput']) if result['throughput'] else u'-',
+            p50=format_ms(result['latency']['p50']), p90=format_ms(result['latency']['p90']),
+            p99=format_ms(result['latency']['p99']), max=format_ms(result['latency']['max']),
+            peak=u'{0:.0f}'.format(result['peak_memory']), growth=u'{0:.0f}'.format(result['memory_growth'])))
+        self.results.append(result)
+
+    def report_header(self):
+        if not self.header:
+            self.stdout.write(STAGES_ROW.format(stage=u'Stage', size=u'Size', count=u'Count', rate=u'Items/s',
+                                                p50=u'p50, ms', p90=u'p90, ms', p99=u'p99, ms', max=u'max, ms',
+                                                peak=u'Peak, MB', growth=u'Grow, MB'))
+            self.header = True
+
+    def poll(self, table, name, size):
+        """Parse the table dump and cache the sessions as one BRAS poll, return the parse and cache stages."""
+        chunks = list(table.dump())
+        with StageRun(u'parse' + name, size) as parse:
+            sessions = list(parse_sessions(iter_lines(parse.timed(chunks)), BENCH_BRAS))
+            parse.count = len(sessions)
+        del chunks
+        update = SessionCacheUpdate(BENCH_BRAS)
+        with StageRun(u'cache' + name, size) as cached:
+            for chunk in cached.timed(iter_chunks(sessions, settings.SESSION_CHUNK_SIZE)):
+                update.update(chunk)
+            update.finish()
+            cached.count = len(sessions)
+        return parse, cached
+
+    def run_sessions(self, options):
+        """BRAS session list parsing and caching, a full poll followed by a poll with 10% of the sessions changed."""
+        self.report_header()
+        for size in self.sizes:
+            table = FakeSessionTable(size)
+            _snapshots.pop(BENCH_BRAS, None)
+            for stage in self.poll(table, u'', size):
+                self.report(stage)
+            table.churn(0.1)
+            for stage in self.poll(table, u'_delta', size):
+                self.report(stage)
+            _snapshots.pop(BENCH_BRAS, None)
+            del table
+
+    def run_coa(self, options):
+        """CoA requests to a local responder, pipelined by the dispatcher and one by one by CoaCommand.run."""
+        self.report_header()
+        count = options['requests']
+        table = FakeSessionTable(count, network=172)
+        cache_session_data([dict(ip=ip, uid=uid, bid=BENCH_BRAS, sid='{:X}'.format(sid))
+                            for sid, uid, ip in table.sessions])
+        with FakeCoaServer(BENCH_SECRET) as server, transaction.atomic():
+            pairs = parse_message(BENCH_MESSAGE.format(user_id='user', aaa_session_id='1'))
+            client = CoaClient(settings.COA_TIMEOUT, settings.COA_RETRIES)
+            latencies = []
+            dispatcher = CoaDispatcher(client, settings.COA_WINDOW, 0)
+            with StageRun(u'coa_dispatch', count) as dispatch:
+                for n in range(count):
+                    dispatcher.submit(server.host, server.port, BENCH_SECRET, pairs,
+                                      lambda request, context: latencies.append(time() - request.started))
+                dispatcher.join()
+                dispatch.count = dispatcher.succeeded
+                dispatch.latencies = latencies
+            client.close()
+            self.report(dispatch)
+
+            Bras.objects.update_or_create(ip_address=BENCH_BRAS, defaults=dict(
+                name=u'isgbench', username=u'isgbench', password=u'isgbench', timeout=5, command_prompt=u'#',
+                coa_secret=BENCH_SECRET, coa_port=server.port))
+            command = CoaCommand.objects.create(name=u'isgbench', message=BENCH_MESSAGE)
+            local_cache.clear('bras')
+            with StageRun(u'coa_run', count) as run:
+                for sid, uid, ip in run.timed(table.sessions):
+                    if command.run(uid, 'debug') is not None:
+                        run.count += 1
+            self.report(run)
+            transaction.set_rollback(True)
+        local_cache.clear('bras')
+
+    def run_portal(self, options):
+        """Captive portal lookups: get_uid, then the notification and the answer page of every subscriber."""
+        self.report_header()
+        count = options['requests']
+        table = FakeSessionTable(count, network=192)
+        factory = RequestFactory()
+        with transaction.atomic():
+            coa = CoaCommand.objects.create(name=u'isgbench', message=BENCH_MESSAGE)
+            UserNotification.objects.filter(is_active=True).update(is_active=False)
+            notification = UserNotification.objects.create(name=u'isgbench', template=u'max', coa=coa,
+                                                           successful_coa=coa, is_active=True)
+            sessions = [dict(ip=ip, uid=uid if uid.startswith('user') else ip, bid=BENCH_BRAS,
+                             sid='{:X}'.format(sid)) for sid, uid, ip in table.sessions]
+            writer = CacheWriter()
+            cache_session_data(sessions, writer=writer)
+            for chunk in iter_chunks([session['uid'] for session in sessions], settings.RECORD_IMPORT_CHUNK_SIZE):
+                UserNotificationRecord.objects.bulk_import(notification, chunk, writer)
+            writer.close()
+            UserNotificationRecord.objects.filter(notification=notification).update(is_active=True)
+            local_cache.clear()
+            clear_pages()
+            random.Random(0).shuffle(sessions)
+
+            with StageRun(u'portal_get_uid', count) as lookup:
+                for session in lookup.timed(sessions):
+                    if get_uid(session['ip']):
+                        lookup.count += 1
+            self.report(lookup)
+
+            notification_view = NotificationView.as_view()
+            with StageRun(u'portal_notify', count) as notify:
+                for session in notify.timed(sessions):
+                    request = factory.get('/sttk-notification/', REMOTE_ADDR=session['ip'])
+                    request.user = AnonymousUser()
+                    response = notification_view(request)
+                    if hasattr(response, 'render'):
+                        response.render()
+                    notify.count += 1
+            self.report(notify)
+
+            records = [record.id for record in UserNotificationRecord.objects.filter(notification=notification)]
+            answer_view = AnswerView.as_view()
+            with StageRun(u'portal_answer', count) as answer:
+                for record_id in answer.timed(records):
+                    request = factory.get('/sttk-notification-answer/', dict(rid=record_id, code='1'))
+                    request.user = AnonymousUser()
+                    response = answer_view(request)
+                    if hasattr(response, 'render'):
+                        response.render()
+                    answer.count += 1
+            self.report(answer)
+            transaction.set_rollback(True)
+        local_cache.clear()
+        clear_pages()
+
+    def write_results(self, path, options):
+        data = dict(started=self.started, python=platform.python_version(), platform=platform.platform(),
+                    host=platform.node(), cache=options['cache'], sessions=self.sizes, requests=options['requests'],
+                    iterations=options['iterations'], results=self.results)
+        if path == '-':
+            dump(data, self.stdout, indent=2, sort_keys=True)
+            self.stdout.write(u'')
+        else:
+            with open(path, 'w') as output:
+                dump(data, output, indent=2, sort_keys=True)
+
+    def handle(self, *args, **options):
+        benchmarks = options['benchmark'] or self.benchmarks
+        for benchmark in benchmarks:
+            if benchmark not in self.benchmarks:
+                raise CommandError(u'Unknown benchmark {0}, choose from {1}'.format(benchmark,
+                                                                                   u', '.join(self.benchmarks)))
+        try:
+            self.sizes = [int(size) for size in options['sessions'].split(',')]
+        except ValueError:
+            raise CommandError(u'Invalid session table sizes {0}'.format(options['sessions']))
+        caches = {'default': dict(CACHE_BACKENDS[options['cache']], LOCATION=options['memcached'])
+                  if options['cache'] == 'memcached' else CACHE_BACKENDS[options['cache']]}
+        self.started = datetime.now().isoformat()
+        self.results = []
+        self.header = False
+        for benchmark in benchmarks:
+            if benchmark in ('values', 'pages'):
+                getattr(self, 'run_{0}'.format(benchmark))(options)
+                continue
+            with override_settings(CACHES=caches, SESSION_TABLE_DIR=None, COMPLETION_BUFFER=None):
+                getattr(self, 'run_{0}'.format(benchmark))(options)
+        if options['json']:
+            self.write_results(options['json'], options)
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import curses, traceback, sys
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from isg.libcache import cache_stats, coa_counter, get_bras_last_update
+from isg.libcache import cache_node_stats, cache_stats, coa_counter, get_bras_last_update
+from isg.libtiming import PERCENTILES, STAGES, format_percentiles, percentile, stage_counts
 from isg.models import Bras, CoaQueue
 from os import getloadavg
 from time import time, sleep
@@ -23,16 +25,34 @@ SCREEN_TEMPLATE = '''
 {bras}
 
   Total items cached: {mi}
+{nodes}
 
   Cache set commands: {ms:<15} {msps:.2f} cmd/sec
   Cache get commands: {mg:<15} {mgps:.2f} cmd/sec
 
   Active notifications are completed: {nc} ({ncp:.2f}%)
 
+                 REQUEST STAGES (LAST {sw} MIN)
+ -------------------------------------------------------
+{stages}
+
   Press key: Q - quit.
 '''
 
 REFRESH_DELAY = 2.00
+STAGE_WINDOWS = 5
+# Per-server memcached figures of the data source output
+NODE_FIGURES = ('curr_items', 'bytes', 'limit_maxbytes', 'curr_connections', 'cmd_get', 'cmd_set', 'get_hits',
+                'get_misses', 'evictions')
+NODE_ROW = u' {name:<21} {items:>10} items {connections:>6} conn {hits:>6.1f}% hits {memory:>6.1f}% memory\n'
+
+
+def node_key(name):
+    return 'memcached_' + ''.join([c if c.isalnum() else '_' for c in name])
+
+
+def percent(part, total):
+    return part * 100.0 / total if total else 0.0
 
 
 class Command(BaseCommand):
@@ -60,7 +80,15 @@ class Command(BaseCommand):
         current_time = time()
         delta = current_time - self.previos_time
         cm = coa_counter()
-        stats = cache_stats()
+        node_stats = cache_node_stats()
+        stats = cache_stats(node_stats)
+        nodes = ''.join([NODE_ROW.format(name=name, items=node['curr_items'], connections=node['curr_connections'],
+                                         hits=percent(node['get_hits'], node['cmd_get']),
+                                         memory=percent(node['bytes'], node['limit_maxbytes']))
+                         for name, node in node_stats])
+        counts = stage_counts(STAGE_WINDOWS)
+        stages = ''.join([' {0:<14} {1}\n'.format(name, format_percentiles(counts[name]))
+                          for name in STAGES if name in counts]) or ' No sampled requests\n'
         completed_notifications_num = UserNotificationRecord.objects.filter(is_completed=True).count()
         notifications_num = UserNotificationRecord.objects.count()
         result = SCREEN_TEMPLATE.format(
@@ -69,11 +97,14 @@ class Command(BaseCommand):
             cq=CoaQueue.objects.all().count(),
             bras=bras_stats,
             mi=stats['curr_items'],
+            nodes=nodes,
             ms=stats['cmd_set'],
             msps=(stats['cmd_set'] - self.previos_ms) / delta,
             mg=stats['cmd_get'],
             mgps=(stats['cmd_get'] - self.previos_mg) / delta,
             la='  '.join(map(str, getloadavg())),
+            sw=STAGE_WINDOWS * settings.TIMING_WINDOW // 60,
+            stages=stages,
             nc=completed_notifications_num,
             ncp=completed_notifications_num / notifications_num * 100
         )
@@ -84,9 +115,19 @@ class Command(BaseCommand):
         return result
 
     def handle(self, *args, **options):
-        stats = cache_stats()
+        node_stats = cache_node_stats()
+        stats = cache_stats(node_stats)
+        for name, node in node_stats:
+            for key in NODE_FIGURES:
+                if key in node:
+                    stats['{0}_{1}'.format(node_key(name), key)] = node[key]
         stats['coa_counter'] = coa_counter()
         stats['coa_queue'] = CoaQueue.objects.all().count()
+        counts = stage_counts(STAGE_WINDOWS)
+        for name in STAGES:
+            if name in counts:
+                for value in PERCENTILES:
+                    stats['stage_{0}_p{1}'.format(name, value)] = round(percentile(counts[name], value) * 1000, 2)
 
         if options['zenoss']:
             formatted_stats = 'OK | ' + ' '.join(['{0}={1}'.format(key, stats[key]) for key in stats])
@@ -1,27 +1,105 @@
 import sys
+import uuid
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from isg.libcache import coa_is_locked, lock_coa, unlock_coa
+from django.db import close_old_connections
+from django.utils import timezone
+from isg.libcache import coa_lock
+from isg.libcoa import CoaDispatcher, CoaError, get_client
+from isg.libmetrics import COA_QUEUE_DEPTH, TextfileExporter
 from isg.models import CoaQueue
 from isgtool.contrib import log
-from time import sleep
+from time import sleep, time
 
 
 class Command(BaseCommand):
     help = 'Run pending CoA job'
 
+    def add_arguments(self, parser):
+        parser.add_argument('-d', '--daemon', dest='daemon', action='store_true',
+                            help='Keep running and send pending CoA as soon as they are queued')
+        parser.add_argument('-b', '--batch-size', type=int, dest='batch_size', default=settings.COA_QUEUE_BATCH_SIZE,
+                            metavar='SIZE', help='Queue entries claimed at once')
+        parser.add_argument('-i', '--interval', type=float, dest='interval', default=settings.COA_QUEUE_INTERVAL,
+                            metavar='SECONDS', help='Daemon queue polling interval when the queue is empty')
+        parser.add_argument('-m', '--metrics-name', dest='metrics_name', default='pending_coa', metavar='NAME',
+                            help='Metrics textfile name, should differ between daemons running side by side')
+
+    def completed(self, request, context):
+        entry, sid = context
+        entry.coa.finish(entry.uid, sid, request)
+        self.latencies.append((timezone.now() - entry.created).total_seconds() if entry.created else 0)
+
+    def run_batch(self, batch, tick=None):
+        logger = log(self)
+        started = time()
+        self.latencies = []
+        dispatcher = CoaDispatcher(get_client(), settings.COA_WINDOW, settings.COA_RATE, tick=tick)
+        for entry in batch:
+            try:
+                prepared = entry.coa.prepare(entry.uid)
+            except CoaError as ex:
+                logger.error(ex)
+                dispatcher.fail()
+                continue
+            except Exception as ex:
+                logger.error(u'CoA for user \'{0}\' failed: {1}'.format(entry.uid, ex))
+                dispatcher.fail()
+                continue
+            if prepared is None:
+                dispatcher.skip()
+                continue
+            bras, sid, pairs = prepared
+            dispatcher.submit(bras.ip_address, bras.coa_port, bras.coa_secret, pairs, self.completed, (entry, sid))
+        dispatcher.join()
+        CoaQueue.objects.filter(id__in=[entry.id for entry in batch]).delete()
+        logger.info(u'{0} pending CoA handled in {1:.2f} s: {2} succeeded, {3} failed, {4} skipped{5}'.format(
+            len(batch), time() - started, dispatcher.succeeded, dispatcher.failed, dispatcher.skipped,
+            u', queue latency avg {0:.2f} s, max {1:.2f} s'.format(sum(self.latencies) / len(self.latencies),
+                                                                   max(self.latencies)) if self.latencies else u''))
+
+    def export_metrics(self, force=False):
+        if force or self.exporter.due():
+            COA_QUEUE_DEPTH.set(CoaQueue.objects.count())
+            self.exporter.export()
+
     def handle(self, *args, **options):
         logger = log(self)
+        worker = uuid.uuid4().hex
+        self.exporter = TextfileExporter(options['metrics_name'])
+        claim = lambda: CoaQueue.objects.claim(worker, options['batch_size'], settings.COA_QUEUE_CLAIM_TIMEOUT)
+        if options['daemon']:
+            logger.info(u'Pending CoA daemon {0} started'.format(worker))
+            # The CoA lock caps the per-BRAS rate of all senders, daemons take turns with each other and with
+            # refresh_services, which releases it between its blocks
+            lock = coa_lock()
+            while True:
+                batch = None
+                try:
+                    self.export_metrics()
+                    with lock:
+                        batch = claim()
+                        if batch:
+                            self.run_batch(batch, lock.renew_if_due)
+                except Exception:
+                    logger.error(u'Pending CoA daemon catched exception: [{0}] {1}'.format(*sys.exc_info()))
+                    batch = None
+                if not batch:
+                    close_old_connections()
+                    sleep(options['interval'])
+
         logger.info(u'Pending CoA job started')
         logger.info('Waiting for CoA is unlocked...')
-        while coa_is_locked():
-            sleep(0.2)
-        lock_coa()
+        lock = coa_lock()
+        lock.acquire()
         try:
-            for coa in CoaQueue.objects.all():
-                coa.run()
-                sleep(0.05)
+            batch = claim()
+            while batch:
+                self.run_batch(batch, lock.renew_if_due)
+                batch = claim()
         except:
             logger.critical(u'PCJ catched exception: [{0}] {1}'.format(*sys.exc_info()))
         logger.info(u'Pending CoA job finished')
-        unlock_coa()
+        lock.release()
+        self.export_metrics(force=True)
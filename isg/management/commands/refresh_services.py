@@ -2,55 +2,116 @@
 
 from datetime import datetime
 from django.core.management.base import BaseCommand
-from isg.libcache import lock_coa, unlock_coa, coa_is_locked
+from isg.libcache import coa_lock
+from isg.libcoa import RESULT_SUCCESS, CoaDispatcher, CoaError, get_client
+from isg.libmetrics import TextfileExporter
+from isg.libsession import iter_chunks
 from isgtool.contrib import log
 from time import sleep
 from www.models import UserNotificationRecord
 from django.conf import settings
 
+
 class Command(BaseCommand):
     help = 'Send CoA for service activation'
 
     def add_arguments(self, parser):
         parser.add_argument('-l', '--limit', type=int, dest='limit', default=0, metavar='LIMIT',
                             help='Limit uid list size')
+        parser.add_argument('-w', '--window', type=int, dest='window', default=settings.COA_WINDOW, metavar='SIZE',
+                            help='CoA requests in flight per BRAS')
+        parser.add_argument('-r', '--rate', type=float, dest='rate', default=None, metavar='RATE',
+                            help='CoA requests per second per BRAS, 0 - no limit, COA_RATE by default')
+
+    def legacy_settings(self, rate):
+        """Block size and rate, honouring the settings of the former fixed-interval sender."""
+        logger = log(self)
+        block_size = settings.COA_PREFETCH_SIZE
+        if hasattr(settings, 'COA_BLOCK_SIZE'):
+            logger.warning(u'COA_BLOCK_SIZE is deprecated, use COA_PREFETCH_SIZE')
+            block_size = settings.COA_BLOCK_SIZE
+        if hasattr(settings, 'COA_MESSAGE_INTERVAL'):
+            logger.warning(u'COA_MESSAGE_INTERVAL is deprecated, use COA_RATE')
+            if rate is None and settings.COA_MESSAGE_INTERVAL > 0:
+                rate = 1.0 / settings.COA_MESSAGE_INTERVAL
+        return block_size, settings.COA_RATE if rate is None else rate
+
+    def completed(self, request, context):
+        record_id, uid, coa, sid = context
+        if coa.finish(uid, sid, request, 'debug') == RESULT_SUCCESS:
+            self.refreshed.append(record_id)
+            if len(self.refreshed) >= settings.COA_PREFETCH_SIZE:
+                self.save_refreshed()
+
+    def save_refreshed(self):
+        if self.refreshed:
+            UserNotificationRecord.objects.filter(id__in=self.refreshed).update(refreshed=datetime.now())
+            self.refreshed = []
+
+    def dispatch(self, block):
+        logger = log(self)
+        commands = {}
+        for record in block:
+            commands.setdefault(record.notification.coa_id, (record.notification.coa, []))[1].append(record)
+        for coa, records in commands.values():
+            try:
+                prepared = coa.prepare_many([record.uid for record in records])
+            except CoaError as ex:
+                logger.error(ex)
+                for record in records:
+                    self.dispatcher.fail()
+                continue
+            for record in records:
+                if record.uid not in prepared:
+                    self.dispatcher.skip()
+                    continue
+                bras, sid, pairs = prepared.pop(record.uid)
+                self.dispatcher.submit(bras.ip_address, bras.coa_port, bras.coa_secret, pairs, self.completed,
+                                       (record.id, record.uid, coa, sid))
+
+    def yield_lock(self):
+        """Release the CoA lock between the blocks, so pending CoA are sent while the campaign runs."""
+        logger = log(self)
+        self.dispatcher.join()
+        self.save_refreshed()
+        self.lock.release()
+        logger.info(u'Records are refreshed: {0}. Waiting for the next block...'.format(self.dispatcher.sent))
+        sleep(settings.COA_BLOCK_DELAY)
+        logger.info('Waiting for CoA is unlocked...')
+        self.lock.acquire()
+
+    def tick(self):
+        self.lock.renew_if_due()
+        if self.exporter.due():
+            self.exporter.export()
 
     def handle(self, *args, **options):
         logger = log(self)
         logger.info('Start services refresh')
-        counter = 0
-        skipped = 0
-        failed = 0
 
-        qs = UserNotificationRecord.objects.get_active().filter(is_completed=False)
+        qs = UserNotificationRecord.objects.get_active().filter(is_completed=False).select_related('notification__coa')
         if options['limit'] > 0:
             qs = qs[:options['limit']]
 
         logger.info('Waiting for CoA is unlocked...')
-        while coa_is_locked():
-            sleep(0.2)
-        lock_coa()
-        for record in qs:
-
-            if counter > 0 and counter % settings.COA_BLOCK_SIZE == 0:
-                unlock_coa()
-                logger.info('Records are refreshed: {}. Waiting for the next block...'.format(counter))
-                sleep(settings.COA_BLOCK_DELAY)
-                logger.info('Waiting for CoA is unlocked...')
-                while coa_is_locked():
-                    sleep(0.2)
-                lock_coa()
-
-            return_code = record.notification.coa.run(record.uid)
-            if return_code is None:
-                skipped += 1
-            elif return_code == 0:
-                counter += 1
-                failed += 1
-            else:
-                counter += 1
-                record.refreshed = datetime.now()
-                record.save()
-                sleep(settings.COA_MESSAGE_INTERVAL)
-        unlock_coa()
-        logger.info('Services refresh finished')
\ No newline at end of file
+        self.lock = lock = coa_lock()
+        lock.acquire()
+        self.refreshed = []
+        self.exporter = TextfileExporter('refresh_services')
+        block_size, rate = self.legacy_settings(options['rate'])
+        self.dispatcher = CoaDispatcher(get_client(), options['window'], rate,
+                                        progress_interval=settings.COA_PROGRESS_INTERVAL,
+                                        logger=logger, tick=self.tick)
+        try:
+            for n, block in enumerate(iter_chunks(qs.iterator(), block_size)):
+                if n:
+                    self.yield_lock()
+                self.tick()
+                self.dispatch(block)
+                self.dispatcher.process(0)
+            self.dispatcher.join()
+        finally:
+            self.save_refreshed()
+            lock.release()
+            self.exporter.export()
+        logger.info('Services refresh finished')
@@ -1,25 +1,47 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import socket
 import subprocess
-import telnetlib
-
-from django.db import models
+import threading
+
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.core.cache import cache
 from isg.libcache import *
+from isg.libcoa import RESULT_FAILURE, RESULT_SUCCESS, CoaError, get_client, parse_message
+from isg.libconnection import get_connection, time_left
+from isg.libmetrics import COA_COMPLETED, COA_SKIPPED
+from isg.libsession import READ_SIZE, iter_chunks, iter_lines, parse_sessions
 from isgtool.contrib import log
+from time import time
+
+
+BRAS_BY_IP_TEMPLATE = 'bras_by_ip_{0}'
+
+
+class CachedBras(CachedValue):
+    __slots__ = ('id', 'name', 'ip_address', 'coa_port', 'coa_secret')
+    TAG = 'B'
 
 
 class BrasManager(models.Manager):
     def get_by_ip(self, ip):
-        key = 'bras_by_ip_{0}'.format(ip)
-        bras = cache.get(key)
+        key = BRAS_BY_IP_TEMPLATE.format(ip)
+        bras = local_cache.get('bras', key)
         if bras:
             return bras
-        else:
-            bras = self.get(ip_address=ip)
-            cache.set(key, bras, 0)
-            return bras
+        bras = CachedBras.unpack(cache.get(key))
+        if bras is None:
+            bras = CachedBras.from_instance(self.get(ip_address=ip))
+            cache.set(key, bras.pack(), None)
+        local_cache.set('bras', key, bras)
+        return bras
 
     def active(self):
         return self.filter(is_active=True)
@@ -54,69 +76,67 @@ class Bras(models.Model):
         else:
             return u'New BRAS'
 
-    def _telnet_output(self, command):
-        tn = telnetlib.Telnet(self.ip_address, 23, self.timeout)
-        tn.read_until('TACACS+ Username: ', timeout=self.timeout)
-        tn.write('{0}\n'.format(self.username))
-        tn.read_until('Password: ', timeout=self.timeout)
-        tn.write('{0}\n'.format(self.password))
-        tn.read_until(str(self.command_prompt))
-        tn.write('terminal length 0\n')
-        tn.read_until(str(self.command_prompt))
-        tn.write('{0}\n'.format(command))
-        result = tn.read_until(str(self.command_prompt))
-        tn.write('logout\n')
-        tn.close()
-        return result
-
-    def _rsh_output(self, command):
-        cmd = '/usr/bin/rsh -l rsh {0} {1}'.format(self.ip_address, command)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
-        (output, error) = p.communicate()
-        p.wait()
-        return output
-
-    def aaa_list_update(self):
+    def _telnet_output(self, command, deadline=None):
+        with get_connection(self) as connection:
+            try:
+                for chunk in connection.execute(command, deadline):
+                    yield chunk
+            finally:
+                if not settings.BRAS_KEEP_CONNECTIONS:
+                    connection.close()
+
+    def _rsh_output(self, command, deadline=None):
+        cmd = ['/usr/bin/rsh', '-l', 'rsh', self.ip_address] + command.split()
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        timer = None
+        if deadline is not None:
+            timer = threading.Timer(time_left(deadline), p.kill)
+            timer.start()
+        try:
+            for chunk in iter(lambda: p.stdout.read(READ_SIZE), ''):
+                yield chunk
+            p.wait()
+        finally:
+            if timer:
+                timer.cancel()
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+        if p.returncode < 0 and deadline is not None and time() >= deadline:
+            raise socket.timeout(u'BRAS \'{0}\' poll deadline exceeded'.format(self.name))
+        if p.returncode != 0:
+            raise IOError(u'RShell to BRAS \'{0}\' exited with code {1}'.format(self.name, p.returncode))
+
+    def aaa_list_update(self, deadline=None, timeout=None):
         logger = log(self)
         if self.method == 'tln':
             logger.info(u'Get sessiong list from BRAS \'{0}\' by command-line interface'.format(self.name))
-            output = self._telnet_output('show aaa sessions')
+            output = self._telnet_output('show aaa sessions', deadline)
         else:
             logger.info(u'Get session list from BRAS \'{0}\' by RShell'.format(self.name))
-            output = self._rsh_output('show aaa sessions')
-        sessions = []
-        counter = 0
-        session_id = None
-        uid = None
-        ip_address = None
+            output = self._rsh_output('show aaa sessions', deadline)
+        update = SessionCacheUpdate(self.id, self.ip_address, timeout)
         logger.info(u'Parse {} output'.format('telnet' if self.method == 'tln' else 'RShell'))
-        for raw_line in output.split('\n'):
-            try:
-                param, value = raw_line.strip().split(': ')
-            except ValueError:
-                continue
-            if param == 'Session Id':
-                session_id = value
-                uid = None
-                ip_address = None
-            elif param == 'User Name' and value != '*not available*':
-                uid = value
-            elif param == 'IP Address':
-                ip_address = value
-                if not uid:
-                    uid = value
-            else:
-                continue
-
-            if uid and session_id and ip_address and ip_address != '0.0.0.0':
-                counter += 1
-                sessions.append(dict(ip=ip_address, uid=uid, bid=self.ip_address, sid='{:X}'.format(int(session_id))))
-
-        logger.info(u'Parsed {0} sessions(s).'.format(counter))
-
-        logger.info(u'Caching query result')
-        cache_session_data(sessions)
-        set_bras_last_update(self.id, counter)
+        try:
+            for chunk in iter_chunks(parse_sessions(iter_lines(output), self.ip_address), settings.SESSION_CHUNK_SIZE):
+                update.update(chunk)
+        except:
+            update.abort()
+            raise
+        if not update.sessions and update.previous:
+            # An error banner or a cut output parses to nothing, publishing it would drop every subscriber
+            logger.error(u'BRAS \'{0}\' returned no sessions, {1} sessions of the previous poll kept'.format(
+                self.name, len(update.previous)))
+            update.abort()
+            raise EmptyPoll(u'BRAS \'{0}\' returned no sessions'.format(self.name))
+        update.finish()
+
+        logger.info(u'Parsed {0} sessions(s): {1} added, {2} changed, {3} removed{4}.'.format(
+            update.sessions, update.added, update.changed, update.removed, ' (full sync)' if update.full else ''))
+        logger.info(u'Written {0} keys in {1:.2f} s ({2:.0f} keys/sec), {3} keys failed.'.format(
+            update.written, update.writer.elapsed, update.writer.rate(), update.writer.failed))
+        set_bras_last_update(self.id, update.sessions)
+        return update
 
     def last_update_datetime(self):
         dt, sss = get_bras_last_update(self.id)
@@ -141,7 +161,7 @@ class CoaCommand(models.Model):
         else:
             return u'New Command'
 
-    def run(self, uid, log_level='info'):
+    def prepare(self, uid, log_level='info'):
         logger = log(self)
         log_level = getattr(logging, log_level.upper())
         logger.log(log_level, u'Run CoA \'{0}\' to user ID \'{1}\''.format(self.name, uid))
@@ -152,44 +172,140 @@ class CoaCommand(models.Model):
             logger.log(log_level, u'No cached session info for user \'{0}\''.format(uid))
             return None
 
-        bras = Bras.objects.get(ip_address=bid)
+        try:
+            bras = Bras.objects.get_by_ip(bid)
+        except Bras.DoesNotExist:
+            logger.warning(u'Unknown BRAS {0} in the session of user \'{1}\''.format(bid, uid))
+            return None
 
-        message = self.message.format(user_id=uid, aaa_session_id=sid)
-        cmd = 'radclient -x -t 3 -r 1 {bid}:{port} coa {secret}'.format(bid=bid, port=bras.coa_port,
-                                                                        secret=bras.coa_secret)
         if get_last_coa_sid(self.id, uid) == sid:
             logger.log(log_level,
                        u'User \'{0}\' session ID {1} hasn\'t changed since last CoA. Avoid CoA'.format(uid, sid))
             return None
-        logger.log(log_level, u'Send CoA to \'{0}\''.format(bras.ip_address))
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, shell=True)
-        (output, error) = p.communicate(input=message)
+        return bras, sid, self.message_pairs(uid, sid)
+
+    def prepare_many(self, uids):
+        """Prepare CoA for many users with two cache round trips.
+
+        Returns {uid: (bras, sid, pairs)} for the users who are online and whose
+        session has changed since the last CoA, the others are left out.
+        """
+        sessions = get_session_details(uids)
+        last_sids = get_last_coa_sids(self.id, sessions.keys())
+        prepared = {}
+        for uid, (bid, sid) in sessions.items():
+            if last_sids.get(uid) == sid:
+                continue
+            try:
+                bras = Bras.objects.get_by_ip(bid)
+            except Bras.DoesNotExist:
+                log(self).warning(u'Unknown BRAS {0} in the session of user \'{1}\''.format(bid, uid))
+                continue
+            prepared[uid] = (bras, sid, self.message_pairs(uid, sid))
+        return prepared
+
+    def message_pairs(self, uid, sid):
+        try:
+            return parse_message(self.message.format(user_id=uid, aaa_session_id=sid))
+        except (CoaError, KeyError, IndexError) as ex:
+            raise CoaError(u'CoA \'{0}\' message is invalid: {1}'.format(self.name, ex))
+
+    def finish(self, uid, sid, request, log_level='info'):
+        logger = log(self)
         increase_coa_counter()
-        if p.returncode == 0:
-            logger.debug(u'CoA Response:\n{0}'.format(output))
+        if request.result == RESULT_SUCCESS:
+            logger.debug(u'CoA Response:\n{0}'.format(request.describe()))
             set_coa_sid(self.id, uid, sid)
         else:
-            logger.log(log_level, u'CoA request failed:\n{0}'.format(output))
-        return p.returncode
+            logger.log(getattr(logging, log_level.upper()), u'CoA request failed:\n{0}'.format(request.describe()))
+        return request.result
+
+    def run(self, uid, log_level='info'):
+        logger = log(self)
+        try:
+            prepared = self.prepare(uid, log_level)
+        except CoaError as ex:
+            logger.error(ex)
+            COA_COMPLETED.inc(result='error')
+            return RESULT_FAILURE
+        if prepared is None:
+            COA_SKIPPED.inc()
+            return None
+        bras, sid, pairs = prepared
+        logger.log(getattr(logging, log_level.upper()), u'Send CoA to \'{0}\''.format(bras.ip_address))
+        request = get_client().request(bras.ip_address, bras.coa_port, bras.coa_secret, pairs)
+        return self.finish(uid, sid, request, log_level)
+
+
+class CoaQueueManager(models.Manager):
+    def claim(self, worker, batch_size, claim_timeout):
+        """Mark up to batch_size unclaimed entries as taken by the worker and return them.
+
+        Entries claimed more than claim_timeout seconds ago are considered
+        abandoned by a dead worker and are claimed again. The conditional
+        update lets several workers claim side by side: a row taken by another
+        worker in between doesn't match and is skipped.
+        """
+        now = timezone.now()
+        claimable = Q(claimed_by=None) | Q(claimed__lt=now - timedelta(seconds=claim_timeout))
+        ids = list(self.filter(claimable).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        self.filter(claimable, id__in=ids).update(claimed_by=worker, claimed=now)
+        return list(self.filter(claimed_by=worker, id__in=ids).select_related('coa'))
+
+    def enqueue(self, coa_id, uid):
+        """Queue the CoA unless the same one is already pending for the user, return the new entry or None."""
+        try:
+            with transaction.atomic():
+                return self.create(coa_id=coa_id, uid=uid)
+        except IntegrityError:
+            return None
+
+    def bulk_enqueue(self, coa_id, uids, batch_size=500):
+        """Queue the CoA for many users with one insert per batch, return the number of new entries."""
+        counter = 0
+        for chunk in iter_chunks(sorted(set(uids)), batch_size):
+            pending = set(self.filter(coa_id=coa_id, uid__in=chunk).values_list('uid', flat=True))
+            entries = [CoaQueue(coa_id=coa_id, uid=uid) for uid in chunk if uid not in pending]
+            try:
+                with transaction.atomic():
+                    self.bulk_create(entries)
+                counter += len(entries)
+            except IntegrityError:
+                counter += len([entry for entry in entries if self.enqueue(coa_id, entry.uid)])
+        log(self).info(u'{0} pending CoA #{1} created.'.format(counter, coa_id))
+        return counter
 
 
 class CoaQueue(models.Model):
     coa = models.ForeignKey('CoaCommand')
     uid = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True, null=True)
+    claimed_by = models.CharField(max_length=32, blank=True, null=True, db_index=True)
+    claimed = models.DateTimeField(blank=True, null=True)
+
+    objects = CoaQueueManager()
 
     class Meta:
         ordering = ('id',)
+        unique_together = ('coa', 'uid')
 
     def run(self):
         self.coa.run(self.uid)
         self.delete()
 
     def save(self, *args, **kwargs):
-        if self.id:
-            new_record = True
-        else:
-            new_record = False
+        new_record = self.id is None
         result = super(CoaQueue, self).save(*args, **kwargs)
         if new_record:
-            log(self).info(u'Pending CoA #{0} ({1}->{2} created.'.format(self.id, self.coa.name, self.uid))
+            log(self).info(u'Pending CoA #{0} (#{1}->{2}) created.'.format(self.id, self.coa_id, self.uid))
         return result
+
+
+@receiver([post_save, post_delete], sender=Bras)
+def invalidate_bras(sender, instance, **kwargs):
+    cache.delete(BRAS_BY_IP_TEMPLATE.format(instance.ip_address))
+    local_cache.clear('bras')
+    if kwargs['signal'] is post_delete or not instance.is_active:
+        invalidate_bras_sessions(instance.id, instance.ip_address)
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import random
+import socket
+import threading
+
+from isg.libcoa import COA_ACK, COA_NAK, CoaError, decode_packet, encode_reply, verify_request
+from isg.libsession import NOT_AVAILABLE, READ_SIZE
+from isg.models import Bras, CoaCommand
+from time import sleep
+from www.models import UserNotification, UserNotificationRecord
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                             'OPTIONS': {'MAX_ENTRIES': 10000}}}
+
+MESSAGE = '''User-Name = "{user_id}"
+Cisco-Account-Info = "S{aaa_session_id}"
+Cisco-AVPair = "subscriber:command=account-logon", Cisco-Command-Code = "\\013PBHK"'''
+
+SESSION_TEMPLATE = '''Session Id: {0}
+   Unique Id: {0}
+   User Name: {1}
+   IP Address: {2}
+   Idle Time: {3}
+   CT Call Handle: 0
+'''
+
+
+class PortalTestMixin(object):
+    """Creates the objects the CoA and portal tests share."""
+
+    def create_bras(self, coa_port, ip_address='127.0.0.1'):
+        return Bras.objects.create(name='BRAS', ip_address=ip_address, username='user', password='password',
+                                   timeout=1, command_prompt='BRAS#', coa_secret='secret', coa_port=coa_port)
+
+    def create_coa(self):
+        return CoaCommand.objects.create(name='Logon', message=MESSAGE)
+
+    def create_notification(self):
+        """The active notification sending the logon CoA."""
+        coa = self.create_coa()
+        return UserNotification.objects.create(name='Poll', template='max', coa=coa, successful_coa=coa,
+                                               is_active=True)
+
+    def create_records(self, notification, uids, **fields):
+        return [UserNotificationRecord.objects.create(notification=notification, uid=uid, **fields) for uid in uids]
+
+
+class FakeCoaServer(threading.Thread):
+    """Local CoA endpoint answering every valid request with CoA-ACK.
+
+    reply is 'ack', 'nak' or 'drop'; the first drop_first requests are ignored
+    whatever the reply is, so retransmits can be checked.
+    """
+
+    def __init__(self, secret, host='127.0.0.1', port=0, reply='ack', drop_first=0):
+        super(FakeCoaServer, self).__init__()
+        self.daemon = True
+        self.secret = secret
+        self.reply = reply
+        self.drop_first = drop_first
+        self.requests = []
+        self.received = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.settimeout(0.1)
+        self.host, self.port = self.socket.getsockname()
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.socket.close()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                packet, address = self.socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            self.received += 1
+            try:
+                code, identifier, authenticator, attributes = decode_packet(packet)
+            except CoaError:
+                continue
+            if not verify_request(packet, self.secret):
+                continue
+            self.requests.append(attributes)
+            if self.received <= self.drop_first or self.reply == 'drop':
+                continue
+            reply_code = COA_ACK if self.reply == 'ack' else COA_NAK
+            self.socket.sendto(encode_reply(packet, self.secret, reply_code), address)
+
+
+class FakeSessionTable(object):
+    """Synthetic BRAS sessions printed like "show aaa sessions".
+
+    Subscriber n has the address 10.x.y.z made of n and a user name, every
+    no_name_every-th one has none, as an IPoE session without
+    authentication. Tables of several BRASs get distinct subscribers with
+    different first numbers. churn() moves a part of the subscribers to new
+    sessions.
+    """
+
+    def __init__(self, count, network=10, no_name_every=50, seed=0, first=0):
+        self.random = random.Random(seed)
+        self.sessions = []
+        for n in range(first, first + count):
+            ip = '{0}.{1}.{2}.{3}'.format(network, ((n + 1) >> 16) & 255, ((n + 1) >> 8) & 255, (n + 1) & 255)
+            uid = NOT_AVAILABLE if no_name_every and n % no_name_every == no_name_every - 1 else 'user{0}'.format(n)
+            self.sessions.append([n + 1, uid, ip])
+        self.next_sid = first + count + 1
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def churn(self, fraction):
+        """Give fraction of the subscribers new session IDs, return the number of changed sessions."""
+        changed = self.random.sample(range(len(self.sessions)), int(len(self.sessions) * fraction))
+        for index in changed:
+            self.sessions[index][0] = self.next_sid
+            self.next_sid += 1
+        return len(changed)
+
+    def dump(self, chunk_size=READ_SIZE):
+        """Yield the command output in chunks of about chunk_size bytes."""
+        chunk = ['Total sessions since last reload: {0}\n'.format(self.next_sid - 1)]
+        size = 0
+        for sid, uid, ip in self.sessions:
+            text = SESSION_TEMPLATE.format(sid, uid, ip, self.random.randint(0, 3600))
+            chunk.append(text)
+            size += len(text)
+            if size >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield ''.join(chunk)
+
+
+class FakeBras(threading.Thread):
+    """Local BRAS command-line interface served over telnet as BrasConnection expects it.
+
+    Every connection logs in with the TACACS+ username and password, then
+    gets the prompt after every command. "show aaa sessions" lists the table,
+    churn of its subscribers get new sessions before every listing. Every
+    command is answered after latency seconds. With a secret a FakeCoaServer
+    answers CoA on coa_port of the same address.
+    """
+
+    def __init__(self, table, host='127.0.0.1', port=0, username='isgtool', password='isgtool', prompt='BRAS#',
+                 churn=0, latency=0, secret=None, coa_port=0, coa_reply='ack'):
+        super(FakeBras, self).__init__()
+        self.daemon = True
+        self.table = table
+        self.username = username
+        self.password = password
+        self.prompt = prompt
+        self.churn = churn
+        self.latency = latency
+        self.connections = 0
+        self.logins = 0
+        self.polls = 0
+        self.lock = threading.Lock()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(16)
+        self.socket.settimeout(0.1)
+        self.host, self.port = self.socket.getsockname()
+        self.coa = FakeCoaServer(secret, host, coa_port, coa_reply) if secret else None
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self.coa:
+            self.coa.start()
+        super(FakeBras, self).start()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.socket.close()
+        if self.coa:
+            self.coa.stop()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                connection, address = self.socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            self.connections += 1
+            thread = threading.Thread(target=self.serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def lines(self, connection):
+        connection.settimeout(0.1)
+        data = ''
+        while not self.stopped.is_set():
+            try:
+                received = connection.recv(4096)
+            except socket.timeout:
+                continue
+            if not received:
+                return
+            data += received
+            while '\n' in data:
+                line, data = data.split('\n', 1)
+                yield line.rstrip('\r')
+
+    def serve(self, connection):
+        lines = self.lines(connection)
+        try:
+            while True:
+                connection.sendall('\r\nUser Access Verification\r\n\r\nTACACS+ Username: ')
+                username = next(lines)
+                connection.sendall('Password: ')
+                password = next(lines)
+                if (username, password) == (self.username, self.password):
+                    break
+                connection.sendall('% Authentication failed\r\n')
+            self.logins += 1
+            connection.sendall('\r\n' + self.prompt)
+            for line in lines:
+                command = line.strip()
+                if command in ('logout', 'exit'):
+                    break
+                if self.latency:
+                    sleep(self.latency)
+                connection.sendall(command + '\r\n')
+                if command == 'show aaa sessions':
+                    with self.lock:
+                        self.polls += 1
+                        if self.churn:
+                            self.table.churn(self.churn)
+                        chunks = list(self.table.dump())
+                    for chunk in chunks:
+                        connection.sendall(chunk)
+                elif command and command != 'terminal length 0':
+                    connection.sendall('% Invalid input detected\r\n')
+                connection.sendall('\r\n' + self.prompt)
+        except (StopIteration, socket.error):
+            pass
+        finally:
+            connection.close()
@@ -1,3 +1,699 @@
-from django.test import TestCase
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from isg import libcache
+from isg.libcache import (CacheWriter, EmptyPoll, LeaseLock, LockLost, SessionCacheUpdate, _snapshots,
+                          cache_session_data, cache_stats, get_session_detail, get_uid, invalidate_bras_sessions,
+                          local_cache)
+from isg.libcoa import (RESULT_FAILURE, RESULT_SUCCESS, CoaClient, CoaDispatcher, CoaError, decode_attributes,
+                        encode_attribute, parse_message)
+from isg.libconnection import close_connections
+from isg.libmemcached import ConsistentClient, ConsistentMemcachedCache, server_names
+from isg.libmetrics import PORTAL_LOOKUPS, Counter, Histogram, Registry, WorkerExporter, collect_workers
+from isg.libtiming import stage_counts, stage_stats
+from isg.libtable import SessionTables, write_session_table
+from isg.management.commands import refresh_services
+from isg.models import Bras, CoaQueue
+from isg.testing import LOCMEM_CACHES, MESSAGE, FakeBras, FakeCoaServer, FakeSessionTable, PortalTestMixin
+from json import loads
+from time import sleep, time
+from www.models import UserNotification, UserNotificationRecord
+
+def session(ip, uid, sid):
+    return dict(ip=ip, uid=uid, bid='10.255.0.1', sid=sid)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SESSION_FULL_SYNC_INTERVAL=3600)
+class SessionCacheUpdateTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        _snapshots.clear()
+
+    def poll(self, *sessions):
+        update = SessionCacheUpdate('delta-test', '10.255.0.1')
+        update.update(sessions)
+        return update.finish()
+
+    def test_delta(self):
+        update = self.poll(session('10.0.0.1', 'alice', '1'), session('10.0.0.2', 'bob', '2'))
+        self.assertEqual((update.added, update.written, update.full), (2, 8, True))
+        update = self.poll(session('10.0.0.1', 'alice', '1'), session('10.0.0.2', 'carol', '3'),
+                           session('10.0.0.3', 'dave', '4'))
+        self.assertEqual((update.added, update.changed, update.removed, update.written), (1, 1, 0, 8))
+        self.assertEqual(get_uid('10.0.0.2'), 'carol')
+        self.assertEqual(get_session_detail('bob'), [None, None])
+        update = self.poll(session('10.0.0.1', 'alice', '1'))
+        self.assertEqual((update.added, update.changed, update.removed, update.written), (0, 0, 2, 0))
+        self.assertIsNone(get_uid('10.0.0.3'))
+        self.assertEqual(get_uid('10.0.0.1'), 'alice')
+        self.assertEqual(get_session_detail('alice'), ['10.255.0.1', '1'])
+
+    def test_generations(self):
+        update = self.poll(session('10.0.0.1', 'alice', '1'), session('10.0.0.2', 'bob', '2'))
+        generation = update.generation
+        with self.settings(SESSION_FULL_SYNC_INTERVAL=0):
+            update = SessionCacheUpdate('delta-test', '10.255.0.1')
+            update.update([session('10.0.0.1', 'alice', '5'), session('10.0.0.3', 'carol', '3')])
+            self.assertNotEqual(update.generation, generation)
+            self.assertEqual(get_session_detail('alice'), ['10.255.0.1', '1'])
+            self.assertEqual(get_uid('10.0.0.2'), 'bob')
+            local_cache.clear()
+            update.finish()
+        self.assertEqual((update.full, update.removed), (True, 1))
+        self.assertEqual(get_session_detail('alice'), ['10.255.0.1', '5'])
+        self.assertIsNone(get_uid('10.0.0.2'))
+        self.assertEqual(get_uid('10.0.0.3'), 'carol')
+        invalidate_bras_sessions('delta-test', '10.255.0.1')
+        local_cache.clear()
+        self.assertIsNone(get_uid('10.0.0.3'))
+        self.assertEqual(self.poll(session('10.0.0.3', 'carol', '3')).full, True)
+        self.assertEqual(get_uid('10.0.0.3'), 'carol')
+
+    def test_empty_full_sync(self):
+        self.poll(session('10.0.0.1', 'alice', '1'))
+        _snapshots.clear()
+        self.assertRaises(EmptyPoll, self.poll)
+        update = SessionCacheUpdate('delta-test', '10.255.0.1')
+        update.update([session('10.0.0.2', 'bob', '2')])
+        update.abort()
+        local_cache.clear()
+        self.assertEqual(get_uid('10.0.0.1'), 'alice')
+        self.assertIsNone(get_uid('10.0.0.2'))
+        SessionCacheUpdate('delta-test', '10.255.0.1').finish(allow_empty=True)
+        local_cache.clear()
+        self.assertIsNone(get_uid('10.0.0.1'))
+
+
+class SessionTableTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lookup(self):
+        sessions = dict(('10.0.{0}.{1}'.format(n // 256, n % 256), ('user{0}'.format(n), '{0:X}'.format(n)))
+                        for n in range(1, 1000))
+        write_session_table(self.directory, 1, sessions)
+        write_session_table(self.directory, 2, {'192.168.0.1': ('other', '1')})
+        tables = SessionTables(self.directory, check_interval=0)
+        self.assertEqual(tables.lookup('10.0.1.44'), [b'user300', b'12C'])
+        self.assertEqual(tables.lookup('192.168.0.1'), [b'other', b'1'])
+        self.assertIsNone(tables.lookup('10.0.0.0'))
+        self.assertIsNone(tables.lookup('10.0.4.0'))
+        write_session_table(self.directory, 2, {'192.168.0.2': ('other', '2')})
+        self.assertIsNone(tables.lookup('192.168.0.1'))
+        self.assertEqual(tables.lookup('192.168.0.2'), [b'other', b'2'])
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_invalidate(self):
+        cache.clear()
+        local_cache.clear()
+        _snapshots.clear()
+        tables = SessionTables(self.directory, check_interval=0)
+        session_tables, libcache.session_tables = libcache.session_tables, tables
+        try:
+            with self.settings(SESSION_TABLE_DIR=self.directory):
+                update = SessionCacheUpdate('table-test', '10.255.0.1')
+                update.update([session('10.0.0.1', 'alice', '1')])
+                update.finish()
+                self.assertEqual(get_uid('10.0.0.1'), 'alice')
+                self.assertEqual(tables.tables['bras_table-test.table'].generation, update.generation)
+                # Invalidated by another process, the table file is still there
+                cache.clear()
+                local_cache.clear()
+                self.assertIsNone(get_uid('10.0.0.1'))
+                self.assertEqual(tables.lookup('10.0.0.1'), [b'alice', b'1'])
+                invalidate_bras_sessions('table-test', '10.255.0.1')
+                self.assertEqual(os.listdir(self.directory), [])
+                self.assertIsNone(tables.lookup('10.0.0.1'))
+        finally:
+            libcache.session_tables = session_tables
+            _snapshots.clear()
+
+
+class HashRingTest(SimpleTestCase):
+    def test_add_node(self):
+        keys = ['uid_by_ip_10.0.{0}.{1}'.format(n // 256, n % 256) for n in range(10000)]
+        servers = ['10.0.0.{0}:11211'.format(n) for n in range(1, 5)]
+        three = ConsistentClient(servers[:3])
+        four = ConsistentClient(servers)
+        before = dict((key, str(three.ring.node(key))) for key in keys)
+        after = dict((key, str(four.ring.node(key))) for key in keys)
+        moved = [key for key in keys if before[key] != after[key]]
+        self.assertTrue(1500 < len(moved) < 3500)
+        self.assertEqual(set([after[key] for key in moved]), set([str(four.servers[3])]))
+        self.assertEqual(len(set(before.values())), 3)
+        self.assertEqual(list(four.ring.iter_nodes(keys[0]))[0], four.ring.node(keys[0]))
+        self.assertEqual(len(list(four.ring.iter_nodes(keys[0]))), 4)
+
+    def test_stats(self):
+        node_stats = [('10.0.0.1:11211', dict(curr_items=10, cmd_get=5, pid=1, version='1.4')),
+                      ('10.0.0.2:11211', dict(curr_items=20, cmd_get=1, pid=2, version='1.4'))]
+        stats = cache_stats(node_stats)
+        self.assertEqual((stats['nodes'], stats['curr_items'], stats['cmd_get'], stats['pid']), (2, 30, 6, 1))
+        self.assertEqual(server_names('10.0.0.1:11211; 10.0.0.2:11211'), ['10.0.0.1:11211', '10.0.0.2:11211'])
+
+
+class RejectingClient(object):
+    """memcached client stub refusing the keys ending with 'bad', and the 'flaky' ones once."""
+
+    def __init__(self):
+        self.stored = {}
+        self.refused = set()
+
+    def set_multi(self, mapping, time=0):
+        failed = [key for key in mapping if key.endswith('bad') or key.endswith('flaky') and key not in self.refused]
+        self.refused.update(failed)
+        self.stored.update((key, mapping[key]) for key in mapping if key not in failed)
+        return failed
+
+
+class CasClient(object):
+    """memcached client stub with gets/cas, on_gets is called between gets() and the following cas()."""
+
+    def __init__(self):
+        self.data = {}
+        self.cas_ids = {}
+        self.version = 0
+        self.on_gets = None
+
+    def _store(self, key, value, time):
+        self.version += 1
+        if time < 0:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = (value, self.version)
+
+    def add(self, key, value, time=0):
+        if key in self.data:
+            return False
+        self._store(key, value, time)
+        return True
+
+    def get(self, key):
+        return self.data.get(key, (None, None))[0]
+
+    def gets(self, key):
+        value, version = self.data.get(key, (None, None))
+        if version is not None:
+            self.cas_ids[key] = version
+        if self.on_gets:
+            self.on_gets()
+        return value
+
+    def cas(self, key, value, time=0):
+        if key not in self.data or self.data[key][1] != self.cas_ids.get(key):
+            return False
+        self._store(key, value, time)
+        return True
+
+
+@override_settings(SESSION_CACHE_PIPELINE=0)
+class CacheWriterTest(SimpleTestCase):
+    def test_failed_keys(self):
+        backend = ConsistentMemcachedCache('10.0.0.1:11211', {'KEY_PREFIX': 'isg'})
+        backend._client = RejectingClient()
+        self.assertEqual(sorted(backend.set_many({'good': 1, 'bad': 2})), ['bad'])
+        writer = CacheWriter(60, backend)
+        writer.set_many(dict(('key{0}'.format(n), n) for n in range(8)))
+        writer.set_many({'key-flaky': 8, 'key-bad': 9})
+        writer.close()
+        self.assertEqual((writer.keys, writer.failed), (9, 1))
+        self.assertEqual(backend._client.stored['isg:1:key-flaky'], 8)
+
+
+class LeaseLockTest(SimpleTestCase):
+    def setUp(self):
+        self.backend = LocMemCache('lease-lock-test', {})
+        self.backend.clear()
+
+    def test_exclusive(self):
+        holders = []
+        overlaps = []
+        acquired = []
+
+        def job():
+            for n in range(20):
+                with LeaseLock('lock', 10, self.backend, max_delay=0.01):
+                    holders.append(n)
+                    sleep(0.001)
+                    if len(holders) > 1:
+                        overlaps.append(n)
+                    acquired.append(n)
+                    holders.pop()
+
+        threads = [threading.Thread(target=job) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlaps, [])
+        self.assertEqual(len(acquired), 160)
+        self.assertIsNone(self.backend.get('lock'))
+
+    def test_expiry(self):
+        crashed = LeaseLock('lock', 1, self.backend)
+        self.assertTrue(crashed.acquire())
+        waiter = LeaseLock('lock', 1, self.backend)
+        self.assertFalse(waiter.acquire(blocking=False))
+        self.assertTrue(waiter.acquire(timeout=3))
+        self.assertRaises(LockLost, crashed.renew)
+        crashed.release()
+        self.assertTrue(waiter.owned())
+        waiter.renew()
+        waiter.release()
+        self.assertIsNone(self.backend.get('lock'))
+
+    def test_expiry_between_steps(self):
+        backend = ConsistentMemcachedCache('10.0.0.1:11211', {})
+        backend._client = client = CasClient()
+        lock = LeaseLock('lock', 10, backend)
+        other = LeaseLock('lock', 10, backend)
+
+        def expire():
+            client.on_gets = None
+            client.data.clear()
+            other.acquire()
+
+        self.assertTrue(lock.acquire())
+        lock.renew()
+        client.on_gets = expire
+        self.assertRaises(LockLost, lock.renew)
+        self.assertTrue(other.owned())
+        other.release()
+        self.assertTrue(lock.acquire())
+        client.on_gets = expire
+        lock.release()
+        self.assertTrue(other.owned())
+
+
+class CoaMessageTest(SimpleTestCase):
+    def test_parse_message(self):
+        pairs = parse_message(MESSAGE.format(user_id='user', aaa_session_id='1F'))
+        self.assertEqual(pairs, [('User-Name', 'user'),
+                                 ('Cisco-Account-Info', 'S1F'),
+                                 ('Cisco-AVPair', 'subscriber:command=account-logon'),
+                                 ('Cisco-Command-Code', '\x0bPBHK')])
+
+    def test_encode_attribute(self):
+        self.assertEqual(encode_attribute('User-Name', 'user'), b'\x01\x06user')
+        self.assertEqual(encode_attribute('Cisco-Account-Info', 'S1F'), b'\x1a\x0b\x00\x00\x00\x09\xfa\x05S1F')
+        self.assertEqual(decode_attributes(encode_attribute('Cisco-Account-Info', 'S1F')),
+                         [('Cisco-Account-Info', b'S1F')])
+        self.assertEqual(encode_attribute('Vendor-9-Attr-37', 'in'), b'\x1a\x0a\x00\x00\x00\x09\x25\x04in')
+        self.assertEqual(decode_attributes(encode_attribute('Attr-77', '0x0102')), [('Attr-77', b'\x01\x02')])
+        self.assertRaises(CoaError, encode_attribute, 'Cisco-Unknown', 'value')
+
+
+class CoaClientTest(SimpleTestCase):
+    def setUp(self):
+        self.client = CoaClient(timeout=0.2, retries=1)
+
+    def tearDown(self):
+        self.client.close()
+
+    def request(self, server, secret='secret'):
+        return self.client.request(server.host, server.port, secret, MESSAGE.format(user_id='user', aaa_session_id='1'))
+
+    def test_ack(self):
+        with FakeCoaServer('secret') as server:
+            request = self.request(server)
+        self.assertEqual(request.result, RESULT_SUCCESS)
+        self.assertEqual(server.requests[0][0], ('User-Name', b'user'))
+
+    def test_nak(self):
+        with FakeCoaServer('secret', reply='nak') as server:
+            self.assertEqual(self.request(server).result, RESULT_FAILURE)
+
+    def test_timeout(self):
+        with FakeCoaServer('secret', reply='drop') as server:
+            request = self.request(server)
+        self.assertEqual(request.result, RESULT_FAILURE)
+        self.assertEqual(request.attempts, 2)
+
+    def test_wrong_secret(self):
+        with FakeCoaServer('secret') as server:
+            self.assertEqual(self.request(server, 'other').result, RESULT_FAILURE)
+
+    def test_retransmit(self):
+        with FakeCoaServer('secret', drop_first=1) as server:
+            request = self.request(server)
+        self.assertEqual(request.result, RESULT_SUCCESS)
+        self.assertEqual(request.attempts, 2)
+
+    def test_many_in_flight(self):
+        with FakeCoaServer('secret') as server:
+            requests = [self.client.submit(server.host, server.port, 'secret',
+                                           MESSAGE.format(user_id='user{0}'.format(n), aaa_session_id=n))
+                        for n in range(600)]
+            self.client.wait()
+        self.assertEqual([request.result for request in requests], [RESULT_SUCCESS] * 600)
+
+
+class CoaDispatcherTest(SimpleTestCase):
+    def test_window(self):
+        client = CoaClient(timeout=0.2, retries=1)
+        dispatcher = CoaDispatcher(client, window=4, rate=0, backlog=10)
+        in_flight = []
+
+        def completed(request, context):
+            in_flight.append(client.in_flight(request.address))
+
+        with FakeCoaServer('secret') as first, FakeCoaServer('secret', reply='nak') as second:
+            for n in range(100):
+                for server in first, second:
+                    dispatcher.submit(server.host, server.port, 'secret', [('User-Name', str(n))], completed)
+            dispatcher.join()
+        client.close()
+        self.assertEqual((dispatcher.sent, dispatcher.succeeded, dispatcher.failed), (200, 100, 100))
+        self.assertEqual(len(in_flight), 200)
+        self.assertLess(max(in_flight), 4)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COA_TIMEOUT=0.2)
+class CoaCommandTest(PortalTestMixin, TestCase):
+    def setUp(self):
+        self.server = FakeCoaServer('secret')
+        self.server.start()
+        self.create_bras(self.server.port)
+        self.coa = self.create_coa()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_run(self):
+        self.assertIsNone(self.coa.run('user'))
+        cache_session_data(dict(ip='10.0.0.1', uid='user', bid='127.0.0.1', sid='1F'))
+        self.assertEqual(self.coa.run('user'), RESULT_SUCCESS)
+        self.assertIsNone(self.coa.run('user'))
+        self.assertEqual(self.server.requests[0][1], ('Cisco-Account-Info', b'S1F'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FakeBrasTest(PortalTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        _snapshots.clear()
+        self.fake = FakeBras(FakeSessionTable(100), churn=0.1, secret='secret')
+        self.fake.start()
+        self.bras = Bras.objects.create(name='BRAS', ip_address='127.0.0.1', username='isgtool', password='isgtool',
+                                        timeout=1, command_prompt='BRAS#', coa_secret='secret',
+                                        coa_port=self.fake.coa.port)
+
+    def tearDown(self):
+        close_connections()
+        self.fake.stop()
+        cache.clear()
+
+    def test_poll(self):
+        with self.settings(BRAS_TELNET_PORT=self.fake.port):
+            update = self.bras.aaa_list_update()
+            self.assertEqual((update.sessions, update.added), (100, 100))
+            update = self.bras.aaa_list_update()
+            self.assertEqual((update.sessions, update.changed), (100, 10))
+        self.assertEqual((self.fake.logins, self.fake.polls), (1, 2))
+        self.assertEqual(get_uid('10.0.0.2'), 'user1')
+        self.assertEqual(get_uid('10.0.0.50'), '10.0.0.50')
+        coa = self.create_coa()
+        self.assertEqual(coa.run('user1'), RESULT_SUCCESS)
+        self.assertEqual(len(self.fake.coa.requests), 1)
+
+    def test_empty_poll(self):
+        with self.settings(BRAS_TELNET_PORT=self.fake.port):
+            self.bras.aaa_list_update()
+            self.fake.table.sessions = []
+            self.assertRaises(EmptyPoll, self.bras.aaa_list_update)
+        local_cache.clear()
+        self.assertEqual(get_uid('10.0.0.2'), 'user1')
+        self.assertEqual(len(_snapshots[self.bras.id][0]), 100)
+
+    def test_oneshot(self):
+        with self.settings(BRAS_TELNET_PORT=self.fake.port, SESSION_ONESHOT_CACHE_TIMEOUT=5):
+            call_command('aaa_update', stdout=StringIO())
+        self.assertEqual(get_uid('10.0.0.2'), 'user1')
+        self.assertLess(cache._expire_info[cache.make_key('bras_by_session_ip_10.0.0.2')], time() + 10)
+
+
+class CoaQueueTest(PortalTestMixin, TestCase):
+    def test_claim(self):
+        coa = self.create_coa()
+        for n in range(5):
+            CoaQueue.objects.create(coa=coa, uid='user{0}'.format(n))
+        first = CoaQueue.objects.claim('first', 3, 300)
+        second = CoaQueue.objects.claim('second', 3, 300)
+        self.assertEqual([entry.uid for entry in first], ['user0', 'user1', 'user2'])
+        self.assertEqual([entry.uid for entry in second], ['user3', 'user4'])
+        self.assertEqual(CoaQueue.objects.claim('third', 3, 300), [])
+        self.assertEqual(len(CoaQueue.objects.claim('third', 10, 0)), 5)
+
+    def test_enqueue(self):
+        coa = self.create_coa()
+        self.assertIsNotNone(CoaQueue.objects.enqueue(coa.id, 'user0'))
+        self.assertIsNone(CoaQueue.objects.enqueue(coa.id, 'user0'))
+        uids = ['user{0}'.format(n % 30) for n in range(100)]
+        self.assertEqual(CoaQueue.objects.bulk_enqueue(coa.id, uids, batch_size=7), 29)
+        self.assertEqual(CoaQueue.objects.count(), 30)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COA_TIMEOUT=0.2)
+class PendingCoaTest(PortalTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.server = FakeCoaServer('secret')
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        cache.clear()
+
+    def test_unknown_bras(self):
+        self.create_bras(self.server.port)
+        coa = self.create_coa()
+        cache_session_data([dict(ip='10.0.0.1', uid='user1', bid='127.0.0.1', sid='1'),
+                            dict(ip='10.0.0.2', uid='user2', bid='127.0.0.2', sid='2')])
+        CoaQueue.objects.bulk_enqueue(coa.id, ['user2', 'user1'])
+        call_command('pending_coa')
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(CoaQueue.objects.count(), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COA_TIMEOUT=0.2, COA_PREFETCH_SIZE=7, COA_BLOCK_DELAY=0)
+class RefreshServicesTest(PortalTestMixin, TestCase):
+    def setUp(self):
+        self.server = FakeCoaServer('secret')
+        self.server.start()
+        self.create_bras(self.server.port)
+        notification = self.create_notification()
+        self.create_records(notification, ['user{0}'.format(n) for n in range(20)], is_active=True)
+        for n in range(1, 20, 2):
+            cache_session_data(dict(ip='10.0.0.{0}'.format(n), uid='user{0}'.format(n), bid='127.0.0.1',
+                                    sid='{0:X}'.format(n)))
+
+    def tearDown(self):
+        self.server.stop()
+        cache.clear()
+
+    def test_refresh(self):
+        call_command('refresh_services')
+        self.assertEqual(len(self.server.requests), 10)
+        refreshed = UserNotificationRecord.objects.exclude(refreshed=None).values_list('uid', flat=True)
+        self.assertEqual(sorted(refreshed), sorted(['user{0}'.format(n) for n in range(1, 20, 2)]))
+        call_command('refresh_services')
+        self.assertEqual(len(self.server.requests), 10)
+
+    def test_legacy_settings(self):
+        command = refresh_services.Command()
+        self.assertEqual(command.legacy_settings(None), (7, 50))
+        with self.settings(COA_BLOCK_SIZE=5, COA_MESSAGE_INTERVAL=0.01):
+            self.assertEqual(command.legacy_settings(None), (5, 100))
+            self.assertEqual(command.legacy_settings(20), (5, 20))
+            call_command('refresh_services')
+        self.assertEqual(len(self.server.requests), 10)
+
+
+class MetricsTest(SimpleTestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = registry.register(Counter('test_total', 'Test counter.', ['result']))
+        histogram = registry.register(Histogram('test_seconds', 'Test histogram.', buckets=(0.1, 1)))
+        counter.inc(result='ok')
+        counter.inc(2, result='failed')
+        for value in 0.05, 0.1, 0.5, 2:
+            histogram.observe(value)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP test_total Test counter.',
+            '# TYPE test_total counter',
+            'test_total{result="failed"} 2',
+            'test_total{result="ok"} 1',
+            '# HELP test_seconds Test histogram.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 2.65',
+            'test_seconds_count 4'])
+
+    def test_view(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertIn(b'# TYPE isg_coa_sent_total counter', response.content)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 404)
+
+    def test_local_cache(self):
+        before = local_cache.stats()['uid']
+        local_cache.set('uid', '10.255.1.1', 'user')
+        local_cache.get('uid', '10.255.1.1')
+        local_cache.get('uid', '10.255.1.1')
+        local_cache.get('uid', '10.255.1.2')
+        local_cache.delete('uid', '10.255.1.1')
+        self.assertEqual(local_cache.stats()['uid'], dict(hits=before['hits'] + 2, misses=before['misses'] + 1))
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertIn(b'isg_local_cache_lookups_total{family="uid",result="hit"}', response.content)
+
+    def test_workers(self):
+        registry = Registry()
+        counter = registry.register(Counter('test_total', 'Test counter.', ['result']))
+        histogram = registry.register(Histogram('test_seconds', 'Test histogram.', buckets=(0.1, 1)))
+        directory = tempfile.mkdtemp()
+        try:
+            with self.settings(METRICS_WORKER_DIR=directory):
+                counter.inc(result='ok')
+                histogram.observe(0.5)
+                exporter = WorkerExporter(registry=registry)
+                exporter.export()
+                gone = subprocess.Popen(['true'])
+                gone.wait()
+                os.rename(os.path.join(directory, exporter.name),
+                          os.path.join(directory, '{0}-1.json'.format(gone.pid)))
+                counter.inc(2, result='failed')
+                histogram.observe(2)
+                exporter.export()
+                lines = registry.render(collect_workers(directory, registry)).splitlines()
+                self.assertIn('test_total{result="ok"} 2', lines)
+                self.assertIn('test_total{result="failed"} 2', lines)
+                self.assertIn('test_seconds_bucket{le="1"} 2', lines)
+                self.assertIn('test_seconds_count 3', lines)
+                self.assertEqual(sorted(os.listdir(directory)), ['.retired.lock', exporter.name, 'retired.json'])
+                # An earlier worker had the same pid
+                os.rename(os.path.join(directory, exporter.name),
+                          os.path.join(directory, '{0}-0.json'.format(os.getpid())))
+                exporter.export()
+                lines = registry.render(collect_workers(directory, registry)).splitlines()
+                self.assertIn('test_total{result="ok"} 3', lines)
+                self.assertIn('test_total{result="failed"} 4', lines)
+                self.assertEqual(sorted(os.listdir(directory)), ['.retired.lock', exporter.name, 'retired.json'])
+                response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+                self.assertIn(b'# TYPE isg_coa_sent_total counter', response.content)
+        finally:
+            shutil.rmtree(directory)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TIMING_SAMPLE_RATE=1, TIMING_FLUSH_INTERVAL=0)
+class StageTimingTest(PortalTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        stage_stats.counts = {}
+
+    def test_stages(self):
+        self.create_records(self.create_notification(), ['user'], is_active=True)
+        cache_session_data(dict(ip='10.0.0.1', uid='user', bid='127.0.0.1', sid='1'))
+        self.assertEqual(self.client.get('/sttk-notification/', REMOTE_ADDR='10.0.0.1').status_code, 200)
+        counts = stage_counts(1)
+        for name in 'notification', 'get_uid', 'record_cache', 'render', 'total':
+            self.assertEqual(sum(counts[name]), 1)
+        self.assertNotIn('record_db', counts)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class NegativeCacheTest(PortalTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        _snapshots.clear()
+
+    def test_unknown_ip(self):
+        negative = PORTAL_LOOKUPS.get(kind='uid', source='negative')
+        self.assertIsNone(get_uid('10.0.0.1'))
+        self.assertIsNone(get_uid('10.0.0.1'))
+        self.assertEqual(PORTAL_LOOKUPS.get(kind='uid', source='negative'), negative + 1)
+        cache_session_data(session('10.0.0.1', 'user', '1'))
+        self.assertEqual(get_uid('10.0.0.1'), 'user')
+
+    def test_unrelated_poll(self):
+        self.assertIsNone(get_uid('10.0.1.5'))
+        update = SessionCacheUpdate('negative-test', '10.255.0.1')
+        update.update([session('10.0.0.7', 'alice', '1')])
+        update.finish()
+        local_cache.clear('epoch')
+        negative = PORTAL_LOOKUPS.get(kind='uid', source='negative')
+        self.assertIsNone(get_uid('10.0.1.5'))
+        self.assertEqual(PORTAL_LOOKUPS.get(kind='uid', source='negative'), negative + 1)
+        update = SessionCacheUpdate('negative-test', '10.255.0.1')
+        update.update([session('10.0.0.7', 'alice', '1'), session('10.0.1.5', 'bob', '2')])
+        update.finish()
+        local_cache.clear('epoch')
+        self.assertEqual(get_uid('10.0.1.5'), 'bob')
+
+    def test_missing_record(self):
+        notification = self.create_notification()
+        negative = PORTAL_LOOKUPS.get(kind='record', source='negative')
+        with self.assertRaises(UserNotificationRecord.DoesNotExist):
+            UserNotificationRecord.objects.get_by_uid('user', notification)
+        local_cache.clear('record_miss')
+        with self.assertNumQueries(0), self.assertRaises(UserNotificationRecord.DoesNotExist):
+            UserNotificationRecord.objects.get_by_uid('user', notification)
+        self.assertEqual(PORTAL_LOOKUPS.get(kind='record', source='negative'), negative + 1)
+        key = ('record_miss', 'record_miss_user_{0}'.format(notification.id))
+        expires = local_cache.data[key][0]
+        sleep(0.01)
+        with self.assertRaises(UserNotificationRecord.DoesNotExist):
+            UserNotificationRecord.objects.get_by_uid('user', notification)
+        self.assertEqual(local_cache.data[key][0], expires)
+        UserNotificationRecord.objects.bulk_import(notification, ['user'])
+        self.assertEqual(UserNotificationRecord.objects.get_by_uid('user', notification).uid, 'user')
+        with self.assertRaises(UserNotificationRecord.DoesNotExist):
+            UserNotificationRecord.objects.get_by_uid('other', notification)
+        UserNotificationRecord.objects.create(notification=notification, uid='other', is_active=True)
+        self.assertEqual(UserNotificationRecord.objects.get_by_uid('other', notification).uid, 'other')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BenchmarkTest(TestCase):
+    def test_values(self):
+        output = StringIO()
+        call_command('isgbench', 'values', iterations=10, stdout=output)
+        self.assertEqual(len(output.getvalue().splitlines()), 7)
+
+    def test_pages(self):
+        output = StringIO()
+        call_command('isgbench', 'pages', iterations=10, stdout=output)
+        self.assertIn('max/notification.html', output.getvalue())
+
+    def test_stages(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'results.json')
+        call_command('isgbench', 'sessions', 'coa', 'portal', sessions='100,200', requests=20, json=path,
+                     stdout=StringIO())
+        with open(path) as results:
+            results = loads(results.read())['results']
+        counts = dict(((result['stage'], result['size']), result['count']) for result in results)
+        self.assertEqual(counts[('parse', 200)], 200)
+        self.assertEqual(counts[('cache_delta', 100)], 100)
+        self.assertEqual(counts[('coa_dispatch', 20)], 20)
+        self.assertEqual(counts[('coa_run', 20)], 20)
+        self.assertEqual(counts[('portal_get_uid', 20)], 20)
+        self.assertEqual(counts[('portal_answer', 20)], 20)
+        self.assertFalse(UserNotification.objects.exists())
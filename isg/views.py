@@ -1,3 +1,15 @@
-from django.shortcuts import render
+# -*- coding: utf-8 -*-
 
-# Create your views here.
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from isg.libmetrics import CONTENT_TYPE, collect_workers, metrics_registry, worker_exporter
+
+
+def metrics(request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404
+    if not settings.METRICS_WORKER_DIR:
+        return HttpResponse(metrics_registry.render(), content_type=CONTENT_TYPE)
+    worker_exporter.export()
+    return HttpResponse(metrics_registry.render(collect_workers(settings.METRICS_WORKER_DIR)),
+                        content_type=CONTENT_TYPE)
@@ -40,6 +40,8 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'www.middleware.StageTimingMiddleware',
+    'www.middleware.WorkerMetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -92,19 +94,73 @@ STATIC_ROOT = BASE_DIR + '/static/'
 
 DEBUG_UID = 'test-kras'
 
+# Job defaults, may be overridden by local settings
+
+AAA_UPDATE_WORKERS = 1
+AAA_UPDATE_DEADLINE = 150
+SESSION_CHUNK_SIZE = 1000
+SESSION_FULL_SYNC_INTERVAL = 600
+SESSION_CACHE_TIMEOUT = 900
+SESSION_ONESHOT_CACHE_TIMEOUT = 180
+SESSION_CACHE_CHUNK_SIZE = 1000
+SESSION_CACHE_PIPELINE = 4
+SESSION_CACHE_RETRIES = 2
+SESSION_TABLE_DIR = None
+BRAS_KEEP_CONNECTIONS = True
+BRAS_TELNET_PORT = 23
+MEMCACHED_RING_REPLICAS = 160
+COA_TIMEOUT = 3
+COA_RETRIES = 1
+COA_WINDOW = 32
+COA_RATE = 50
+COA_PROGRESS_INTERVAL = 5
+COA_LOCK_TTL = 60
+COA_PREFETCH_SIZE = 500
+COA_BLOCK_DELAY = 2
+COA_QUEUE_BATCH_SIZE = 100
+COA_QUEUE_INTERVAL = 1
+COA_QUEUE_CLAIM_TIMEOUT = 300
+RECORD_IMPORT_CHUNK_SIZE = 5000
+EXPORT_CHUNK_SIZE = 2000
+METRICS_TEXTFILE_DIR = None
+METRICS_WORKER_DIR = None
+METRICS_EXPORT_INTERVAL = 15
+METRICS_ALLOWED_IPS = ['127.0.0.1']
+TIMING_SAMPLE_RATE = 0.1
+TIMING_SLOW_REQUEST = 1.0
+TIMING_FLUSH_INTERVAL = 60
+TIMING_WINDOW = 60
+TIMING_WINDOWS = 15
+COMPLETION_BUFFER = None
+COMPLETION_BATCH_SIZE = 500
+COMPLETION_FLUSH_INTERVAL = 1
+PRERENDER_PAGES = True
+PAGE_CACHE_TTL = 60
+PAGE_VARIANTS = 32
+
+LOCAL_CACHE_MAX_ENTRIES = 10000
+LOCAL_CACHE_TTL = {
+    'bras': 300,
+    'epoch': 1,
+    'generation': 1,
+    'notification': 60,
+    'record': 2,
+    'record_miss': 2,
+    'uid': 2,
+    'uid_miss': 10,
+}
+NEGATIVE_CACHE_TIMEOUT = 60
+
 try:
     from isgtool.local_settings import *
 except ImportError:
 
     ENABLE_ADMIN = True
 
-    COA_BLOCK_SIZE = 50
-    COA_BLOCK_DELAY = 50
-    COA_MESSAGE_INTERVAL = 2
-
+    # The CoA lock needs compare_and_set() of ConsistentMemcachedCache when several processes share the cache
     CACHES = {
         'default': {
-            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'BACKEND': 'isg.libmemcached.ConsistentMemcachedCache',
             'LOCATION': '127.0.0.1:11211',
             'TIMEOUT': 180,
             'OPTIONS': {
@@ -15,11 +15,13 @@ Including another URLconf
 """
 from django.conf.urls import include, url
 from django.contrib import admin
+from isg.views import metrics
 from www.views import *
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^template-preview/', TemplatePreView.as_view(), name='template_preview'),
+    url(r'^metrics$', metrics, name='metrics'),
 ]
 
 urlpatterns += [
@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
 
 from django.contrib import admin
+from isg.models import CoaQueue
 from www.models import *
-from django.http import HttpResponse
-from xlsxwriter.workbook import Workbook
-from io import BytesIO
-from json import loads
+from django.http import StreamingHttpResponse
+from wsgiref.util import FileWrapper
+from www.libexport import iter_records_csv, write_records_xlsx
 
 
 @admin.register(UserNotification)
@@ -32,13 +32,15 @@ class UserNotificationRecordAdmin(admin.ModelAdmin):
               'completed', 'display_answer', ]
     readonly_fields = ['is_completed', 'refreshed', 'completed', 'display_answer']
     actions = ['activate_records', 'deactivate_records', 'include_records', 'exclude_records', 'acknowledge_records',
-               'export_to_excel']
+               'queue_successful_coa', 'export_to_excel', 'export_to_csv']
 
     def acknowledge_records(self, request, queryset):
         queryset.update(acknowledged='p')
 
     def activate_records(self, request, queryset):
+        records = list(queryset.values_list('uid', 'notification_id'))
         queryset.update(is_active=True)
+        UserNotificationRecord.objects.forget_misses(records)
 
     def exclude_records(self, request, queryset):
         queryset.update(is_excluded=True)
@@ -47,61 +49,32 @@ class UserNotificationRecordAdmin(admin.ModelAdmin):
         queryset.update(is_active=False)
 
     def include_records(self, request, queryset):
+        records = list(queryset.values_list('uid', 'notification_id'))
         queryset.update(is_excluded=False)
+        UserNotificationRecord.objects.forget_misses(records)
 
-    def export_to_excel(self, request, queryset):
-        column_keys = ['datetime', 'notification', 'uid']
-        column_formats = {
-            'datetime': dict(title=u'Date Time', width=16),
-            'notification': dict(title=u'Notification', width=15),
-            'uid': dict(title=u'UID', width=16)
-        }
-        rows = []
-        for record in queryset.all():
-            row = dict(datetime='', notification=record.notification.name, uid=record.uid)
-            if record.completed:
-                row['datetime'] = record.completed.strftime('%d.%m.%Y %H:%M')
-            if record.json_result:
-                json_data = loads(record.json_result)
-                for key in json_data:
-                    if key not in column_keys:
-                        column_keys.append(key)
-                    if key not in column_formats:
-                        column_formats[key] = dict(title=key.title(), width=len(json_data[key]) + 2)
-                    else:
-                        if column_formats[key]['width'] < len(json_data[key]) + 2:
-                            column_formats[key]['width'] = len(json_data[key]) + 2
-                    row[key] = json_data[key]
-            rows.append(row)
+    def queue_successful_coa(self, request, queryset):
+        uids = {}
+        for coa_id, uid in queryset.values_list('notification__successful_coa_id', 'uid').iterator():
+            uids.setdefault(coa_id, []).append(uid)
+        counter = sum([CoaQueue.objects.bulk_enqueue(coa_id, uids[coa_id]) for coa_id in uids])
+        self.message_user(request, u'{0} pending CoA queued.'.format(counter))
 
-        output = BytesIO()
-        workbook = Workbook(output, {'in_memory': True})
-        header_format = workbook.add_format(
-            properties={
-                'bg_color': 'yellow',
-                'border_color': 'black',
-                'border': 1,
-                'text_wrap': True,
-                'valign': 'top'})
-        worksheet = workbook.add_worksheet(u'Records')
-        worksheet.write_row(0, 0, [column_formats[key]['title'] for key in column_keys], header_format)
-        index = 0
-        while index < len(column_keys):
-            worksheet.set_column(index, index, column_formats[column_keys[index]]['width'])
-            index += 1
-        index = 1
-        for data in rows:
-            worksheet.write_row(index, 0, [data[key] if key in data else '' for key in column_keys])
-            index += 1
-        workbook.close()
-        output.seek(0)
-        response = HttpResponse(output.read(),
-                                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    def export_to_excel(self, request, queryset):
+        response = StreamingHttpResponse(FileWrapper(write_records_xlsx(queryset)),
+                                         content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
         response['Content-Disposition'] = 'attachment; filename="User Notification Records.xlsx"'
         return response
 
+    def export_to_csv(self, request, queryset):
+        response = StreamingHttpResponse(iter_records_csv(queryset), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="User Notification Records.csv"'
+        return response
+
     acknowledge_records.short_description = u'Acknowledge records'
+    queue_successful_coa.short_description = u'Queue successful CoA'
     export_to_excel.short_description = u'Export to *.xlsx'
+    export_to_csv.short_description = u'Export to *.csv'
     include_records.short_description = u'Add records to the notification'
     exclude_records.short_description = u'Exclude records from the notification'
     activate_records.short_description = u'Activate records'
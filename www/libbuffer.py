@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+
+from django.conf import settings
+from time import time
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS completion (
+    record_id INTEGER PRIMARY KEY,
+    result TEXT NOT NULL,
+    completed REAL NOT NULL
+)'''
+
+
+class CompletionBuffer(object):
+    """Local SQLite journal of the notification answers waiting to be written to the database.
+
+    Every answer is committed to the journal before the subscriber gets the
+    answer page, a second answer for the same record is rejected by the
+    primary key. Each thread uses its own connection, several processes may
+    share the file.
+    """
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.execute(SCHEMA)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def add(self, record_id, result, completed=None):
+        """Journal the answer, return False if the record already has one waiting."""
+        cursor = self.connection.execute('INSERT OR IGNORE INTO completion (record_id, result, completed) '
+                                         'VALUES (?, ?, ?)', (record_id, result, completed or time()))
+        return cursor.rowcount == 1
+
+    def contains(self, record_id):
+        return self.connection.execute('SELECT 1 FROM completion WHERE record_id = ?',
+                                       (record_id,)).fetchone() is not None
+
+    def pending(self, limit):
+        """The oldest answers as [(record_id, result, completed)]."""
+        return self.connection.execute('SELECT record_id, result, completed FROM completion '
+                                       'ORDER BY completed LIMIT ?', (limit,)).fetchall()
+
+    def remove(self, record_ids):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('DELETE FROM completion WHERE record_id = ?',
+                                   [(record_id,) for record_id in record_ids])
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM completion').fetchone()[0]
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+_buffer = None
+
+
+def get_completion_buffer():
+    """The COMPLETION_BUFFER journal of this process, None when answers are written at once."""
+    global _buffer
+    if not settings.COMPLETION_BUFFER:
+        return None
+    if _buffer is None or _buffer.path != settings.COMPLETION_BUFFER:
+        _buffer = CompletionBuffer(settings.COMPLETION_BUFFER)
+    return _buffer
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import tempfile
+
+from django.conf import settings
+from django.utils import six
+from json import loads
+from xlsxwriter.workbook import Workbook
+
+COLUMN_KEYS = ['datetime', 'notification', 'uid']
+COLUMN_FORMATS = {
+    'datetime': dict(title=u'Date Time', width=16),
+    'notification': dict(title=u'Notification', width=15),
+    'uid': dict(title=u'UID', width=16)
+}
+RECORD_FIELDS = ('completed', 'notification__name', 'uid', 'json_result')
+
+
+def iter_values(queryset, fields, chunk_size=None):
+    """Yield values_list rows of the queryset by id ranges, only one chunk is held in memory."""
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    queryset = queryset.order_by('id').values_list('id', *fields)
+    last_id = None
+    while True:
+        chunk = queryset if last_id is None else queryset.filter(id__gt=last_id)
+        chunk = list(chunk[:chunk_size])
+        for row in chunk:
+            yield row[1:]
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1][0]
+
+
+def record_columns(queryset):
+    """Column keys and formats of the export, JSON result keys are found by reading the results only."""
+    column_keys = list(COLUMN_KEYS)
+    column_formats = dict((key, dict(COLUMN_FORMATS[key])) for key in COLUMN_FORMATS)
+    for json_result, in iter_values(queryset.exclude(json_result=None).exclude(json_result=''), ['json_result']):
+        json_data = loads(json_result)
+        for key in json_data:
+            width = len(json_data[key]) + 2
+            if key not in column_keys:
+                column_keys.append(key)
+            if key not in column_formats:
+                column_formats[key] = dict(title=key.title(), width=width)
+            elif column_formats[key]['width'] < width:
+                column_formats[key]['width'] = width
+    return column_keys, column_formats
+
+
+def record_rows(queryset, column_keys):
+    for completed, notification, uid, json_result in iter_values(queryset, RECORD_FIELDS):
+        row = dict(datetime='', notification=notification, uid=uid)
+        if completed:
+            row['datetime'] = completed.strftime('%d.%m.%Y %H:%M')
+        if json_result:
+            row.update(loads(json_result))
+        yield [row[key] if key in row else '' for key in column_keys]
+
+
+def write_records_xlsx(queryset):
+    """Write the records workbook row by row to a temporary file and return the file rewound.
+
+    Memory stays flat, but the XLSX zip is only complete when the workbook
+    is closed: the response can't start before the last row is written,
+    large exports wait for the whole query. The CSV export streams.
+    """
+    column_keys, column_formats = record_columns(queryset)
+    output = tempfile.TemporaryFile()
+    workbook = Workbook(output, {'constant_memory': True})
+    header_format = workbook.add_format(
+        properties={
+            'bg_color': 'yellow',
+            'border_color': 'black',
+            'border': 1,
+            'text_wrap': True,
+            'valign': 'top'})
+    worksheet = workbook.add_worksheet(u'Records')
+    for index, key in enumerate(column_keys):
+        worksheet.set_column(index, index, column_formats[key]['width'])
+    worksheet.write_row(0, 0, [column_formats[key]['title'] for key in column_keys], header_format)
+    for index, row in enumerate(record_rows(queryset, column_keys), 1):
+        worksheet.write_row(index, 0, row)
+    workbook.close()
+    output.seek(0)
+    return output
+
+
+class Echo(object):
+    def write(self, value):
+        return value
+
+
+def iter_records_csv(queryset):
+    column_keys, column_formats = record_columns(queryset)
+    writer = csv.writer(Echo())
+    encode = lambda value: value.encode('utf-8') if six.PY2 and isinstance(value, six.text_type) else value
+    yield writer.writerow([encode(column_formats[key]['title']) for key in column_keys])
+    for row in record_rows(queryset, column_keys):
+        yield writer.writerow([encode(value) for value in row])
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import re
+import threading
+import uuid
+
+from django.conf import settings
+from django.template import Context
+from django.template.loader import get_template
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.html import conditional_escape
+from time import time
+
+# Context keys set by the context processors, a template reading any of them is always fully rendered
+REQUEST_KEYS = ('request', 'user', 'perms', 'messages', 'DEFAULT_MESSAGE_LEVELS', 'debug', 'sql_queries',
+                'csrf_token')
+SIMPLE_TYPES = six.string_types + six.integer_types + (type(None), bool)
+
+
+class TrackingContext(dict):
+    """Context dictionary remembering every key the template looked for."""
+
+    def __init__(self, *args, **kwargs):
+        super(TrackingContext, self).__init__(*args, **kwargs)
+        self.used = set()
+
+    def __contains__(self, key):
+        self.used.add(key)
+        return super(TrackingContext, self).__contains__(key)
+
+
+class PrerenderedPage(object):
+    """Template output split into static parts and the per-request values between them."""
+    __slots__ = ('parts', 'names')
+
+    def __init__(self, parts, names):
+        self.parts = parts
+        self.names = names
+
+    def render(self, values):
+        output = [self.parts[0]]
+        for name, part in zip(self.names, self.parts[1:]):
+            output.append(conditional_escape(force_text(values[name])))
+            output.append(part)
+        return u''.join(output)
+
+
+class PageTemplate(object):
+    """Pre-rendered outputs of a template.
+
+    The values listed in names are replaced by sentinels and substituted on
+    every request. Any other context value the template reads is an input:
+    an output is pre-rendered for each combination of the inputs, at most
+    PAGE_VARIANTS of them, the other combinations are left to the engine
+    without compiling them. Every pre-rendered output is checked once against
+    a full render, the templates and variants which don't match (e.g. a
+    filter applied to a substituted value) are always fully rendered.
+    """
+
+    def __init__(self, template_name, names):
+        self.template = get_template(template_name).template
+        self.names = tuple(names)
+        self.token = uuid.uuid4().hex
+        self.pattern = re.compile(u'{0}(\\w+?){0}'.format(self.token))
+        self.inputs = ()
+        self.variants = {}
+        self.disabled = False
+        self.lock = threading.Lock()
+
+    def render_full(self, values):
+        context = TrackingContext(values)
+        output = self.template.render(Context(context))
+        return output, context.used
+
+    def compile(self, values):
+        sentinels = dict(values)
+        sentinels.update((name, u'{0}{1}{0}'.format(self.token, name)) for name in self.names)
+        output, used = self.render_full(sentinels)
+        chunks = self.pattern.split(output)
+        page = PrerenderedPage(chunks[0::2], chunks[1::2])
+        expected, used_full = self.render_full(values)
+        if set(page.names) - set(self.names) or page.render(values) != expected:
+            page = None
+        return page, (used | used_full) - set(self.names)
+
+    def render(self, values):
+        """The page for the context values, None when it has to be rendered by the engine."""
+        if self.disabled:
+            return None
+        key = tuple([values.get(name) for name in self.inputs])
+        if not all([isinstance(value, SIMPLE_TYPES) for value in key]):
+            return None
+        page = self.variants.get(key, False)
+        if page is False:
+            if len(self.variants) >= settings.PAGE_VARIANTS:
+                return None
+            page, used = self.compile(values)
+            with self.lock:
+                if used & set(REQUEST_KEYS):
+                    self.disabled = True
+                    return None
+                if not used <= set(self.inputs):
+                    self.inputs = tuple(sorted(used | set(self.inputs)))
+                    self.variants = {}
+                elif len(self.variants) < settings.PAGE_VARIANTS:
+                    self.variants[key] = page
+        return page.render(values) if page else None
+
+
+_pages = {}
+
+
+def render_page(notification, template_name, names, values):
+    """Render the notification page from its pre-rendered template, None if it can't be pre-rendered."""
+    if not settings.PRERENDER_PAGES:
+        return None
+    key = (notification.id, template_name, tuple(names))
+    entry = _pages.get(key)
+    if entry is None or entry[0] < time():
+        entry = _pages[key] = (time() + settings.PAGE_CACHE_TTL, PageTemplate(template_name, names))
+    return entry[1].render(values)
+
+
+def clear_pages():
+    _pages.clear()
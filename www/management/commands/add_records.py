@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import sys
+
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db.utils import IntegrityError
+from isg.libcache import CacheWriter
+from isg.libsession import iter_chunks
 from isgtool.contrib import log
+from time import time
 from www.models import UserNotificationRecord, UserNotification
 
 
@@ -10,23 +15,35 @@ class Command(BaseCommand):
     help = 'Import user notification records'
 
     def add_arguments(self, parser):
-        parser.add_argument('file_name', help='UID list\'s file name')
+        parser.add_argument('file_name', help='UID list\'s file name, - to read standard input')
+        parser.add_argument('-c', '--chunk-size', type=int, dest='chunk_size', default=settings.RECORD_IMPORT_CHUNK_SIZE,
+                            metavar='SIZE', help='UIDs inserted with one statement')
+
+    def uids(self, lines):
+        for line in lines:
+            uid = line.strip()
+            if uid:
+                yield uid
 
     def handle(self, *args, **options):
         logger = log(self)
         logger.info(u'Start records import')
         notification = UserNotification.objects.get_active()
         logger.info(u'Active notification: {}'.format(notification.name))
-        counter = 0
-        for line in open(options['file_name']):
-            uid = line.strip()
-            logger.debug(u'Create record for the UID {}'.format(uid))
-            try:
-                record = UserNotificationRecord.objects.create(uid=uid, notification=notification)
-            except IntegrityError:
-                logger.debug(u'UID {} already exists'.format(uid))
-            else:
-                logger.debug(u'Create record #{0} for the UID {1}'.format(record.id, uid))
-                counter += 1
-
-        logger.info(u'Records import finished. {0} new items were imported.'.format(counter))
\ No newline at end of file
+        lines = sys.stdin if options['file_name'] == '-' else open(options['file_name'])
+        started = time()
+        read = counter = 0
+        writer = CacheWriter()
+        try:
+            for chunk in iter_chunks(self.uids(lines), options['chunk_size']):
+                read += len(chunk)
+                counter += UserNotificationRecord.objects.bulk_import(notification, chunk, writer)
+                logger.info(u'{0} UIDs read, {1} imported, {2:.0f} rows/s'.format(
+                    read, counter, read / max(time() - started, 0.001)))
+        finally:
+            writer.close()
+            if lines is not sys.stdin:
+                lines.close()
+
+        logger.info(u'Records import finished. {0} new items were imported from {1} UIDs in {2:.2f} s.'.format(
+            counter, read, time() - started))
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from isgtool.contrib import log
+from time import sleep, time
+from www.libbuffer import get_completion_buffer
+from www.models import UserNotificationRecord
+
+
+class Command(BaseCommand):
+    help = 'Write buffered notification answers to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-d', '--daemon', dest='daemon', action='store_true',
+                            help='Keep running and flush answers as soon as they are buffered')
+        parser.add_argument('-b', '--batch-size', type=int, dest='batch_size', default=settings.COMPLETION_BATCH_SIZE,
+                            metavar='SIZE', help='Answers written at once')
+        parser.add_argument('-i', '--interval', type=float, dest='interval', default=settings.COMPLETION_FLUSH_INTERVAL,
+                            metavar='SECONDS', help='Daemon buffer polling interval when the buffer is empty')
+
+    def flush(self, completion_buffer, batch_size):
+        logger = log(self)
+        answers = completion_buffer.pending(batch_size)
+        if not answers:
+            return 0
+        started = time()
+        completed = UserNotificationRecord.objects.complete_many(answers)
+        completion_buffer.remove([answer[0] for answer in answers])
+        logger.info(u'{0} buffered answers flushed in {1:.2f} s, {2} records completed, oldest waited {3:.2f} s'.format(
+            len(answers), time() - started, completed, started - min([answer[2] for answer in answers])))
+        return len(answers)
+
+    def handle(self, *args, **options):
+        logger = log(self)
+        completion_buffer = get_completion_buffer()
+        if completion_buffer is None:
+            raise CommandError('COMPLETION_BUFFER is not set')
+        logger.info(u'Flush of the buffered answers from {0} started'.format(completion_buffer.path))
+        while True:
+            while self.flush(completion_buffer, options['batch_size']) >= options['batch_size']:
+                pass
+            if not options['daemon']:
+                break
+            close_old_connections()
+            sleep(options['interval'])
+        logger.info(u'Flush of the buffered answers finished')
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from isg.libmetrics import worker_exporter
+from isg.libtiming import current_timing, finish_timing, stage_stats, start_timing
+from isgtool.contrib import log
+from time import time
+
+
+class StageTimingMiddleware(object):
+    """Times the request stages, keeps sampled timings and logs slow requests with their breakdown.
+
+    Should be the first middleware so the whole request is timed.
+    """
+
+    def process_request(self, request):
+        start_timing(request.path)
+
+    def process_template_response(self, request, response):
+        timing = current_timing()
+        if timing is not None:
+            started = time()
+            response.add_post_render_callback(lambda response: timing.add('render', time() - started))
+        return response
+
+    def process_response(self, request, response):
+        timing = finish_timing()
+        if timing is None:
+            return response
+        if timing.sampled:
+            stage_stats.record(timing)
+        if timing.total >= settings.TIMING_SLOW_REQUEST:
+            log(self).warning(u'Slow request {0} from {1}: {2:.1f} ms ({3})'.format(
+                timing.path, request.META.get('REMOTE_ADDR'), timing.total * 1000, timing.describe()))
+        return response
+
+
+class WorkerMetricsMiddleware(object):
+    """Exports the metrics of this worker every METRICS_EXPORT_INTERVAL seconds for the metrics view."""
+
+    def process_response(self, request, response):
+        if worker_exporter.due():
+            worker_exporter.export()
+        return response
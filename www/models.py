@@ -1,25 +1,42 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
+from django.conf import settings
 from django.core.cache import cache
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError
+from isg.libcache import CacheWriter, CachedValue, local_cache
+from isg.libmetrics import PORTAL_LOOKUP_SECONDS, PORTAL_LOOKUPS
+from isg.libsession import iter_chunks
+from isg.libtiming import stage
 from isg.models import CoaCommand, CoaQueue
+from www.libpage import clear_pages
 from isgtool.contrib import log
 from json import loads
+from time import time
+
+
+class CachedNotification(CachedValue):
+    __slots__ = ('id', 'name', 'template', 'coa_id', 'successful_coa_id')
+    TAG = 'N'
 
 
 class UserNotificationManager(models.Manager):
     ACTIVE_KEY = 'active-notification'
 
     def get_active(self):
-        active = cache.get(self.ACTIVE_KEY)
+        active = local_cache.get('notification', self.ACTIVE_KEY)
         if active:
             return active
-        else:
-            active = self.get(is_active=True)
-            cache.set(self.ACTIVE_KEY, active, None)
-            return active
+        active = CachedNotification.unpack(cache.get(self.ACTIVE_KEY))
+        if active is None:
+            active = CachedNotification.from_instance(self.get(is_active=True))
+            cache.set(self.ACTIVE_KEY, active.pack(), None)
+        local_cache.set('notification', self.ACTIVE_KEY, active)
+        return active
 
 
 class UserNotification(models.Model):
@@ -33,8 +50,6 @@ class UserNotification(models.Model):
 
     objects = UserNotificationManager()
 
-    # TODO Override self.save(...) for active cache update
-
     class Meta:
         ordering = ('name',)
 
@@ -56,34 +71,135 @@ class UserNotification(models.Model):
 
 RECORD_KEY_TEMPLATE = 'record_{uid}_{nid}'
 RECORD_ID_KEY_TEMPLATE = 'record_id_{id}'
+# Remembers for NEGATIVE_CACHE_TIMEOUT seconds that the UID has no active record
+RECORD_MISS_KEY_TEMPLATE = 'record_miss_{uid}_{nid}'
 
 
 class UserNotificationRecordManager(models.Manager):
     def get_by_uid(self, uid, notification=None):
         if not notification:
             notification = UserNotification.objects.get_active()
+        started = time()
         key = RECORD_KEY_TEMPLATE.format(uid=uid, nid=notification.id)
-        record = cache.get(key)
-        if record:
-            return record
-        else:
-            record = self.get_active().get(uid=uid)
-            record.update_cache()
-            return record
+        miss_key = RECORD_MISS_KEY_TEMPLATE.format(uid=uid, nid=notification.id)
+        missing = False
+        with stage('record_cache'):
+            record = local_cache.get('record', key)
+            source = 'local'
+            if not record:
+                missing = local_cache.get('record_miss', miss_key)
+                if not missing:
+                    values = cache.get_many([key, miss_key])
+                    record = CachedRecord.unpack(values.get(key))
+                    missing = not record and values.get(miss_key)
+                    source = 'memcached'
+        try:
+            if record:
+                if source != 'local':
+                    local_cache.set('record', key, record)
+                return record
+            elif missing:
+                if source != 'local':
+                    local_cache.set('record_miss', miss_key, True)
+                source = 'negative'
+                raise self.model.DoesNotExist(u'No active record for the UID \'{0}\''.format(uid))
+            else:
+                source = 'db'
+                try:
+                    with stage('record_db'):
+                        return self.get_active().get(uid=uid).update_cache()
+                except self.model.DoesNotExist:
+                    source = 'miss'
+                    cache.set(miss_key, True, settings.NEGATIVE_CACHE_TIMEOUT)
+                    local_cache.set('record_miss', miss_key, True)
+                    raise
+        finally:
+            PORTAL_LOOKUPS.inc(kind='record', source=source)
+            PORTAL_LOOKUP_SECONDS.observe(time() - started, kind='record')
 
     def get_by_id(self, id):
         key = RECORD_ID_KEY_TEMPLATE.format(id=id)
-        record = cache.get(key)
+        with stage('record_cache'):
+            record = local_cache.get('record', key)
+            if record:
+                return record
+            record = CachedRecord.unpack(cache.get(key))
         if record:
+            local_cache.set('record', key, record)
             return record
         else:
-            record = self.get_active().get(id=id)
-            record.update_cache()
-            return record
+            with stage('record_db'):
+                return self.get_active().get(id=id).update_cache()
 
     def get_active(self):
         return self.filter(is_active=True, is_excluded=False)
 
+    def forget_misses(self, records):
+        """Drop the remembered misses of the [(uid, notification_id)] records."""
+        keys = [RECORD_MISS_KEY_TEMPLATE.format(uid=uid, nid=nid) for uid, nid in records]
+        for chunk in iter_chunks(keys, settings.RECORD_IMPORT_CHUNK_SIZE):
+            cache.delete_many(chunk)
+        for key in keys:
+            local_cache.delete('record_miss', key)
+
+    def bulk_import(self, notification, uids, writer=None):
+        """Create records for the new UIDs with one insert and cache them, return the number of new records."""
+        uids = set(uids)
+        uids -= set(self.filter(notification_id=notification.id, uid__in=uids).values_list('uid', flat=True))
+        if not uids:
+            return 0
+        try:
+            with transaction.atomic():
+                self.bulk_create([UserNotificationRecord(notification_id=notification.id, uid=uid) for uid in uids])
+        except IntegrityError:
+            uids = set([uid for uid in uids if self._create_missing(notification, uid)])
+        own_writer = writer is None
+        if own_writer:
+            writer = CacheWriter()
+        for record in self.filter(notification_id=notification.id, uid__in=uids):
+            writer.set_many(record.cache_items())
+        if own_writer:
+            writer.close()
+        self.forget_misses([(uid, notification.id) for uid in uids])
+        return len(uids)
+
+    def complete_many(self, answers):
+        """Store [(record_id, result, completed timestamp)] answers with one update, queue the successful CoA
+        and refresh the cached records, return the number of records completed.
+
+        Records already completed in the database are left untouched.
+        """
+        answers = dict((record_id, (result, completed)) for record_id, result, completed in answers)
+        ids = list(self.filter(id__in=list(answers), is_completed=False).values_list('id', flat=True))
+        if not ids:
+            return 0
+        with transaction.atomic():
+            self.filter(id__in=ids).update(
+                is_completed=True,
+                json_result=Case(*[When(id=record_id, then=Value(answers[record_id][0])) for record_id in ids],
+                                 output_field=models.TextField()),
+                completed=Case(*[When(id=record_id, then=Value(datetime.fromtimestamp(answers[record_id][1])))
+                                 for record_id in ids], output_field=models.DateTimeField()))
+        uids = {}
+        items = {}
+        for record in self.filter(id__in=ids).select_related('notification'):
+            uids.setdefault(record.notification.successful_coa_id, []).append(record.uid)
+            items.update(record.cache_items())
+        cache.set_many(items)
+        for key, value in items.items():
+            local_cache.set('record', key, CachedRecord.unpack(value))
+        for coa_id in uids:
+            CoaQueue.objects.bulk_enqueue(coa_id, uids[coa_id])
+        return len(ids)
+
+    def _create_missing(self, notification, uid):
+        try:
+            with transaction.atomic():
+                self.create(notification_id=notification.id, uid=uid)
+        except IntegrityError:
+            return False
+        return True
+
 
 class UserNotificationRecord(models.Model):
     notification = models.ForeignKey('UserNotification', verbose_name=u'Notification Template')
@@ -109,16 +225,26 @@ class UserNotificationRecord(models.Model):
         self.is_completed = True
         self.completed = datetime.now()
         self.save()
-        CoaQueue.objects.create(coa=self.notification.successful_coa, uid=self.uid)
+        CoaQueue.objects.enqueue(self.notification.successful_coa_id, self.uid)
 
-    def update_cache(self):
-        key1 = RECORD_KEY_TEMPLATE.format(uid=self.uid, nid=self.notification.id)
+    def cache_items(self):
+        value = CachedRecord.from_instance(self).pack()
+        key1 = RECORD_KEY_TEMPLATE.format(uid=self.uid, nid=self.notification_id)
         key2 = RECORD_ID_KEY_TEMPLATE.format(id=self.id)
-        cache.set_many({key1: self, key2: self})
+        return {key1: value, key2: value}
+
+    def update_cache(self):
+        cached = CachedRecord.from_instance(self)
+        items = self.cache_items()
+        cache.set_many(items)
+        for key in items:
+            local_cache.set('record', key, cached)
+        return cached
 
     def save(self, *args, **kwargs):
         super(UserNotificationRecord, self).save(*args, **kwargs)
         self.update_cache()
+        UserNotificationRecord.objects.forget_misses([(self.uid, self.notification_id)])
 
     def display_answer(self):
         if self.json_result:
@@ -126,3 +252,36 @@ class UserNotificationRecord(models.Model):
             return u', \n'.join([u'{0}: {1}'.format(key, result[key]) for key in result])
         else:
             return '-'
+
+
+class CachedRecord(CachedValue):
+    __slots__ = ('id', 'uid', 'notification_id', 'is_completed', 'is_acknowledged')
+    TAG = 'R'
+
+    def complete(self, result):
+        """Store the answer with a single-row update, the buffered answers go through complete_many()."""
+        if not self.is_acknowledged:
+            log(self).info(u'Notification #{0} UID{1} is completed.'.format(self.id, self.uid))
+        if not UserNotificationRecord.objects.filter(id=self.id, is_completed=False).update(
+                is_completed=True, json_result=result, completed=datetime.now()):
+            return
+        self.is_completed = True
+        items = {RECORD_KEY_TEMPLATE.format(uid=self.uid, nid=self.notification_id): self.pack(),
+                 RECORD_ID_KEY_TEMPLATE.format(id=self.id): self.pack()}
+        cache.set_many(items)
+        for key in items:
+            local_cache.set('record', key, self)
+        notification = UserNotification.objects.get_active()
+        if notification.id == self.notification_id:
+            coa_id = notification.successful_coa_id
+        else:
+            coa_id = UserNotification.objects.values_list('successful_coa_id', flat=True).get(id=self.notification_id)
+        CoaQueue.objects.enqueue(coa_id, self.uid)
+
+
+@receiver([post_save, post_delete], sender=UserNotification)
+def invalidate_notification(sender, instance, **kwargs):
+    cache.delete(UserNotificationManager.ACTIVE_KEY)
+    local_cache.clear('notification')
+    local_cache.clear('record')
+    clear_pages()
@@ -1,3 +1,144 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import zipfile
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.template import Context
+from django.test import TestCase, override_settings
+
+from isg.libcache import cache_session_data, local_cache
+from isg.models import CoaQueue
+from isg.testing import LOCMEM_CACHES, PortalTestMixin
+from json import loads
+from time import sleep
+from www import libpage
+from www.libbuffer import get_completion_buffer
+from www.libexport import iter_records_csv, write_records_xlsx
+from www.models import CachedRecord, UserNotification, UserNotificationRecord
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AddRecordsTest(PortalTestMixin, TestCase):
+    def test_import(self):
+        notification = self.create_notification()
+        self.create_records(notification, ['user3'])
+        with tempfile.NamedTemporaryFile() as uids:
+            uids.write(b''.join(b'user%d\n' % (n % 40) for n in range(100)) + b'\n')
+            uids.flush()
+            call_command('add_records', uids.name, chunk_size=7)
+        self.assertEqual(UserNotificationRecord.objects.count(), 40)
+        record = UserNotificationRecord.objects.get(uid='user7')
+        self.assertEqual(CachedRecord.unpack(cache.get('record_user7_{0}'.format(notification.id))).id, record.id)
+        self.assertEqual(CachedRecord.unpack(cache.get('record_id_{0}'.format(record.id))).uid, 'user7')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, EXPORT_CHUNK_SIZE=3)
+class ExportTest(PortalTestMixin, TestCase):
+    def test_export(self):
+        notification = self.create_notification()
+        for n in range(10):
+            self.create_records(notification, ['user{0}'.format(n)],
+                                json_result='{{"answer{0}": "yes"}}'.format(n % 2) if n else None)
+        queryset = UserNotificationRecord.objects.all()
+        rows = list(iter_records_csv(queryset))
+        self.assertEqual(rows[0], 'Date Time,Notification,UID,Answer1,Answer0\r\n')
+        self.assertEqual(rows[1:3], [',Poll,user0,,\r\n', ',Poll,user1,yes,\r\n'])
+        self.assertEqual(len(rows), 11)
+        workbook = zipfile.ZipFile(write_records_xlsx(queryset))
+        self.assertIn(b'user9', workbook.read('xl/worksheets/sheet1.xml'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CompletionBufferTest(PortalTestMixin, TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_flush(self):
+        records = self.create_records(self.create_notification(), ['user{0}'.format(n) for n in range(5)],
+                                      is_active=True)
+        with self.settings(COMPLETION_BUFFER=os.path.join(self.directory, 'answers.db')):
+            for record in records:
+                response = self.client.get('/sttk-notification-answer/', {'rid': record.id, 'answer': 'yes'})
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.client.get('/sttk-notification-answer/', {'rid': records[0].id}).status_code, 404)
+            self.assertEqual(UserNotificationRecord.objects.filter(is_completed=True).count(), 0)
+            call_command('flush_completions', batch_size=2)
+            self.assertEqual(len(get_completion_buffer()), 0)
+        self.assertEqual(UserNotificationRecord.objects.filter(is_completed=True).count(), 5)
+        self.assertEqual(CoaQueue.objects.count(), 5)
+        local_cache.clear('record')
+        record = UserNotificationRecord.objects.get_by_id(records[3].id)
+        self.assertTrue(record.is_completed)
+        self.assertEqual(loads(UserNotificationRecord.objects.get(id=record.id).json_result)['answer'], 'yes')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CachedValueTest(PortalTestMixin, TestCase):
+    def test_cached_values(self):
+        notification = self.create_notification()
+        record, = self.create_records(notification, ['user'], is_active=True, json_result='{"answer": "yes"}')
+        self.assertEqual(cache.get('record_id_{0}'.format(record.id)),
+                         ('R', 1, record.id, 'user', notification.id, False, False))
+        self.assertIsNone(CachedRecord.unpack(('R', 0, record.id, 'user', notification.id, False, False)))
+        self.assertIsNone(CachedRecord.unpack(record))
+        local_cache.clear('record')
+        cache.set('record_id_{0}'.format(record.id), record)
+        cached = UserNotificationRecord.objects.get_by_id(record.id)
+        self.assertEqual((cached.id, cached.uid, cached.is_completed), (record.id, 'user', False))
+        UserNotification.objects.get_active()
+        with self.assertNumQueries(4):
+            cached.complete('{"answer": "no"}')
+        self.assertTrue(UserNotificationRecord.objects.get(id=record.id).is_completed)
+        self.assertTrue(UserNotificationRecord.objects.get_by_id(record.id).is_completed)
+        self.assertTrue(UserNotificationRecord.objects.get_by_uid('user', notification).is_completed)
+        self.assertEqual(CoaQueue.objects.get().uid, 'user')
+        self.assertEqual(UserNotification.objects.get_active().template, 'max')
+
+    def test_local_expiry(self):
+        notification = self.create_notification()
+        record, = self.create_records(notification, ['user'], is_active=True)
+        local_cache.clear('record')
+        UserNotificationRecord.objects.get_by_uid('user', notification)
+        UserNotificationRecord.objects.get_by_id(record.id)
+        keys = [('record', 'record_user_{0}'.format(notification.id)), ('record', 'record_id_{0}'.format(record.id))]
+        expires = [local_cache.data[key][0] for key in keys]
+        sleep(0.01)
+        UserNotificationRecord.objects.get_by_uid('user', notification)
+        UserNotificationRecord.objects.get_by_id(record.id)
+        self.assertEqual([local_cache.data[key][0] for key in keys], expires)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PrerenderedPageTest(PortalTestMixin, TestCase):
+    def setUp(self):
+        self.notification = self.create_notification()
+        self.record, = self.create_records(self.notification, ['user'], is_active=True)
+        cache_session_data(dict(ip='10.0.0.1', uid='user', bid='127.0.0.1', sid='1'))
+
+    def test_notification(self):
+        with self.settings(PRERENDER_PAGES=False):
+            expected = self.client.get('/sttk-notification/', REMOTE_ADDR='10.0.0.1').content
+        for n in range(3):
+            self.assertEqual(self.client.get('/sttk-notification/', REMOTE_ADDR='10.0.0.1').content, expected)
+        page_template = list(libpage._pages.values())[0][1]
+        self.assertEqual(len(page_template.variants), 1)
+        self.assertIn('value="{0}"'.format(self.record.id).encode('utf-8'), expected)
+        self.notification.save()
+        self.assertEqual(libpage._pages, {})
+
+    def test_answer(self):
+        page = libpage.PageTemplate('plus100/answer.html', ())
+        for code in '1', '2', '1', '3':
+            values = dict(code=code, pppoe='')
+            expected = page.template.render(Context(values))
+            self.assertEqual(page.render(values), expected)
+        self.assertEqual(page.inputs, ('code', 'pppoe'))
+        self.assertEqual(len(page.variants), 3)
+        with self.settings(PAGE_VARIANTS=3):
+            self.assertIsNone(page.render(dict(code='4', pppoe='')))
+        self.assertEqual(len(page.variants), 3)
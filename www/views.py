@@ -3,13 +3,16 @@
 from datetime import datetime
 from django.conf import settings
 from django.core.urlresolvers import reverse_lazy
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.views.generic import TemplateView
 from isg.libcache import get_uid
+from isg.libtiming import stage
 from isgtool.contrib import log
 from json import dumps
+from www.libbuffer import get_completion_buffer
+from www.libpage import render_page
 from www.models import UserNotification, UserNotificationRecord
 
 
@@ -52,12 +55,27 @@ class TemplatePreView(TemplateView):
         return context
 
 
-class NotificationView(TemplateView):
+class PrerenderedPageMixin(object):
+    """Serves the page from the pre-rendered template, page_values are substituted on every request."""
+    page_values = ()
+
+    def render_to_response(self, context, **response_kwargs):
+        with stage('render'):
+            content = render_page(self.notification, self.get_template_names()[0], self.page_values, context)
+        if content is None:
+            return super(PrerenderedPageMixin, self).render_to_response(context, **response_kwargs)
+        return HttpResponse(content, **response_kwargs)
+
+
+class NotificationView(PrerenderedPageMixin, TemplateView):
+    page_values = ('rid', 'answer_url')
+
     def __init__(self):
         super(NotificationView, self).__init__()
         self.logger = log(self)
         try:
-            self.notification = UserNotification.objects.get_active()
+            with stage('notification'):
+                self.notification = UserNotification.objects.get_active()
         except UserNotification.DoesNotExist as ex:
             self.logger.critical(u'Active notification doesn\'t exist.')
             raise_exception(ex)
@@ -67,11 +85,13 @@ class NotificationView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super(NotificationView, self).get_context_data(**kwargs)
-        uid = get_uid(self.request.META['REMOTE_ADDR'])
+        with stage('get_uid'):
+            uid = get_uid(self.request.META['REMOTE_ADDR'])
         if uid:
             try:
                 record = UserNotificationRecord.objects.get_by_uid(uid, self.notification)
-                if record.is_completed:
+                completion_buffer = get_completion_buffer()
+                if record.is_completed or (completion_buffer and completion_buffer.contains(record.id)):
                     raise_exception(Http404)
             except UserNotificationRecord.DoesNotExist as ex:
                 self.logger.error(
@@ -86,12 +106,13 @@ class NotificationView(TemplateView):
             raise_exception(u'No cached session info with IP {0}'.format(self.request.META['REMOTE_ADDR']))
 
 
-class AnswerView(TemplateView):
+class AnswerView(PrerenderedPageMixin, TemplateView):
     def __init__(self):
         super(AnswerView, self).__init__()
         self.logger = log(self)
         try:
-            self.notification = UserNotification.objects.get_active()
+            with stage('notification'):
+                self.notification = UserNotification.objects.get_active()
         except UserNotification.DoesNotExist as ex:
             self.logger.critical(u'Active notification doesn\'t exist.')
             raise_exception(ex)
@@ -107,7 +128,15 @@ class AnswerView(TemplateView):
                     u'Notification {0} for user \{1}\ already has been completed'.format(record.id, record.uid))
                 raise_exception(
                     u'Notification {0} for user \{1}\ already has been completed'.format(record.id, record.uid))
-            record.complete(dumps(self.request.GET))
+            with stage('complete'):
+                completion_buffer = get_completion_buffer()
+                if completion_buffer is None:
+                    record.complete(dumps(self.request.GET))
+                elif not completion_buffer.add(record.id, dumps(self.request.GET)):
+                    self.logger.debug(
+                        u'Notification {0} for user \{1}\ already has been answered'.format(record.id, record.uid))
+                    raise_exception(
+                        u'Notification {0} for user \{1}\ already has been answered'.format(record.id, record.uid))
         except KeyError as ex:
             self.logger.error('Invalid GET query.')
             raise_exception(ex)